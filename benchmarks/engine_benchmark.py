@@ -0,0 +1,63 @@
+""" CLIクラスをプロセス内で繰り返し呼び出す場合のベンチマークです。
+
+    python benchmarks/engine_benchmark.py --calls 1000
+    python benchmarks/engine_benchmark.py --connection postgresql://... --calls 1000
+
+以下の2つの方法で `get` を繰り返し実行し、所要時間を比較します。
+
+- fresh:  呼び出しごとにEngineを破棄します(以前の、ハンドラごとに create_engine していた動作と同等です)
+- shared: database.py のレジストリでEngine(接続プール)を共有します
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from io import StringIO
+from contextlib import redirect_stdout, redirect_stderr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bind9zone import database  # noqa: E402
+from bind9zone.cli import Bind9ZoneCLI  # noqa: E402
+
+ZONE = 'bench/bench.example.com'
+
+
+def prepare(connection):
+    with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+        Bind9ZoneCLI(['init', '--connection', connection, '--drop']).run()
+        Bind9ZoneCLI(['set', '--connection', connection, '--zone', ZONE, 'www', 'A', '192.0.2.1']).run()
+
+
+def bench_get(connection, calls, shared):
+    args = ['get', '--connection', connection, '--zone', ZONE, 'www', 'A']
+    database.dispose_engines()
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+        for _ in range(calls):
+            if not shared:
+                database.dispose_engines()
+            Bind9ZoneCLI(args).run()
+    elapsed = time.perf_counter() - start
+    print('{:8s} calls={:6d}  total={:7.3f} sec  per call={:7.3f} ms'.format(
+        'shared' if shared else 'fresh', calls, elapsed, elapsed * 1000 / calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='in-process CLI engine benchmark')
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--connection', default=None,
+                        help='Database connection string (default: temporary SQLite file)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        connection = args.connection or 'sqlite:///{}'.format(os.path.join(workdir, 'bench.sqlite3'))
+        prepare(connection)
+        bench_get(connection, args.calls, shared=False)
+        bench_get(connection, args.calls, shared=True)
+        database.dispose_engines()
+
+
+if __name__ == '__main__':
+    main()
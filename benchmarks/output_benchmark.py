@@ -0,0 +1,69 @@
+""" zoneファイル出力(通常/コンパクト)のベンチマークです。
+
+    python benchmarks/output_benchmark.py --records 100000
+
+合成したレコードを使用して、出力サイズと出力時間を比較します。
+named-checkzone がPATH上にある場合は、その読み込み時間も計測します。
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bind9zone import ZoneFile, ZoneRecord  # noqa: E402
+
+ORIGIN = 'bench.example.com.'
+
+
+def make_records(count):
+    records = [ZoneRecord({'name': '@', 'type': 'SOA', 'ttl': 600, 'origin': ORIGIN, 'namespace': 'bench',
+                           'data': 'ns.example.com. admin.example.com. ( 1 3600 1200 604800 600 )'}),
+               ZoneRecord({'name': '@', 'type': 'NS', 'ttl': 3600, 'origin': ORIGIN, 'namespace': 'bench',
+                           'data': 'ns.example.com.'})]
+    for i in range(count):
+        name = 'host{}'.format(i // 2)
+        records.append(ZoneRecord({'name': name, 'type': 'A', 'ttl': 60, 'origin': ORIGIN, 'namespace': 'bench',
+                                   'data': '10.{}.{}.{}'.format((i >> 16) & 255, (i >> 8) & 255, i & 255)}))
+    return records
+
+
+def bench_output(records, workdir, label, **options):
+    start = time.perf_counter()
+    zonetext = '\n'.join(ZoneFile.iter_zonefile(records, **options)) + '\n'
+    elapsed = time.perf_counter() - start
+    path = os.path.join(workdir, '{}.zone'.format(label))
+    with open(path, mode='w') as output:
+        output.write(zonetext)
+    print('{:8s} size={:10d} bytes  render={:7.3f} sec'.format(label, len(zonetext), elapsed))
+    return path
+
+
+def bench_checkzone(path, label):
+    command = shutil.which('named-checkzone')
+    if command is None:
+        return
+    start = time.perf_counter()
+    subprocess.run([command, '-q', ORIGIN, path], check=False)
+    print('{:8s} named-checkzone={:7.3f} sec'.format(label, time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='zonefile output benchmark')
+    parser.add_argument('--records', type=int, default=50000)
+    args = parser.parse_args()
+
+    records = ZoneFile.sort_records(make_records(args.records))
+    with tempfile.TemporaryDirectory() as workdir:
+        full = bench_output(records, workdir, 'full', sort=False)
+        compact = bench_output(records, workdir, 'compact', sort=False, compact=True, with_meta=False)
+        bench_checkzone(full, 'full')
+        bench_checkzone(compact, 'compact')
+
+
+if __name__ == '__main__':
+    main()
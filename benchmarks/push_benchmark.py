@@ -0,0 +1,88 @@
+""" pushzone処理(パース -> DB登録)のベンチマークです。
+
+    python benchmarks/push_benchmark.py --records 100000
+
+合成したzoneファイルを使用して、以下を計測します。
+
+- parse:  パース結果1レコードあたりのメモリ使用量(dict / ParsedRecord)
+- insert: ORM(add_all)とexecutemany(query.insert_records)による登録時間
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from bind9zone import ZoneFile, ZoneRecord, query  # noqa: E402
+
+ORIGIN = 'bench.example.com.'
+
+
+def make_zonetext(count):
+    lines = ['$ORIGIN {}'.format(ORIGIN), '$TTL 600',
+             '@ 600 IN SOA ns.example.com. admin.example.com. ( 1 3600 1200 604800 600 )']
+    for i in range(count):
+        lines.append('host{} 60 IN A 10.{}.{}.{}'.format(i, (i >> 16) & 255, (i >> 8) & 255, i & 255))
+    return '\n'.join(lines) + '\n'
+
+
+def measure_memory(factory):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = factory()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return records, (after - before) / max(len(records), 1)
+
+
+def create_session(workdir, name):
+    engine = create_engine('sqlite:///' + os.path.join(workdir, name))
+    ZoneRecord.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)()
+
+
+def bench_parse(zonetext):
+    records, per_record = measure_memory(
+        lambda: list(ZoneFile.from_stream(StringIO(zonetext), origin=ORIGIN)))
+    print('parse  total        : {:8.1f} bytes/record (including strings)'.format(per_record))
+    # 文字列は共有した上で、レコードのコンテナ部分のみを比較します。
+    _, per_record = measure_memory(lambda: [type(r)._make(r) for r in records])
+    print('record ParsedRecord : {:8.1f} bytes/record'.format(per_record))
+    _, per_record = measure_memory(lambda: [dict(r) for r in records])
+    print('record dict         : {:8.1f} bytes/record'.format(per_record))
+    return records
+
+
+def bench_insert(records, workdir):
+    session = create_session(workdir, 'orm.sqlite3')
+    start = time.perf_counter()
+    session.add_all([ZoneRecord({**r, 'namespace': 'bench'}) for r in records])
+    session.commit()
+    print('insert ORM add_all  : {:8.3f} sec'.format(time.perf_counter() - start))
+
+    session = create_session(workdir, 'core.sqlite3')
+    start = time.perf_counter()
+    query.insert_records(session, 'bench', records)
+    print('insert executemany  : {:8.3f} sec'.format(time.perf_counter() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pushzone benchmark')
+    parser.add_argument('--records', type=int, default=50000)
+    args = parser.parse_args()
+
+    zonetext = make_zonetext(args.records)
+    print('records={} zonefile={} bytes'.format(args.records, len(zonetext)))
+    records = bench_parse(zonetext)
+    with tempfile.TemporaryDirectory() as workdir:
+        bench_insert(records, workdir)
+
+
+if __name__ == '__main__':
+    main()
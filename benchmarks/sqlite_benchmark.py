@@ -0,0 +1,78 @@
+""" SQLiteの設定(SQLITE_PROFILE, bulkpush --bulk-load)ごとの bulkpush のベンチマークです。
+
+    python benchmarks/sqlite_benchmark.py --zones 200 --records 500
+
+合成した複数のzoneファイルを、以下の設定で空のDBに bulkpush して所要時間を比較します。
+
+- default:              SQLiteのデフォルト(rollback journal, synchronous=FULL)
+- default+bulk-load:    デフォルトの設定で --bulk-load を指定
+- performance:          SQLITE_PROFILE=performance (WAL, synchronous=NORMAL, mmap 等)
+- performance+bulk-load: SQLITE_PROFILE=performance で --bulk-load を指定
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from io import StringIO
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bind9zone import database  # noqa: E402
+from bind9zone.cli import Bind9ZoneCLI  # noqa: E402
+
+NAMESPACE = 'bench'
+
+
+def make_zones(workdir, zones, records):
+    os.makedirs(os.path.join(workdir, NAMESPACE))
+    names = []
+    for z in range(zones):
+        origin = 'zone{}.example.com'.format(z)
+        lines = ['$ORIGIN {}.'.format(origin), '$TTL 600',
+                 '@ 600 IN SOA ns.example.com. admin.example.com. ( 1 3600 1200 604800 600 )',
+                 '@ 600 IN NS ns.example.com.']
+        for i in range(records):
+            lines.append('host{} 60 IN A 10.{}.{}.{}'.format(i, z & 255, (i >> 8) & 255, i & 255))
+        with open(os.path.join(workdir, NAMESPACE, origin + '.zone'), mode='w') as output:
+            output.write('\n'.join(lines) + '\n')
+        names.append('{}/{}'.format(NAMESPACE, origin))
+    return ','.join(names)
+
+
+def bench_push(workdir, zones, label, profile, bulk_load):
+    connection = 'sqlite:///{}'.format(os.path.join(workdir, '{}.sqlite3'.format(label)))
+    if profile:
+        os.environ['SQLITE_PROFILE'] = profile
+    else:
+        os.environ.pop('SQLITE_PROFILE', None)
+    database.dispose_engines()
+    args = ['bulkpush', '--connection', connection, '--dir', workdir, '--zones', zones]
+    if bulk_load:
+        args.append('--bulk-load')
+    with redirect_stdout(StringIO()):
+        Bind9ZoneCLI(['init', '--connection', connection]).run()
+        start = time.perf_counter()
+        Bind9ZoneCLI(args).run()
+        elapsed = time.perf_counter() - start
+    print('{:22s} bulkpush={:7.3f} sec'.format(label, elapsed))
+    database.dispose_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite bulkpush benchmark')
+    parser.add_argument('--zones', type=int, default=200)
+    parser.add_argument('--records', type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        zones = make_zones(workdir, args.zones, args.records)
+        bench_push(workdir, zones, 'default', None, False)
+        bench_push(workdir, zones, 'default+bulk-load', None, True)
+        bench_push(workdir, zones, 'performance', 'performance', False)
+        bench_push(workdir, zones, 'performance+bulk-load', 'performance', True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from .zonerecord import ZoneRecord
-from .zonefile import ZoneFile
+from .zonefile import ZoneFile, ParsedRecord
 from . import query
 
-__all__ = [ZoneRecord, ZoneFile, query]
+__all__ = [ZoneRecord, ZoneFile, ParsedRecord, query]
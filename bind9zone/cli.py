@@ -1,13 +1,25 @@
 import sys
 import os
 import re
-import io
+import json
+import codecs
 import argparse
+import tempfile
+import itertools
+import ipaddress
 import validators
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from .zonerecord import ZoneRecord
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from .zonerecord import ZoneRecord, Base
+from .rendercache import compress_zone, iter_zone_chunks
+from .journal import format_changes, parse_as_of, SNAPSHOT_INTERVAL
 from .zonefile import ZoneFile
+from .parsecache import ParseCache, DigestReader
+from .zoneio import open_zone_reader, find_zone_file
+from .rawzone import iter_raw_zone, RawFormatError
+from . import reversezone
+from . import querycache
+from . import database
 from . import utils as zutils
 from . import query
 
@@ -47,6 +59,45 @@ class MultiZonesAction(argparse.Action):
         setattr(namespace, self.dest, zones)
 
 
+class MultiDirsAction(argparse.Action):
+    """ 複数回指定できるディレクトリ引数を受け取る argparse.Action です。
+    1つの引数に os.pathsep (":") 区切りで複数のディレクトリを指定することもできます。
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        dirs = getattr(namespace, self.dest)
+        if dirs is None or dirs is self.default:
+            dirs = []
+        setattr(namespace, self.dest, dirs + split_dirs(values))
+
+
+def split_dirs(value):
+    """ os.pathsep 区切りのディレクトリ指定(ZONEDIR環境変数等)をlistにします。未指定の場合はNoneを返します。 """
+    if not value:
+        return None
+    return [d for d in value.split(os.pathsep) if d]
+
+
+def address_argument(value):
+    """ search --address の値(IPv4/IPv6アドレスまたはCIDR表記)を検証する argparse の type です。 """
+    try:
+        ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{}" is not an IPv4/IPv6 address or CIDR range.'.format(value))
+    return value
+
+
+def reverse_prefix_argument(value):
+    """ pullreverse --prefix の値を検証する argparse の type です。
+    IPv4は /8, /16, /24、IPv6は4の倍数のプレフィックス長のみ受け付けます。
+    """
+    try:
+        reversezone.reverse_zone_origin(ipaddress.ip_network(value, strict=False))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('Invalid reverse zone prefix "{}". {}'.format(value, e))
+    return value
+
+
 class SingleZoneAction(argparse.Action):
     """ 単一のzone引数を受け取る argparse.Action です。
     zoneは、"namespace/origin" の形式で表現されます。
@@ -98,7 +149,11 @@ class Bind9ZoneCLI(object):
             code = 1
         else:
             handler = self.handler
-            code = handler(**self.args)
+            try:
+                code = handler(**self.args)
+            finally:
+                # Engine(接続プール)はプロセス内で共有し、Sessionだけを閉じます。
+                database.remove_sessions()
         return code
 
     @classmethod
@@ -115,9 +170,17 @@ class Bind9ZoneCLI(object):
                                help="Database connection string")
         subparser.add_argument('--drop', action='store_true')
 
+        # Options for upgrade command
+        subparser = subparsers.add_parser('upgrade', help='see `upgrade -h`')
+        subparser.set_defaults(handler=cls.upgrade)
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+
         # Options for get command
         subparser = subparsers.add_parser('get', help='see `get -h`')
         subparser.set_defaults(handler=cls.getrecord)
+        cls.add_read_connection_arguments(subparser)
         subparser.add_argument('-c', '--connection', action='store',
                                default=os.getenv('DB_CONNECT'),
                                help="Database connection string")
@@ -128,6 +191,9 @@ class Bind9ZoneCLI(object):
         subparser.add_argument('rtype', nargs='?', default=None, action='store',
                                choices=RRTYPE_LIST,
                                help="Resource type, like A, AAAA, TXT, etc.")
+        subparser.add_argument('--query-cache', action='store_true', default=zutils.env_flag('QUERY_CACHE'),
+                               help='Use the in-process query cache shared by Bind9ZoneCLI calls in the same process. '
+                               'Cached records are validated by the zone generation.')
 
         # Options for set command
         subparser = subparsers.add_parser('set', help='see `set -h`')
@@ -159,6 +225,24 @@ class Bind9ZoneCLI(object):
                                choices=RRTYPE_LIST,
                                help="Resource type, like A, AAAA, TXT, etc.")
 
+        # Options for search command
+        subparser = subparsers.add_parser('search', help='see `search -h`')
+        subparser.set_defaults(handler=cls.search)
+        cls.add_read_connection_arguments(subparser)
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+        subparser.add_argument('-n', '--namespace', action='store', default=None,
+                               help='Namespace to search. All namespaces are searched if not specified.')
+        group = subparser.add_mutually_exclusive_group(required=True)
+        group.add_argument('--address', action='store', type=address_argument,
+                           help='IPv4/IPv6 address or CIDR range of A/AAAA records, like 192.0.2.0/24')
+        group.add_argument('--target', action='store',
+                           help='Target name (FQDN) of CNAME/NS/PTR/MX/SRV records')
+        subparser.add_argument('--type', dest='rtype', action='store', default=None,
+                               choices=RRTYPE_LIST,
+                               help="Resource type to search with --target, like CNAME, MX, etc.")
+
         # Options for pullzone command
         subparser = subparsers.add_parser('pullzone', help='see `pullzone -h`')
         subparser.add_argument('-c', '--connection', action='store',
@@ -166,11 +250,15 @@ class Bind9ZoneCLI(object):
                                help="Database connection string for pull")
         subparser.add_argument('-z', '--zone', action=SingleZoneAction,
                                help='A Zone name to access, in namespace/origin format')
-        subparser.add_argument('-d', '--dir', action='store', default=os.getenv('ZONEDIR'),
-                               help="Directory for zone files")
+        cls.add_pull_dir_arguments(subparser)
         subparser.add_argument('--mkdir', action='store_true',
                                help='Make output namespace directories if not exists')
+        cls.add_output_arguments(subparser)
+        subparser.add_argument('--as-of', action='store', type=parse_as_of, default=None,
+                               help='Output the zone as it was at this point, rebuilt from snapshots and the journal. '
+                                    'A SOA serial (digits only) or an ISO 8601 timestamp like 2024-01-01T09:00:00.')
         subparser.set_defaults(handler=cls.pullzone)
+        cls.add_read_connection_arguments(subparser)
 
         # Options for pushzone command
         subparser = subparsers.add_parser('pushzone', help='see `pushzone -h`')
@@ -181,8 +269,33 @@ class Bind9ZoneCLI(object):
                                help='A Zone name to access, in namespace/origin format')
         subparser.add_argument('-d', '--dir', action='store', default=os.getenv('ZONEDIR'),
                                help="Directory for zone files")
+        subparser.add_argument('file', nargs='?', default=None,
+                               help='Zone file to push ("-" for stdin). gzip/bzip2/xz/zstd compressed files are also accepted.')
+        cls.add_tolerant_arguments(subparser)
+        cls.add_lock_arguments(subparser)
         subparser.set_defaults(handler=cls.pushzone)
 
+        # Options for pullreverse command
+        subparser = subparsers.add_parser('pullreverse', help='see `pullreverse -h`')
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string for pull")
+        subparser.add_argument('-n', '--namespaces', action='store', required=True,
+                               help='Comma separated namespace list')
+        subparser.add_argument('-p', '--prefix', dest='prefixes', action='append', required=True,
+                               type=reverse_prefix_argument,
+                               help='Prefix of reverse zone, like 192.0.2.0/24 or 2001:db8::/48. Can be specified multiple times.')
+        subparser.add_argument('-d', '--dir', action='store', default=os.getenv('ZONEDIR'),
+                               help="Directory for zone files")
+        subparser.add_argument('--mkdir', action='store_true',
+                               help='Make output namespace directories if not exists')
+        subparser.add_argument('--nameserver', action='store', required=True,
+                               help='Authority name server of reverse zones.')
+        subparser.add_argument('--email', action='store', required=True,
+                               help='An administrator contact email')
+        subparser.set_defaults(handler=cls.pullreverse)
+        cls.add_read_connection_arguments(subparser)
+
         # Options for initzone command
         subparser = subparsers.add_parser('initzone', help='see `initzone -h`')
         subparser.add_argument('-c', '--connection', action='store',
@@ -203,6 +316,7 @@ class Bind9ZoneCLI(object):
                                help="Database connection string for delete")
         subparser.add_argument('-z', '--zones', action=MultiZonesAction,
                                help='Comma separated namespace/zone list')
+        cls.add_lock_arguments(subparser)
         subparser.set_defaults(handler=cls.deletezone)
 
         # Options for bulkpull command
@@ -213,11 +327,67 @@ class Bind9ZoneCLI(object):
         subparser.add_argument('-z', '--zones', action=MultiZonesAction,
                                default=os.getenv('ZONES'),
                                help='Comma separated namespace/zone list')
-        subparser.add_argument('-d', '--dir', action='store', default=os.getenv('ZONEDIR'),
-                               help="Directory for zone files")
+        cls.add_pull_dir_arguments(subparser)
         subparser.add_argument('--mkdir', action='store_true',
                                help='Make output namespace directories if not exists')
+        cls.add_output_arguments(subparser)
         subparser.set_defaults(handler=cls.bulkpull)
+        cls.add_read_connection_arguments(subparser)
+
+        # Options for bulkserial command
+        subparser = subparsers.add_parser('bulkserial', help='see `bulkserial -h`')
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+        subparser.add_argument('-z', '--zones', action=MultiZonesAction,
+                               default=os.getenv('ZONES'),
+                               help='Comma separated namespace/zone list. All zones are updated if not specified.')
+        subparser.add_argument('--force', action='store_true',
+                               help='Update serials of all zones, even if no records are modified.')
+        subparser.add_argument('--date', dest='date_serial', action='store_true',
+                               help='Use date based serial (YYYYMMDDnn) instead of incrementing it.')
+        subparser.set_defaults(handler=cls.bulkserial)
+
+        # Options for journal command
+        subparser = subparsers.add_parser('journal', help='see `journal -h`')
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+        subparser.add_argument('-z', '--zone', action=SingleZoneAction,
+                               help='A Zone name to access, in namespace/origin format')
+        subparser.add_argument('--since', dest='serial', action='store', type=int, default=0,
+                               help='Output changes made at this SOA serial or later, grouped by serial (IXFR-like).')
+        subparser.set_defaults(handler=cls.journal)
+        cls.add_read_connection_arguments(subparser)
+
+        # Options for compactjournal command
+        subparser = subparsers.add_parser('compactjournal', help='see `compactjournal -h`')
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+        subparser.add_argument('-z', '--zones', action=MultiZonesAction,
+                               default=os.getenv('ZONES'),
+                               help='Comma separated namespace/zone list. Journals of all zones are compacted if not specified.')
+        group = subparser.add_argument_group('compaction conditions (at least one is required)')
+        group.add_argument('--before-serial', dest='serial', action='store', type=int, default=None,
+                           help='Delete changes made at SOA serials older than this.')
+        group.add_argument('--max-age', action='store', type=int, default=None,
+                           help='Delete changes recorded more than this number of seconds ago.')
+        subparser.set_defaults(handler=cls.compactjournal)
+
+        # Options for snapshot command
+        subparser = subparsers.add_parser('snapshot', help='see `snapshot -h`')
+        subparser.add_argument('-c', '--connection', action='store',
+                               default=os.getenv('DB_CONNECT'),
+                               help="Database connection string")
+        subparser.add_argument('-z', '--zones', action=MultiZonesAction,
+                               default=os.getenv('ZONES'),
+                               help='Comma separated namespace/zone list. All zones are checked if not specified.')
+        subparser.add_argument('--interval', action='store', type=int,
+                               default=int(os.getenv('JOURNAL_SNAPSHOT_INTERVAL', SNAPSHOT_INTERVAL)),
+                               help='Save snapshots of zones with at least this number of journal entries '
+                                    'since the last snapshot.')
+        subparser.set_defaults(handler=cls.snapshot)
 
         # Options for bulkpush command
         subparser = subparsers.add_parser('bulkpush', help='see `bulkpush -h`')
@@ -229,48 +399,123 @@ class Bind9ZoneCLI(object):
                                help='Comma separated namespace/zone list')
         subparser.add_argument('-d', '--dir', action='store', default=os.getenv('ZONEDIR'),
                                help="Directory for zone files")
+        subparser.add_argument('--cache-dir', action='store', default=os.getenv('ZONECACHE_DIR'),
+                               help="Directory for parsed zone cache. Unchanged zone files are not parsed again.")
+        subparser.add_argument('--cache-size', action='store', type=int,
+                               default=int(os.getenv('ZONECACHE_SIZE', 64 * 1024 * 1024)),
+                               help="Maximum total bytes of parsed zone cache")
+        subparser.add_argument('--bulk-load', action='store_true',
+                               help="Push all zones in one transaction with relaxed durability (synchronous=OFF).")
+        cls.add_tolerant_arguments(subparser)
+        cls.add_lock_arguments(subparser)
         subparser.set_defaults(handler=cls.bulkpush)
 
         return parser
 
+    @staticmethod
+    def add_pull_dir_arguments(subparser):
+        subparser.add_argument('-d', '--dir', action=MultiDirsAction, default=split_dirs(os.getenv('ZONEDIR')),
+                               help="Directory for zone files. Can be specified multiple times (or separated by "
+                                    "'{}') to write the same zones to every directory.".format(os.pathsep))
+        subparser.add_argument('--dir-map', action='store', default=os.getenv('ZONEDIR_MAP'),
+                               help='File mapping namespaces to output directories. '
+                                    'Each line is "<namespace|*> <directory>".')
+
+    @staticmethod
+    def add_output_arguments(subparser):
+        subparser.add_argument('--format', dest='output_format', action='store', default='text',
+                               choices=['text', 'raw'],
+                               help='Output format. "raw" writes BIND9 masterfile-format raw to {origin}.zone.raw')
+        subparser.add_argument('--compact', action='store_true',
+                               help='Compact output. Use the most common TTL as $TTL, omit inferable TTLs and repeated owner names.')
+        subparser.add_argument('--no-meta', dest='with_meta', action='store_false',
+                               help='Do not output "; meta=(id=N)" comments')
+        subparser.add_argument('--render-cache', action='store_true',
+                               default=zutils.env_flag('RENDER_CACHE'),
+                               help='Store rendered zones in the database and reuse them until the zone is modified')
+
+    @staticmethod
+    def add_read_connection_arguments(subparser):
+        subparser.add_argument('--read-connection', action='store',
+                               default=os.getenv('DB_CONNECT_READ'),
+                               help='Comma separated database connection strings of read replicas. '
+                               'Replicas are used in turn, and --connection is used if all of them are unavailable.')
+
+    @staticmethod
+    def add_tolerant_arguments(subparser):
+        subparser.add_argument('--max-errors', action='store', type=int, default=None,
+                               help='Tolerant mode. Skip unparseable lines and exit with code 4 only if errors exceed this number.')
+        subparser.add_argument('--error-report', action='store', default=None,
+                               help='Write skipped lines as JSON to this file ("-" for stdout). '
+                               'Without --max-errors, runs in tolerant mode with no error limit.')
+
+    @staticmethod
+    def add_lock_arguments(subparser):
+        lock_timeout = os.getenv('ZONE_LOCK_TIMEOUT')
+        subparser.add_argument('--lock-timeout', action='store', type=float,
+                               default=float(lock_timeout) if lock_timeout else None,
+                               help='Seconds to wait for other processes pushing/deleting the same zone. '
+                                    'Wait without limit if not specified.')
+
     @staticmethod
     def init(connection, drop):
-        engine = create_engine(connection)
+        engine = database.get_engine(connection)
         if engine.dialect.has_table(engine, ZoneRecord.__tablename__):
             if drop:
-                ZoneRecord.__table__.drop(engine)
-                zutils.log_message('Table {} dropped.', [
-                                   ZoneRecord.__tablename__])
+                for table in reversed(Base.metadata.sorted_tables):
+                    if engine.dialect.has_table(engine, table.name):
+                        table.drop(engine)
+                        zutils.log_message('Table {} dropped.', [table.name])
             else:
-                zutils.log_error('Table {} already exists. To drop this table, use "--drop" option',
-                                 [ZoneRecord.__tablename__])
+                zutils.log_error('Table {} already exists. To upgrade the tables, use "upgrade" command. '
+                                 'To drop this table, use "--drop" option', [ZoneRecord.__tablename__])
                 return 3
-        ZoneRecord.metadata.create_all(
-            bind=engine, tables=[ZoneRecord.__table__], checkfirst=False)
-        zutils.log_message('Table {} created.', [ZoneRecord.__tablename__])
+        for table in Base.metadata.sorted_tables:
+            if not engine.dialect.has_table(engine, table.name):
+                table.create(engine)
+                zutils.log_message('Table {} created.', [table.name])
+        return 0
+
+    @staticmethod
+    def upgrade(connection):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        engine = database.get_engine(connection)
+        for kind, name in database.upgrade_tables(engine, Base.metadata.sorted_tables):
+            zutils.log_message('Upgrade: {} {} added.', [kind.capitalize(), name])
+        session = database.get_session(connection)
+        count = query.fill_record_columns(session)
+        zutils.log_message('Upgrade: Records filled. records={}', [count])
         return 0
 
     @staticmethod
-    def getrecord(connection, zone, name, rtype):
+    def getrecord(connection, zone, name, rtype, read_connection=None, query_cache=False):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
+        session = database.get_read_session(connection, read_connection)
+        database.begin_readonly(session)
 
-        records = query.get_records(
-            session, origin=origin, namespace=namespace, name=name, type=rtype)
+        if query_cache:
+            # キャッシュのレコード(CachedRecord)は、zoneのoriginからの相対名の行を保持しています。
+            records = querycache.get_shared_cache().get_records(
+                session, origin=origin, namespace=namespace, name=name, type=rtype)
+            lines = [r.text for r in records]
+        else:
+            records = query.get_records(
+                session, origin=origin, namespace=namespace, name=name, type=rtype)
+            lines = [r.to_record(origin=origin) for r in records]
         if records is None or len(records) == 0:
             zutils.log_message('getrecord: No records founded. zone={} namespace={}, name={}, rtype={}', [
                                origin, namespace, name, rtype])
             return 2
         else:
-            zutils.output('\n'.join([r.to_record(origin=origin) for r in records]))
+            zutils.output('\n'.join(lines))
             return 0
 
     @staticmethod
@@ -281,13 +526,14 @@ class Bind9ZoneCLI(object):
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
+        session = database.get_session(connection)
 
-        added, deleted = query.set_records(session, origin=origin, namespace=namespace,
-                                           name=name, type=rtype, data=values, ttl=60)
+        try:
+            added, deleted = query.set_records(session, origin=origin, namespace=namespace,
+                                               name=name, type=rtype, data=values, ttl=60)
+        except query.ConcurrentUpdateError as e:
+            zutils.log_error('setrecord: {} zone={} namespace={}, name={}', [e, origin, namespace, name])
+            return 1
         if deleted:
             zutils.log_message('\n'.join(
                 [' * DEL : ' + ZoneRecord(r).to_record(origin=origin) for r in deleted]))
@@ -304,11 +550,12 @@ class Bind9ZoneCLI(object):
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        deleted = query.delete_records(session, origin=origin, namespace=namespace, name=name, type=rtype)
+        session = database.get_session(connection)
+        try:
+            deleted = query.delete_records(session, origin=origin, namespace=namespace, name=name, type=rtype)
+        except query.ConcurrentUpdateError as e:
+            zutils.log_error('deleterecord: {} zone={} namespace={}, name={}', [e, origin, namespace, name])
+            return 1
         if deleted:
             zutils.log_message('\n'.join(
                 [' * DEL : ' + ZoneRecord(r).to_record(origin=origin) for r in deleted]))
@@ -322,10 +569,7 @@ class Bind9ZoneCLI(object):
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
+        session = database.get_session(connection)
         records = query.get_records(session, origin=origin, namespace=namespace, type='SOA', name='@')
         if records:
             zutils.log_error('SOA record of {}/{} is already exists.'.format(namespace, origin))
@@ -341,19 +585,44 @@ class Bind9ZoneCLI(object):
         return 0
 
     @staticmethod
-    def deletezone(connection, zones):
+    def search(connection, namespace, address, target, rtype, read_connection=None):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        session = database.get_read_session(connection, read_connection)
+        database.begin_readonly(session)
+
+        if address is not None:
+            records = query.find_by_address(session, address, namespace=namespace)
+        else:
+            records = query.find_by_target(session, target, namespace=namespace, type=rtype)
+        if not records:
+            zutils.log_message('search: No records founded. namespace={}, address={}, target={}', [
+                               namespace, address, target])
+            return 2
+        zutils.output('\n'.join(['{}/{} {}'.format(r.namespace, r.origin, r.to_record()) for r in records]))
+        return 0
+
+    @staticmethod
+    def deletezone(connection, zones, lock_timeout=None):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
             return 1
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
+        session = database.get_session(connection)
+        lock_stats = database.lock_stats()
+        code = 0
         for zone in zones:
             origin = zone['origin']
             namespace = zone['namespace']
-            items = query.delete_records(session, origin=origin, namespace=namespace)
+            try:
+                with database.zone_locks(session, [(namespace, origin)], timeout=lock_timeout):
+                    items = query.delete_records(session, origin=origin, namespace=namespace)
+            except database.LockTimeoutError as e:
+                zutils.log_error('DeleteZone: {} zone={} namespace={}', [e, origin, namespace])
+                code = 1
+                continue
             count = len(items)
             if count == 0:
                 zutils.log_message('DeleteZone: No records founded. zone={} namespace={}', [
@@ -361,59 +630,185 @@ class Bind9ZoneCLI(object):
             else:
                 zutils.log_message('DeleteZone: completed. zone={} namespace={}, records={}', [
                     origin, namespace, count])
-        return 0
+        _log_lock_stats('DeleteZone', lock_stats)
+        return code
 
     @staticmethod
-    def pullzone(connection, zone, dir, mkdir):
+    def pullzone(connection, zone, dir, mkdir, compact=False, with_meta=True, output_format='text',
+                 render_cache=False, dir_map=None, read_connection=None, as_of=None):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        return _pullzone(session, dir, origin, namespace, mkdir)
+        targets = _zone_targets(namespace, dir, _read_dir_map(dir_map))
+        if dir_map is not None and not targets:
+            # --dir-map を指定した場合は、該当するディレクトリがないzoneを標準出力には出力しません。
+            zutils.log_error('Pullzone: No output directory for namespace. zone={} namespace={}',
+                             [origin, namespace])
+            return 1
+        if as_of is not None:
+            # 過去の時点のzoneは変更履歴から再構成します。レコードのidは無く、キャッシュも使用しません。
+            with_meta = False
+            render_cache = False
+        if render_cache:
+            # キャッシュを書き込むため、プライマリを使用します。
+            session = database.get_session(connection)
+        else:
+            # 読み込みのみの場合は、レプリカからzoneの全レコードを同じスナップショットで出力します。
+            session = database.get_read_session(connection, read_connection)
+            database.begin_readonly(session)
+        try:
+            return _pullzone(session, targets or None, origin, namespace, mkdir, compact=compact, with_meta=with_meta,
+                             output_format=output_format, render_cache=render_cache, as_of=as_of)
+        except ValueError as e:
+            if as_of is None:
+                raise
+            zutils.log_error('Pullzone: {} zone={} namespace={}', [e, origin, namespace])
+            return 1
+
+    @staticmethod
+    def pullreverse(connection, namespaces, prefixes, dir, mkdir, nameserver, email, read_connection=None):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        if dir is None:
+            zutils.log_error(
+                'Zonefile directory required, but not specified. Use ZONEDIR environment or --dir option.')
+            return 1
+        try:
+            index = reversezone.ReverseZoneIndex(prefixes)
+        except ValueError as e:
+            # 重複するプレフィックスは、個々の引数ではなく組み合わせで判定します。
+            zutils.log_error('Pullreverse: {}', [e])
+            return 1
+        session = database.get_read_session(connection, read_connection)
+        database.begin_readonly(session)
+        results = [_pullreverse(session, dir, namespace, index, mkdir, nameserver, email)
+                   for namespace in namespaces.split(',')]
+        return max(results)
 
     @staticmethod
-    def pushzone(connection, zone, dir):
+    def pushzone(connection, zone, dir, file=None, max_errors=None, error_report=None, lock_timeout=None):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
             return 1
-        if dir is None and sys.stdin.isatty():
+        if file is None and dir is None and sys.stdin.isatty():
             zutils.log_error(
                 'One of "zonefile directory" or "pipe zonefile into stdin" required, but not specified. Use ZONEDIR environment or --dir option, otherwise input a zonefile from stdin.')
             return 1
         origin = zone['origin']
         namespace = zone['namespace']
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        return _pushzone(Session, dir, origin, namespace)
+        session = database.get_session(connection)
+        errors = [] if max_errors is not None or error_report is not None else None
+        lock_stats = database.lock_stats()
+        code = _pushzone_locked(session, dir, origin, namespace, lock_timeout, path=file, errors=errors)
+        _log_lock_stats('Pushzone', lock_stats)
+        return _report_errors(code, errors, max_errors, error_report)
 
     @staticmethod
-    def bulkpull(connection, zones, dir, mkdir):
+    def bulkpull(connection, zones, dir, mkdir, compact=False, with_meta=True, output_format='text',
+                 render_cache=False, dir_map=None, read_connection=None):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
             return 1
-        if dir is None:
+        if dir is None and dir_map is None:
             zutils.log_error(
                 'Zonefile directory required, but not specified. Use ZONEDIR environment or --dir option.')
             return 1
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        results = [_pullzone(session, dir, zone['origin'],
-                             zone['namespace'], mkdir) for zone in zones]
+        if render_cache:
+            # キャッシュを書き込むため、プライマリを使用します。
+            session = database.get_session(connection)
+        else:
+            # 読み込みのみの場合は、レプリカからすべてのzoneを同じスナップショットで出力します。
+            session = database.get_read_session(connection, read_connection)
+            database.begin_readonly(session)
+        mapping = _read_dir_map(dir_map)
+        results = []
+        for zone in zones:
+            targets = _zone_targets(zone['namespace'], dir, mapping)
+            if not targets:
+                zutils.log_error('Bulkpull: No output directory for namespace. zone={} namespace={}',
+                                 [zone['origin'], zone['namespace']])
+                results.append(1)
+                continue
+            results.append(_pullzone(session, targets, zone['origin'], zone['namespace'], mkdir,
+                                     compact=compact, with_meta=with_meta, output_format=output_format,
+                                     render_cache=render_cache))
         return max(results)
 
     @staticmethod
-    def bulkpush(connection, zones, dir):
+    def bulkserial(connection, zones, force=False, date_serial=False):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        session = database.get_session(connection)
+        if zones is not None:
+            zones = [(z['namespace'], z['origin']) for z in zones]
+        updated = query.update_serials(session, zones, force=force, date_serial=date_serial)
+        for namespace, origin, serial in updated:
+            zutils.log_message('Bulkserial: updated. zone={} namespace={} serial={}', [origin, namespace, serial])
+        zutils.log_message('Bulkserial: completed. zones={}', [len(updated)])
+        return 0
+
+    @staticmethod
+    def journal(connection, zone, serial=0, read_connection=None):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        origin = zone['origin']
+        namespace = zone['namespace']
+        session = database.get_read_session(connection, read_connection)
+        database.begin_readonly(session)
+        changes = query.get_journal_changes(session, namespace=namespace, origin=origin, serial=serial)
+        if not changes:
+            zutils.log_message('journal: No changes founded. zone={} namespace={}, since={}', [
+                               origin, namespace, serial])
+            return 2
+        zutils.output(format_changes(changes))
+        return 0
+
+    @staticmethod
+    def compactjournal(connection, zones, serial=None, max_age=None):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        if serial is None and max_age is None:
+            zutils.log_error('Compactjournal: --before-serial or --max-age required.')
+            return 1
+        session = database.get_session(connection)
+        if zones is not None:
+            zones = [(z['namespace'], z['origin']) for z in zones]
+        before = datetime.now() - timedelta(seconds=max_age) if max_age is not None else None
+        count = query.compact_journal(session, zones, serial=serial, before=before)
+        zutils.log_message('Compactjournal: completed. entries={}', [count])
+        return 0
+
+    @staticmethod
+    def snapshot(connection, zones, interval=SNAPSHOT_INTERVAL):
+        if connection is None:
+            zutils.log_error(
+                'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
+            return 1
+        session = database.get_session(connection)
+        if zones is not None:
+            zones = [(z['namespace'], z['origin']) for z in zones]
+        saved = query.take_snapshots(session, zones, interval=interval)
+        for namespace, origin, journal_id in saved:
+            zutils.log_message('Snapshot: saved. zone={} namespace={} journal_id={}', [origin, namespace, journal_id])
+        zutils.log_message('Snapshot: completed. zones={}', [len(saved)])
+        return 0
+
+    @staticmethod
+    def bulkpush(connection, zones, dir, cache_dir=None, cache_size=None, max_errors=None, error_report=None,
+                 bulk_load=False, lock_timeout=None):
         if connection is None:
             zutils.log_error(
                 'Database connection string required but not specified. Use DB_CONNECT environment or --connection option.')
@@ -422,72 +817,358 @@ class Bind9ZoneCLI(object):
             zutils.log_error(
                 'Zonefile directory required, but not specified. Use ZONEDIR environment or --dir option.')
             return 1
-        engine = create_engine(connection)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        results = [_pushzone(session, dir, z['origin'], z['namespace'])
-                   for z in zones]
-        return max(results)
+        cache = ParseCache(cache_dir, max_bytes=cache_size) if cache_dir else None
+        errors = [] if max_errors is not None or error_report is not None else None
+        lock_stats = database.lock_stats()
+        if bulk_load:
+            # すべてのzoneを1つのトランザクションで登録します。zoneのロックは最初にまとめて取得します。
+            try:
+                with database.bulk_load_scope(connection) as session:
+                    with database.zone_locks(session, [(z['namespace'], z['origin']) for z in zones],
+                                             timeout=lock_timeout):
+                        results = [_pushzone(session, dir, z['origin'], z['namespace'], cache=cache, errors=errors,
+                                             commit=False)
+                                   for z in zones]
+                        # ロックを解放する前にコミットします。
+                        session.commit()
+            except database.LockTimeoutError as e:
+                zutils.log_error('Bulkpush: {}', [e])
+                return 1
+        else:
+            session = database.get_session(connection)
+            results = [_pushzone_locked(session, dir, z['origin'], z['namespace'], lock_timeout,
+                                        cache=cache, errors=errors)
+                       for z in zones]
+        _log_lock_stats('Bulkpush', lock_stats)
+        return _report_errors(max(results), errors, max_errors, error_report)
 
 #  ---- functions ----
 
 
-def _pullzone(session, target, origin, namespace, mkdir):
-    records = query.get_records(session, origin=origin, namespace=namespace)
-    if mkdir and target and not os.path.isdir(os.path.join(target, namespace)):
+def _pullzone(session, target, origin, namespace, mkdir, compact=False, with_meta=True, output_format='text',
+              render_cache=False, as_of=None):
+    """ zoneをDBから取得してzoneファイルを出力します。
+    target には出力先ディレクトリ(またはそのlist)を指定します。Noneの場合は標準出力です。
+    複数のディレクトリを指定した場合も、DBからの取得と出力の生成は1度だけ行われます。
+    as_of(日時またはシリアル)を指定した場合は、その時点のzoneを変更履歴から再構成して出力します。
+    """
+    targets = target if isinstance(target, (list, tuple)) else [target]
+    for t in targets:
+        if mkdir and t and not os.path.isdir(os.path.join(t, namespace)):
+            os.mkdir(os.path.join(t, namespace))
+    try:
+        if render_cache:
+            return _pullzone_cached(session, target, origin, namespace, compact, with_meta, output_format)
+
+        counter = itertools.count(1)
+        chunks = _render_zone(session, origin, namespace, compact, with_meta, output_format, counter, as_of=as_of)
+        if chunks is None:
+            zutils.log_message('Pullzone: No records founded. zone={} namespace={}', [
+                origin, namespace])
+            return 2
+        else:
+            _write_zone(chunks, target=target, origin=origin, namespace=namespace,
+                        binary=(output_format == 'raw'))
+            zutils.log_message('Pullzone: completed. zone={} namespace={}, records={}', [
+                origin, namespace, next(counter) - 1])
+            return 0
+    except RawFormatError as e:
+        # 出力先のファイルは一時ファイルに書き出してから置き換えるため、既存のファイルはそのまま残ります。
+        zutils.log_error('Pullzone: {} zone={} namespace={}', [e, origin, namespace])
+        return 1
+
+
+def _pullreverse(session, target, namespace, index, mkdir, nameserver, email):
+    """ namespaceのA/AAAAレコードを1回のクエリで取得し、index の逆引きzoneをすべて生成します。
+    内容が前回の生成時から変わっていないzoneは書き換えません。
+    A/AAAAレコードがない場合は2、zoneファイルを書き出せなかった場合は1を返します。
+    """
+    if mkdir and not os.path.isdir(os.path.join(target, namespace)):
         os.mkdir(os.path.join(target, namespace))
+    counter = itertools.count()
+    records = (r for r, _ in zip(query.iter_address_records(session, namespace), counter))
+    zones = reversezone.build_reverse_zones(records, index)
+    if next(counter) == 0:
+        zutils.log_message('Pullreverse: No records founded. namespace={}', [namespace])
+        return 2
+    code = 0
+    for origin, entries in zones.items():
+        zone = origin.rstrip('.')
+        digest = reversezone.reverse_zone_digest(origin, entries, nameserver, email)
+        old_digest, old_serial = reversezone.read_reverse_zone_header(_zone_path(target, zone, namespace))
+        if digest == old_digest:
+            zutils.log_message('Pullreverse: Zone not changed, skipped. zone={} namespace={}', [zone, namespace])
+            continue
+        serial = reversezone.next_serial(old_serial)
+        lines = reversezone.render_reverse_zone(origin, entries, nameserver, email, serial, digest)
+        try:
+            _write_zone(((line + '\n').encode('utf-8') for line in lines),
+                        target=target, origin=zone, namespace=namespace)
+        except OSError as e:
+            zutils.log_error('Pullreverse: Failed to write zone. zone={} namespace={} error={}', [zone, namespace, e])
+            code = 1
+            continue
+        zutils.log_message('Pullreverse: completed. zone={} namespace={}, records={}, serial={}', [
+            zone, namespace, len(entries), serial])
+    return code
+
 
-    if records is None or len(records) == 0:
+def _pullzone_cached(session, target, origin, namespace, compact, with_meta, output_format):
+    """ DB上の出力済みzoneのキャッシュ(bind9zone_rendered_zones)を使用してzoneファイルを書き出します。
+    キャッシュが有効な場合はレコードを読み込まず、圧縮データを展開しながら書き出します。
+    """
+    variant = output_format
+    if output_format == 'text':
+        variant += ('-compact' if compact else '') + ('' if with_meta else '-nometa')
+    binary = output_format == 'raw'
+    compressed = query.get_rendered_zone(session, namespace=namespace, origin=origin, variant=variant)
+    if compressed is not None:
+        _write_zone(iter_zone_chunks(compressed), target=target, origin=origin, namespace=namespace,
+                    binary=binary)
+        zutils.log_message('Pullzone: completed from render cache. zone={} namespace={}', [
+            origin, namespace])
+        return 0
+
+    # 世代番号はレコードを読み込む前に取得します。出力中に更新された場合、キャッシュは保存されません。
+    generation = query.get_generation(session, namespace=namespace, origin=origin)
+    counter = itertools.count(1)
+    chunks = _render_zone(session, origin, namespace, compact, with_meta, output_format, counter)
+    if chunks is None:
         zutils.log_message('Pullzone: No records founded. zone={} namespace={}', [
             origin, namespace])
         return 2
+    content = b''.join(chunks)
+    compressed, digest = compress_zone(content)
+    query.put_rendered_zone(session, namespace=namespace, origin=origin, variant=variant,
+                            generation=generation, content=compressed, digest=digest)
+    _write_zone([content], target=target, origin=origin, namespace=namespace, binary=binary)
+    zutils.log_message('Pullzone: completed. zone={} namespace={}, records={}', [
+        origin, namespace, next(counter) - 1])
+    return 0
+
+
+def _render_zone(session, origin, namespace, compact, with_meta, output_format, counter, as_of=None):
+    """ DBのレコードからzoneファイルを生成し、bytesのiteratorを返します。レコードがない場合はNoneを返します。
+    counter は出力したレコード数だけ進みます。
+    """
+    default_ttl = None
+    if as_of is not None:
+        # 変更履歴から再構成したレコード(正規順序でソート済み)を出力します。$TTLは iter_zonefile が求めます。
+        records = iter(query.get_records_as_of(session, namespace=namespace, origin=origin, as_of=as_of))
     else:
-        zonedata = ZoneFile.to_zonefile(records)
-        _write_zone(zonedata, target=target,
-                    origin=origin, namespace=namespace)
-        zutils.log_message('Pullzone: completed. zone={} namespace={}, records={}', [
-            origin, namespace, len(records)])
-        return 0
+        if compact and output_format == 'text':
+            # $TTLはDB側で集計したTTLの分布から決めるため、レコードを読み込み直す必要はありません。
+            default_ttl = zutils.most_common_ttl(
+                query.get_ttl_histogram(session, namespace=namespace, origin=origin))
+        # DB側で正規順序にソート済みのレコードを逐次取得し、1行ずつ書き出します。
+        records = iter(query.iter_records(session, origin=origin, namespace=namespace))
+    first = next(records, None)
+    if first is None:
+        return None
+    records = (r for r, _ in zip(itertools.chain([first], records), counter))
+    if output_format == 'raw':
+        return iter_raw_zone(records)
+    lines = ZoneFile.iter_zonefile(records, sort=False, compact=compact,
+                                   with_meta=with_meta, default_ttl=default_ttl)
+    return ((line + '\n').encode('utf-8') for line in lines)
+
+
+def _pushzone_locked(session, target, origin, namespace, lock_timeout=None, **kwargs):
+    """ zoneのロックを取得してから _pushzone を実行します。同じzoneへのpushは1つずつ実行されます。
+    lock_timeout 秒以内にロックを取得できない場合は、登録せずに1を返します。
+    """
+    try:
+        with database.zone_locks(session, [(namespace, origin)], timeout=lock_timeout):
+            code = _pushzone(session, target, origin, namespace, **kwargs)
+            # 登録を省略した場合も、ロックを解放する前にトランザクションを終了します。
+            session.commit()
+            return code
+    except database.LockTimeoutError as e:
+        zutils.log_error('Pushzone: {} zone={} namespace={}', [e, origin, namespace])
+        return 1
+
+
+def _log_lock_stats(command, before):
+    # database.lock_stats はプロセス内の累計のため、コマンドの実行前(before)との差を出力します。
+    stats = database.lock_stats()
+    zutils.log_message('{}: zone locks acquired={} timeouts={} wait={:.3f}s', [
+        command, stats['acquired'] - before['acquired'], stats['timeouts'] - before['timeouts'],
+        stats['wait_total'] - before['wait_total']])
+
+
+def _pushzone(session, target, origin, namespace, cache=None, path=None, errors=None, commit=True):
+    """ zoneファイルを読み込んでDBに登録します。
+    errors にlistを指定すると寛容モードになり、解釈できない行やファイルの読み込みエラーは
+    例外にせず errors に追加されます。解釈できた行はそのまま登録されます。
+    """
+    if path is None and target is not None and target != '-':
+        path = find_zone_file(target, origin=origin, namespace=namespace)
+    if path == '-':
+        path = None
+    if errors is None:
+        return _pushzone_file(session, path, origin, namespace, cache=cache, commit=commit)
+    missed = []
+    try:
+        return _pushzone_file(session, path, origin, namespace, cache=cache, errors=missed, commit=commit)
+    except OSError as e:
+        missed.append({'line': None, 'text': None, 'reason': str(e)})
+        return 2
+    finally:
+        error_base = {'file': path if path is not None else '-', 'namespace': namespace, 'origin': origin}
+        errors.extend([{**error_base, **m} for m in missed])
+
+
+def _pushzone_file(session, path, origin, namespace, cache=None, errors=None, commit=True):
+    parsed = None
+    if cache is not None and path is not None:
+        parsed = cache.get(path, origin)
+    if parsed is not None:
+        # キャッシュが有効(=ファイル未変更)で、DB上のレコードとも一致する場合はpushを省略します。
+        origins = set([r['origin'] for r in parsed])
+        if parsed and query.get_zone_digest(session, namespace, origins) == zutils.records_digest(parsed):
+            zutils.log_message('Pushzone: Zone not changed, skipped. zone={} namespace={}', [
+                origin, namespace])
+            return 0
+        return _insert_zone(session, parsed, origin, namespace, commit=commit)
+
+    if cache is not None and path is not None:
+        # キャッシュには、実際にパースしたバイト列のサイズ/ダイジェストを保存します。
+        with DigestReader(path) as source, open_zone_reader(source) as reader:
+            records = list(ZoneFile.from_stream(reader=reader, origin=origin, missed_lines=errors))
+            identity = source.identity()
+        if not errors and identity is not None:
+            cache.put(path, origin, records, identity)
+        return _insert_zone(session, records, origin, namespace, errors=errors, commit=commit)
+
+    with open_zone_reader(path if path is not None else sys.stdin.buffer) as reader:
+        records = ZoneFile.from_stream(reader=reader, origin=origin, missed_lines=errors)
+        # recordsがgeneratorの場合は、パースしながらバッチ単位でINSERTされます。
+        return _insert_zone(session, records, origin, namespace, errors=errors, commit=commit)
 
 
-def _pushzone(session, target, origin, namespace):
-    zonedata = _read_zone(target, origin=origin, namespace=namespace)
-    with io.StringIO(zonedata) as reader:
-        records = [ZoneRecord({**r, 'namespace': namespace})
-                   for r in ZoneFile.from_stream(reader=reader, origin=origin)]
-    if records is None or len(records) == 0:
+def _insert_zone(session, records, origin, namespace, errors=None, commit=True):
+    if not commit:
+        # トランザクションは呼び出し元でコミットします。
+        count = query.insert_records(session, namespace, records, errors=errors, commit=False)
+    else:
+        try:
+            count = query.insert_records(session, namespace, records, errors=errors)
+        finally:
+            session.close()
+    if count == 0:
         zutils.log_message('Pushzone: No records founded. zone={} namespace={}', [
             origin, namespace])
         return 2
-    try:
-        session.add_all(records)
-        session.commit()
-        zutils.log_message('Records pushed. zone={} namespace={} records={}', [
-            origin, namespace, len(records)])
-    finally:
-        session.close()
+    zutils.log_message('Records pushed. zone={} namespace={} records={}', [
+        origin, namespace, count])
     return 0
 
 
-def _read_zone(target=None, origin=None, namespace=None):
-    if target is not None and target != '-':
-        readpath = os.path.join(target, namespace, origin + '.zone')
-        with open(readpath) as reader:
-            content = reader.read()
-            reader.close()
-    else:
-        content = sys.stdout.read()
-    return content
+def _report_errors(code, errors, max_errors, report=None):
+    """ 寛容モードで収集したエラーをJSONで出力し、閾値に応じた終了コードを返します。
+    エラー数が max_errors を超えた場合は 4 を返します(max_errors がNoneの場合は上限なしです)。
+    """
+    if errors is None:
+        return code
+    if report is not None:
+        text = json.dumps({'total': len(errors), 'max_errors': max_errors, 'errors': errors},
+                          ensure_ascii=False, indent=2)
+        if report == '-':
+            zutils.output(text)
+        else:
+            with open(report, mode='w') as output:
+                print(text, file=output)
+    if max_errors is not None and len(errors) > max_errors:
+        zutils.log_error('Too many errors. errors={} max_errors={}', [len(errors), max_errors])
+        return 4
+    if errors:
+        zutils.log_message('Some lines skipped. errors={}', [len(errors)])
+    return code
+
+
+def _zone_path(target, origin=None, namespace=None):
+    return os.path.join(target, namespace, origin + '.zone')
+
+
+def _write_zone(chunks, target=None, origin=None, namespace=None, binary=False):
+    """ zonefileの内容(bytesのiterable)を書き出します。
+    target には出力先ディレクトリ(またはそのlist)を指定します。Noneまたは"-"の場合は標準出力です。
+    binary=True (raw形式) の場合、出力先のファイル名は {origin}.zone.raw になります。
+    ファイルは同じディレクトリの一時ファイルに書き出した後、os.replaceで置き換えます。
+    複数のディレクトリを指定した場合は、内容を一度だけ生成して各ディレクトリに並行して書き出します。
+    """
+    targets = target if isinstance(target, (list, tuple)) else [target]
+    targets = [t for t in targets if t is not None and t != '-'] or [None]
+    # mkstempは0600でファイルを作成するため、通常のファイル作成と同じパーミッションに揃えます。
+    # os.umaskはプロセス全体の設定を変更するため、スレッドを開始する前に取得します。
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = 0o666 & ~umask
+    if len(targets) == 1:
+        _write_zone_target(chunks, targets[0], origin, namespace, binary, mode)
+        return
+    content = b''.join(chunks)
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [executor.submit(_write_zone_target, [content], t, origin, namespace, binary, mode)
+                   for t in targets]
+        for future in futures:
+            future.result()
 
 
-def _write_zone(data, target=None, origin=None, namespace=None):
-    if target is not None and target != '-':
-        writepath = os.path.join(target, namespace, origin + '.zone')
-        with open(writepath, mode='w') as output:
-            print(data, file=output)
+def _write_zone_target(chunks, target, origin, namespace, binary, mode):
+    if target is not None:
+        writepath = _zone_path(target, origin=origin, namespace=namespace)
+        if binary:
+            writepath += '.raw'
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(writepath), prefix='.' + os.path.basename(writepath))
+        try:
+            with os.fdopen(fd, mode='wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+            os.chmod(tmppath, mode)
+            os.replace(tmppath, writepath)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+    elif binary:
+        sys.stdout.flush()
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
     else:
-        print(data, file=sys.stdout)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in chunks:
+            sys.stdout.write(decoder.decode(chunk))
+        sys.stdout.write(decoder.decode(b'', final=True))
+
+
+def _read_dir_map(path):
+    """ namespaceごとの出力先ディレクトリを指定するファイルを読み込みます。
+    各行は "<namespace> <directory>" の形式で、namespaceに"*"を指定するとすべてのnamespaceが対象になります。
+    同じnamespaceを複数行指定すると、それぞれのディレクトリに出力されます。"#"以降はコメントです。
+    """
+    mapping = {}
+    if path is None:
+        return mapping
+    with open(path, mode='r') as reader:
+        for lineno, line in enumerate(reader, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                raise ValueError('Invalid directory map line {}: "{}"'.format(lineno, line))
+            mapping.setdefault(fields[0], []).append(fields[1].strip())
+    return mapping
+
+
+def _zone_targets(namespace, dirs, mapping):
+    """ --dir と --dir-map から、namespaceの出力先ディレクトリのlistを返します。 """
+    targets = list(dirs or [])
+    for d in mapping.get(namespace, []) + mapping.get('*', []):
+        if d not in targets:
+            targets.append(d)
+    return targets
 
 
 def main():
@@ -0,0 +1,408 @@
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager, ExitStack
+from sqlalchemy import create_engine, event, text, inspect, literal
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from . import utils as zutils
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ["get_engine", "get_session", "session_scope", "begin_readonly", "end_readonly",
+           "bulk_load_scope", "get_read_session", "split_connections",
+           "advisory_key", "lock_for_update", "zone_locks", "lock_stats", "reset_lock_stats", "LockTimeoutError",
+           "upgrade_tables", "remove_sessions", "dispose_engines"]
+
+# 接続プールの設定です。環境変数で変更できます。
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_RECYCLE = -1
+# SQLITE_PROFILE=performance の場合に、SQLiteの接続ごとに設定するPRAGMAです。
+SQLITE_PERFORMANCE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),
+    ('busy_timeout', 5000),
+)
+
+# 接続に失敗したレプリカを、この秒数の間は選択しません。
+REPLICA_RETRY_INTERVAL = 30
+# SQLiteのzoneのロックファイルを、タイムアウトを指定した場合に確認し直す間隔(秒)です。
+LOCK_POLL_INTERVAL = 0.05
+# PostgreSQLで lock_timeout によりロックを取得できなかった場合のSQLSTATE(lock_not_available)です。
+PG_LOCK_NOT_AVAILABLE = '55P03'
+
+_registry = {}
+_lock = threading.Lock()
+_replica_counter = 0
+_replica_down = {}
+_lock_stats = {'acquired': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+
+class LockTimeoutError(Exception):
+    """ zone_locks で、指定した時間内にロックを取得できなかった場合の例外です。 """
+
+
+def engine_options(connection):
+    """ 接続文字列に対応する create_engine のオプションをdictで返します。
+
+    - DB_POOL_SIZE:     プールに保持する接続数 (デフォルト: 5)
+    - DB_MAX_OVERFLOW:  プールの接続数を超えて一時的に作成できる接続数 (デフォルト: 10)
+    - DB_POOL_PRE_PING: 1/true/yes の場合、プールから取り出す際に接続を確認します
+    - DB_POOL_RECYCLE:  指定した秒数より古い接続を作り直します (デフォルト: -1 = 作り直さない)
+    """
+    options = {
+        'pool_pre_ping': zutils.env_flag('DB_POOL_PRE_PING'),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', POOL_RECYCLE)),
+    }
+    url = make_url(connection)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # メモリ上のDBは接続ごとに別のDBになるため、SQLAlchemyのデフォルト(SingletonThreadPool)のままにします。
+            return options
+        # ファイルのDBも接続を使い回します(SQLAlchemy 1.3のデフォルトは接続を保持しないNullPoolです)。
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+    options['pool_size'] = int(os.getenv('DB_POOL_SIZE', POOL_SIZE))
+    options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', MAX_OVERFLOW))
+    return options
+
+
+def _get_entry(connection):
+    entry = _registry.get(connection)
+    if entry is None:
+        with _lock:
+            entry = _registry.get(connection)
+            if entry is None:
+                engine = create_engine(connection, **engine_options(connection))
+                if engine.dialect.name == 'sqlite':
+                    event.listen(engine, 'checkin', _reset_query_only)
+                    if os.getenv('SQLITE_PROFILE') == 'performance':
+                        event.listen(engine, 'connect', _apply_sqlite_pragmas)
+                entry = (engine, scoped_session(sessionmaker(bind=engine)))
+                _registry[connection] = entry
+    return entry
+
+
+def get_engine(connection):
+    """ 接続文字列に対応するEngineを返します。
+    同じ接続文字列に対しては、プロセス内で同じEngine(接続プール)を使い回します。
+    """
+    return _get_entry(connection)[0]
+
+
+def get_session(connection):
+    """ 接続文字列に対応するSessionを返します。
+    スレッドごとに同じSessionが返ります。使い終わったら remove_sessions か session_scope で解放してください。
+    """
+    return _get_entry(connection)[1]()
+
+
+def split_connections(value):
+    """ "," 区切りの接続文字列(DB_CONNECT_READ 等)をlistにします。 """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [v.strip() for v in value if v.strip()]
+
+
+def get_read_session(connection, read_connections=None):
+    """ 読み込み用のSessionを返します。
+    read_connections(レプリカの接続文字列のlist、または","区切りの文字列)を呼び出しごとに順番に選択し、
+    接続できなかったレプリカは REPLICA_RETRY_INTERVAL 秒の間は選択しません。
+    すべてのレプリカに接続できない場合や、レプリカの指定がない場合は connection(プライマリ)のSessionを返します。
+    """
+    global _replica_counter
+    replicas = split_connections(read_connections)
+    if not replicas:
+        return get_session(connection)
+    with _lock:
+        start = _replica_counter % len(replicas)
+        _replica_counter += 1
+    now = time.monotonic()
+    candidates = replicas[start:] + replicas[:start]
+    # 停止中とみなしたレプリカは、他のレプリカがすべて失敗した場合のみ試します。
+    candidates.sort(key=lambda c: _replica_down.get(c, 0) > now)
+    for replica in candidates:
+        session = get_session(replica)
+        try:
+            # 接続をここで確立して、失敗した場合は次のレプリカに切り替えます。
+            session.connection()
+            _replica_down.pop(replica, None)
+            return session
+        except DBAPIError:
+            session.close()
+            _replica_down[replica] = now + REPLICA_RETRY_INTERVAL
+    return get_session(connection)
+
+
+@contextmanager
+def session_scope(connection, readonly=False):
+    """ with文の間だけSessionを使用し、終了時に接続をプールに返します。
+    readonly=True の場合は begin_readonly で読み込み専用のトランザクションを開始し、
+    with文の間のすべてのSELECTが同じスナップショットを参照します。終了時はロールバックします。
+    """
+    Session = _get_entry(connection)[1]
+    session = Session()
+    try:
+        if readonly:
+            begin_readonly(session)
+        yield session
+    finally:
+        if readonly:
+            end_readonly(session)
+        Session.remove()
+
+
+def begin_readonly(session):
+    """ Sessionで読み込み専用のトランザクションを開始します。トランザクションを開始する前のSessionを指定してください。
+
+    - PostgreSQL: REPEATABLE READ, READ ONLY のトランザクションです。
+    - SQLite:     PRAGMA query_only を有効にして、明示的にトランザクション(BEGIN DEFERRED)を開始します。
+                  (pysqliteはSELECTだけではトランザクションを開始しないため)
+    その他のDBでは通常のトランザクションのままです。
+    """
+    name = session.get_bind().dialect.name
+    if name == 'postgresql':
+        session.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+    elif name == 'sqlite':
+        session.execute('PRAGMA query_only = ON')
+        session.execute('BEGIN DEFERRED')
+
+
+def end_readonly(session):
+    """ begin_readonly で開始したトランザクションを終了します。
+    接続はプールで使い回されるため、SQLiteの query_only は元に戻します。
+    """
+    try:
+        if session.get_bind().dialect.name == 'sqlite' and session.is_active:
+            session.execute('PRAGMA query_only = OFF')
+    finally:
+        session.rollback()
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # journal_mode=WAL はDBファイルに記録されますが、その他の設定は接続ごとに必要です。
+    for name, value in SQLITE_PERFORMANCE_PRAGMAS:
+        dbapi_connection.execute('PRAGMA {} = {}'.format(name, value))
+
+
+@contextmanager
+def bulk_load_scope(connection):
+    """ 大量のレコードを登録するためのSessionを返し、with文の終了時に1回だけコミットします。
+    with文の間は書き込みの永続性を緩めます(終了後は元に戻します)。
+    途中で例外が発生した場合はすべての変更をロールバックします。
+
+    - PostgreSQL: SET LOCAL synchronous_commit = OFF (トランザクションの終了時に元に戻ります)
+    - SQLite:     PRAGMA synchronous = OFF (終了時に元の値に戻します)
+    """
+    engine = get_engine(connection)
+    with engine.connect() as conn:
+        name = engine.dialect.name
+        synchronous = None
+        if name == 'sqlite':
+            synchronous = conn.execute('PRAGMA synchronous').scalar()
+            conn.execute('PRAGMA synchronous = OFF')
+        # 同じ接続で設定を戻すため、Sessionを接続に直接バインドします。
+        session = sessionmaker(bind=conn)()
+        try:
+            if name == 'postgresql':
+                session.execute('SET LOCAL synchronous_commit = OFF')
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            if synchronous is not None:
+                conn.execute('PRAGMA synchronous = {}'.format(int(synchronous)))
+
+
+def advisory_key(*parts):
+    """ 文字列の組から、pg_advisory_xact_lock のキーにする64bitの符号付き整数を求めます。 """
+    digest = hashlib.blake2b('\0'.join(parts).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def lock_for_update(session, *parts):
+    """ parts(文字列の組)をキーとするロックを取得し、同じキーで変更するトランザクションを直列化します。
+    ロックはトランザクションの終了時に解放されます。変更する行を読み込む前に呼び出してください。
+
+    - PostgreSQL: pg_advisory_xact_lock です。キーが異なるトランザクションは互いに待ちません。
+    その他のDB(SQLite等)では何もしません。SQLiteにはキーごとのロックがなく、DB全体のロック(BEGIN IMMEDIATE)では
+    異なるキーの変更まで待たせてしまうため、読み込んだ時点のversionを条件にした更新(ZoneRecordのversion_id_col)と
+    呼び出し元のやり直しで競合を検出します。
+    """
+    name = session.get_bind().dialect.name
+    if name == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': advisory_key(*parts)})
+
+
+@contextmanager
+def zone_locks(session, zones, timeout=None):
+    """ zones((namespace, origin) のiterable)ごとのロックを取得し、with文の間は同じzoneを変更する他のプロセスを待たせます。
+    異なるzoneのロックは互いに待たないため、異なるzoneへのpush/deleteは複数のホストから並行して実行できます。
+    ロックはzoneの順に取得するため、複数のzoneをまとめてロックしてもデッドロックしません。
+    timeout(秒)までに取得できない場合は LockTimeoutError になります。Noneの場合は取得できるまで待ちます。
+    待ち時間は lock_stats で参照できます。
+
+    - PostgreSQL: pg_advisory_xact_lock です。ロックはトランザクションの終了時に解放されるため、
+                  with文の中でコミットしてください。タイムアウトは lock_timeout で設定します。
+    - SQLite:     DBファイルと同じディレクトリの "{DBファイル}.locks/" 以下のzoneごとのファイルをロックします(fcntl.flock)。
+                  with文の終了時に解放されるため、with文の中でコミットしてください。
+                  メモリ上のDBや、fcntlがない環境では何もしません。
+    その他のDBでは何もしません。
+    """
+    bind = session.get_bind()
+    name = bind.dialect.name
+    lock_dir = None
+    if name == 'sqlite' and fcntl is not None and bind.engine.url.database not in (None, '', ':memory:'):
+        lock_dir = bind.engine.url.database + '.locks'
+        os.makedirs(lock_dir, exist_ok=True)
+    with ExitStack() as stack:
+        for namespace, origin in sorted({(namespace, zutils.origin_with_dot(origin)) for namespace, origin in zones}):
+            key = advisory_key('zone', namespace, origin)
+            start = time.monotonic()
+            try:
+                if name == 'postgresql':
+                    _lock_zone_postgresql(session, key, timeout)
+                elif lock_dir is not None:
+                    path = os.path.join(lock_dir, '{:016x}.lock'.format(key & 0xffffffffffffffff))
+                    stack.enter_context(_lock_file(path, timeout))
+            except LockTimeoutError:
+                _count_lock_wait(time.monotonic() - start, timeout=True)
+                raise LockTimeoutError('Lock of zone {}/{} not acquired in {} sec'.format(namespace, origin, timeout))
+            _count_lock_wait(time.monotonic() - start)
+        yield
+
+
+def _lock_zone_postgresql(session, key, timeout):
+    if timeout is not None:
+        # lock_timeout=0 は無制限の意味になるため、最小値は1msにします。
+        session.execute("SET LOCAL lock_timeout = '{}ms'".format(max(int(timeout * 1000), 1)))
+    try:
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': key})
+    except OperationalError as e:
+        session.rollback()
+        # 接続の切断やstatement_timeout等は、ロックのタイムアウトではないためそのまま送出します。
+        if getattr(e.orig, 'pgcode', None) != PG_LOCK_NOT_AVAILABLE:
+            raise
+        raise LockTimeoutError(str(e)) from e
+    if timeout is not None:
+        session.execute('SET LOCAL lock_timeout = DEFAULT')
+
+
+@contextmanager
+def _lock_file(path, timeout):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise LockTimeoutError(path)
+                    time.sleep(LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        # ファイルを閉じるとロックも解放されます。
+        os.close(fd)
+
+
+def _count_lock_wait(wait, timeout=False):
+    with _lock:
+        _lock_stats['timeouts' if timeout else 'acquired'] += 1
+        _lock_stats['wait_total'] += wait
+        _lock_stats['wait_max'] = max(_lock_stats['wait_max'], wait)
+
+
+def lock_stats():
+    """ zone_locks の {'acquired', 'timeouts', 'wait_total', 'wait_max'} のdictを返します。
+    acquired/timeouts はロックを取得できた/タイムアウトしたzoneの数、wait_total/wait_max はロックを待った秒数の合計/最大です。
+    """
+    with _lock:
+        return dict(_lock_stats)
+
+
+def reset_lock_stats():
+    with _lock:
+        _lock_stats.update({'acquired': 0, 'timeouts': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+
+
+def _reset_query_only(dbapi_connection, connection_record):
+    # 読み込み専用のトランザクションが例外で終了した場合も、プールに戻す接続は書き込み可能にします。
+    if dbapi_connection is not None:
+        dbapi_connection.execute('PRAGMA query_only = OFF')
+
+
+def upgrade_tables(engine, tables):
+    """ 以前のバージョンで作成したDBを、tables(sqlalchemy.Tableのlist)の定義に合わせます。
+    存在しないテーブルを作成し、既存のテーブルには存在しないカラム(ALTER TABLE ... ADD COLUMN)と
+    インデックスを追加します。既存のデータは変更しません。
+    実行した変更を ('table' | 'column' | 'index', 名前) のlistで返します。
+    """
+    changes = []
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    for table in tables:
+        if table.name not in existing:
+            table.create(engine)
+            changes.append(('table', table.name))
+            continue
+        columns = set([c['name'] for c in inspector.get_columns(table.name)])
+        for column in table.columns:
+            if column.name not in columns:
+                with engine.begin() as conn:
+                    conn.execute(text(_add_column_ddl(engine, table, column)))
+                changes.append(('column', '{}.{}'.format(table.name, column.name)))
+        indexes = set([i['name'] for i in inspector.get_indexes(table.name)])
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in indexes:
+                index.create(engine)
+                changes.append(('index', index.name))
+    return changes
+
+
+def _add_column_ddl(engine, table, column):
+    # NOT NULLのカラムは既存の行にも値が必要なため、スカラーのデフォルト値をDEFAULTとして指定します(versionカラム等)。
+    preparer = engine.dialect.identifier_preparer
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.format_table(table), preparer.format_column(column), column.type.compile(dialect=engine.dialect))
+    if column.default is not None and column.default.is_scalar:
+        default = literal(column.default.arg, type_=column.type)
+        ddl += ' DEFAULT {}'.format(default.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    return ddl
+
+
+def remove_sessions():
+    """ 現在のスレッドのSessionをすべて閉じて、接続をプールに返します。 """
+    for engine, Session in list(_registry.values()):
+        Session.remove()
+
+
+def dispose_engines():
+    """ すべてのEngineの接続プールを破棄して、レジストリを空にします。
+    fork した子プロセスで接続を作り直す場合などに使用します。
+    """
+    with _lock:
+        for engine, Session in _registry.values():
+            Session.remove()
+            engine.dispose()
+        _registry.clear()
+        _replica_down.clear()
@@ -0,0 +1,121 @@
+import re
+import json
+import zlib
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import Column, Index
+from sqlalchemy.types import DateTime, String, Integer, BigInteger, LargeBinary
+from .zonerecord import Base
+
+__all__ = ["ZoneJournal", "ZoneSnapshot", "OP_ADD", "OP_DELETE", "record_key", "diff_records", "format_changes",
+           "encode_snapshot", "decode_snapshot", "parse_as_of"]
+
+OP_ADD = 'add'
+OP_DELETE = 'del'
+# query.take_snapshots で、前回のスナップショットからこの件数以上の変更があったzoneのスナップショットを保存します。
+SNAPSHOT_INTERVAL = 1000
+
+
+class ZoneJournal(Base):
+    """ レコードの変更履歴を追記のみで保持するテーブルです。
+    query.py のレコードを変更する関数は、変更と同じトランザクション内で1レコードにつき1行を追加します。
+    値の変更は、変更前の値の削除(op="del")と変更後の値の追加(op="add")の2行になります。
+    serial には変更時点のzoneのSOAシリアルが入ります(SOAがない場合は0)。
+    SOAシリアルの更新自体も、古いSOAの削除と新しいSOAの追加として同じシリアルで記録されるため、
+    serialごとにまとめるとIXFRの差分と同じ形になります。
+    """
+
+    __tablename__ = "bind9zone_zone_journal"
+    __table_args__ = (
+        Index('ix_bind9zone_zone_journal_zone_serial', 'namespace', 'origin', 'serial'),
+        {'sqlite_autoincrement': True})
+
+    id = Column('id', BigInteger().with_variant(Integer, "sqlite"),
+                primary_key=True, autoincrement=True)
+    namespace = Column('namespace', String(), nullable=False)
+    origin = Column('origin', String(), nullable=False)
+    serial = Column('serial', BigInteger(), nullable=False, default=0)
+    op = Column('op', String(), nullable=False)
+    name = Column('name', String(), nullable=False)
+    type = Column('type', String())
+    ttl = Column('ttl', Integer())
+    data = Column('data', String(), nullable=False)
+    created_at = Column('created_at', DateTime(timezone=False), default=datetime.now)
+
+    def to_record(self):
+        """ "name ttl IN type data" 形式の文字列を返します(TTLがない場合は省略します)。 """
+        fields = [self.name] + ([str(self.ttl)] if self.ttl is not None else []) + ['IN', self.type, self.data]
+        return ' '.join(fields)
+
+
+class ZoneSnapshot(Base):
+    """ 変更履歴のある時点のzoneの内容を保持するテーブルです。
+    journal_id までの変更履歴を反映した内容で、serial/journal_at はその変更履歴のシリアルと記録日時です。
+    query.get_records_as_of は、指定した時点より前の最新のスナップショットに、それ以降の変更履歴を適用して
+    zoneを再構成するため、読み込む変更履歴はスナップショットの間隔分だけになります。
+    """
+
+    __tablename__ = "bind9zone_zone_snapshots"
+    __table_args__ = (
+        Index('ix_bind9zone_zone_snapshots_zone_journal_id', 'namespace', 'origin', 'journal_id'),
+        {'sqlite_autoincrement': True})
+
+    id = Column('id', BigInteger().with_variant(Integer, "sqlite"),
+                primary_key=True, autoincrement=True)
+    namespace = Column('namespace', String(), nullable=False)
+    origin = Column('origin', String(), nullable=False)
+    journal_id = Column('journal_id', BigInteger(), nullable=False)
+    serial = Column('serial', BigInteger(), nullable=False)
+    journal_at = Column('journal_at', DateTime(timezone=False), nullable=False)
+    record_count = Column('record_count', Integer(), nullable=False)
+    content = Column('content', LargeBinary(), nullable=False)
+    created_at = Column('created_at', DateTime(timezone=False), default=datetime.now)
+
+
+def record_key(record):
+    """ ZoneRecord/dict から、変更の比較に使用する (name, type, ttl, data) を返します。 """
+    if isinstance(record, dict):
+        return (record['name'], record['type'], record.get('ttl'), record['data'])
+    return (record.name, record.type, record.ttl, record.data)
+
+
+def diff_records(before, after):
+    """ 変更前/変更後の record_key のlistを比較し、(削除された値のlist, 追加された値のlist) を返します。
+    変更されなかった値は含まれません。
+    """
+    removed = Counter(before) - Counter(after)
+    added = Counter(after) - Counter(before)
+    return list(removed.elements()), list(added.elements())
+
+
+def format_changes(changes):
+    """ query.get_journal_changes の結果を、シリアルごとの "del"/"add" 行のテキストにします。 """
+    lines = []
+    for change in changes:
+        lines.append('; serial {}'.format(change['serial']))
+        for op in (OP_DELETE, OP_ADD):
+            for entry in change[op]:
+                lines.append('{} {}'.format(op, entry.to_record()))
+    return '\n'.join(lines)
+
+
+def encode_snapshot(keys):
+    """ record_key のlistを、スナップショットの content(圧縮したJSON)にします。 """
+    return zlib.compress(json.dumps([list(k) for k in keys]).encode('utf-8'))
+
+
+def decode_snapshot(content):
+    """ encode_snapshot の結果を record_key のlistに戻します。 """
+    return [tuple(k) for k in json.loads(zlib.decompress(content).decode('utf-8'))]
+
+
+def parse_as_of(value):
+    """ pullzone --as-of の値を、SOAシリアル(int)または日時(datetime)に変換します。
+    数字のみの場合はシリアル、それ以外はISO 8601形式の日時です。タイムゾーン付きの日時はローカル時刻に変換します。
+    """
+    if re.fullmatch(r'[0-9]+', value):
+        return int(value)
+    as_of = datetime.fromisoformat(value)
+    if as_of.tzinfo is not None:
+        as_of = as_of.astimezone().replace(tzinfo=None)
+    return as_of
@@ -0,0 +1,209 @@
+import io
+import os
+import sys
+import time
+import zlib
+import marshal
+import hashlib
+import tempfile
+from .zonefile import ParsedRecord
+
+__all__ = ["ParseCache", "DigestReader", "file_identity"]
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+_FORMAT_VERSION = 2
+_INDEX_NAME = 'index'
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """ ファイル内容のSHA-256ダイジェスト(hex)を、ファイル全体を読み込まずに計算します。
+    """
+    h = hashlib.sha256()
+    with open(path, mode='rb') as reader:
+        chunk = reader.read(chunk_size)
+        while chunk:
+            h.update(chunk)
+            chunk = reader.read(chunk_size)
+    return h.hexdigest()
+
+
+def file_identity(path):
+    """ ParseCache.put に渡す (サイズ, mtime(ns), SHA-256) を返します。
+    パース後に取得すると、パース中に変更された内容を新しいファイルのものとして保存してしまうため、
+    パースの前に取得してください。
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns, file_digest(path))
+
+
+class DigestReader(io.RawIOBase):
+    """ ファイルを読み込みながら、読み込んだバイト列のサイズとSHA-256を計算するバイナリストリームです。
+    open_zone_reader に渡してパースすると、identity() でパースした内容そのものの
+    (サイズ, mtime(ns), SHA-256) が得られます。mtimeはファイルを開いた時点の値です。
+    """
+
+    def __init__(self, path):
+        self._raw = open(path, mode='rb')
+        self._stat = os.fstat(self._raw.fileno())
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._raw.readinto(buffer)
+        if size:
+            self._hash.update(memoryview(buffer)[:size])
+            self._size += size
+        return size
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+    def identity(self):
+        """ 読み込んだ内容の (サイズ, mtime(ns), SHA-256) を返します。
+        読み込み中にファイルが変更された場合は、キャッシュしてはいけないためNoneを返します。
+        """
+        try:
+            st = os.stat(self._raw.name)
+        except OSError:
+            return None
+        if (st.st_ino, st.st_size, st.st_mtime_ns) != (self._stat.st_ino, self._size, self._stat.st_mtime_ns):
+            return None
+        return (self._size, self._stat.st_mtime_ns, self._hash.hexdigest())
+
+
+class ParseCache(object):
+    """ ZoneFile.from_stream のパース結果をディスク上にキャッシュするクラスです。
+
+    キャッシュは「zoneファイルのパス + origin」をキーにして保存され、
+    ファイルのサイズ/mtime/内容のSHA-256が一致する場合にのみ有効と判定されます。
+    サイズとmtimeが一致していればファイル内容は読み込みません。
+    mtimeだけが変わっている場合(touchされた等)は内容のダイジェストで判定します。
+
+    エントリはmarshal形式をzlib圧縮したバイナリで保存され、
+    合計サイズが max_bytes を超えると最終アクセスが古いものから削除されます(LRU)。
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def get(self, path, origin):
+        """ キャッシュ済みのパース結果(ParsedRecordのlist)を返します。
+        キャッシュが存在しないか、ファイルが変更されている場合はNoneを返します。
+        """
+        key = self._key(path, origin)
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        size, mtime, digest, nbytes, atime = entry
+        if st.st_size != size:
+            return None
+        if st.st_mtime_ns != mtime:
+            if file_digest(path) != digest:
+                return None
+        records = self._load_entry(key)
+        if records is None:
+            self._discard(key)
+            self._save_index()
+            return None
+        self._index[key] = (size, st.st_mtime_ns, digest, nbytes, time.time())
+        self._save_index()
+        return records
+
+    def put(self, path, origin, records, identity):
+        """ パース結果(ParsedRecordのiterable)をキャッシュに保存します。
+        identity にはパースした内容の (サイズ, mtime(ns), SHA-256) を指定します
+        (DigestReader.identity() または パース前に取得した file_identity() の値)。
+        保存後、合計サイズが上限を超えている場合は古いエントリから削除します。
+        """
+        key = self._key(path, origin)
+        size, mtime, digest = identity
+        rows = [tuple(r) for r in records]
+        payload = zlib.compress(marshal.dumps((_header(), rows)))
+        self._write_atomic(self._entry_path(key), payload)
+        self._index[key] = (size, mtime, digest, len(payload), time.time())
+        self._evict()
+        self._save_index()
+
+    def clear(self):
+        for key in list(self._index.keys()):
+            self._discard(key)
+        self._save_index()
+
+    @property
+    def total_bytes(self):
+        return sum(e[3] for e in self._index.values())
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = self.total_bytes
+        for key, entry in sorted(self._index.items(), key=lambda kv: kv[1][4]):
+            if total <= self.max_bytes:
+                break
+            total -= entry[3]
+            self._discard(key)
+
+    def _discard(self, key):
+        self._index.pop(key, None)
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _load_entry(self, key):
+        try:
+            with open(self._entry_path(key), mode='rb') as reader:
+                header, rows = marshal.loads(zlib.decompress(reader.read()))
+        except (OSError, EOFError, ValueError, TypeError, zlib.error):
+            return None
+        if header != _header():
+            return None
+        return [ParsedRecord._make(row) for row in rows]
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, _INDEX_NAME), mode='rb') as reader:
+                header, index = marshal.loads(reader.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        if header != _header() or not isinstance(index, dict):
+            return {}
+        return index
+
+    def _save_index(self):
+        payload = marshal.dumps((_header(), self._index))
+        self._write_atomic(os.path.join(self.directory, _INDEX_NAME), payload)
+
+    def _write_atomic(self, path, payload):
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, mode='wb') as output:
+                output.write(payload)
+            os.replace(tmppath, path)
+        except Exception:
+            os.remove(tmppath)
+            raise
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    @staticmethod
+    def _key(path, origin):
+        source = '{}\0{}'.format(os.path.abspath(path), origin)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def _header():
+    # marshalのフォーマットはPythonのバージョン依存のため、ヘッダに含めて判定します。
+    return (_FORMAT_VERSION, marshal.version, sys.version_info[0], sys.version_info[1])
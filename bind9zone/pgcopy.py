@@ -0,0 +1,115 @@
+from datetime import datetime
+from .journal import OP_ADD
+
+__all__ = ["is_copy_supported", "copy_insert_rows", "format_copy_value", "format_copy_row"]
+
+# COPYで読み込む一時テーブルです。トランザクションの終了時に中身は削除されます。
+STAGING_TABLE = 'bind9zone_staging_records'
+_STAGING_SEQ = 'staging_seq'
+_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def is_copy_supported(session):
+    """ SessionのDBが COPY ... FROM STDIN による登録に対応している(PostgreSQL + psycopg2)かを返します。 """
+    dialect = session.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def format_copy_value(value):
+    """ 値を COPY のテキスト形式の1フィールドに変換します。
+    NoneはNULL(\\N)、bytesはbyteaのhex形式になり、バックスラッシュ/タブ/改行はエスケープされます。
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        # byteaの "\x..." 形式。COPYのテキスト形式ではバックスラッシュ自体もエスケープが必要です。
+        return '\\\\x' + value.hex()
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value).translate(_TEXT_ESCAPES)
+
+
+def format_copy_row(values):
+    """ 値のlistを COPY のテキスト形式の1行(改行付き)に変換します。 """
+    return '\t'.join([format_copy_value(v) for v in values]) + '\n'
+
+
+def copy_insert_rows(session, table, rows, journal_table=None):
+    """ INSERT用のdict(ZoneRecord.to_insert_row)のiterableを、COPY で一時テーブルに流し込んだ後、
+    INSERT ... SELECT でまとめて table に追加します。rowsは読み込みながら送信されるため、メモリに保持しません。
+    journal_table(ZoneJournal)を指定した場合は、追加するレコードの変更履歴も INSERT ... SELECT で追加します。
+    コミットは呼び出し元で行います。追加したレコード数を返します。
+    """
+    columns = [c.name for c in table.columns]
+    # COPYではカラムのデフォルト値が使われないため、NULLの場合は値を補います。
+    defaults = {c.name: c.default.arg for c in table.columns if c.default is not None and c.default.is_scalar}
+    now = datetime.now()
+    connection = session.connection()
+    connection.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS '
+        'SELECT {columns}, CAST(NULL AS BIGINT) AS {seq} FROM {table} WITH NO DATA'.format(
+            staging=STAGING_TABLE, columns=', '.join(columns), seq=_STAGING_SEQ, table=table.name))
+    connection.execute('TRUNCATE {}'.format(STAGING_TABLE))
+
+    def lines():
+        for seq, row in enumerate(rows):
+            values = [row.get(c) for c in columns]
+            for i, c in enumerate(columns):
+                if values[i] is None and c in ('created_at', 'modified_at'):
+                    values[i] = now
+                elif values[i] is None and c in defaults:
+                    values[i] = defaults[c]
+            yield format_copy_row(values + [seq])
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}, {}) FROM STDIN'.format(STAGING_TABLE, ', '.join(columns), _STAGING_SEQ),
+                           _LineReader(lines()))
+    finally:
+        cursor.close()
+
+    if journal_table is not None:
+        # シリアルは追加する前のzoneのシリアルです(query.write_journal と同じ)。レコードより先に追加するため、
+        # 追加するSOAは含まれません。SOAがない場合は変更履歴の最後のシリアル、それもない場合は0です。
+        connection.execute(
+            "INSERT INTO {journal} (namespace, origin, serial, op, name, type, ttl, data, created_at) "
+            "SELECT s.namespace, s.origin, COALESCE((SELECT MAX(r.soa_serial) FROM {table} r "
+            "WHERE r.namespace = s.namespace AND r.origin = s.origin AND r.name = '@' AND r.type = 'SOA'), "
+            "(SELECT MAX(j.serial) FROM {journal} j WHERE j.namespace = s.namespace AND j.origin = s.origin), 0), "
+            "'{op}', s.name, s.type, s.ttl, s.data, s.created_at FROM {staging} s ORDER BY s.{seq}".format(
+                journal=journal_table.name, table=table.name, op=OP_ADD, staging=STAGING_TABLE, seq=_STAGING_SEQ))
+
+    # idを指定したレコード(meta=(id=N))はそのidで、それ以外は採番して追加します。
+    without_id = [c for c in columns if c != 'id']
+    count = connection.execute(
+        'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} WHERE id IS NOT NULL'.format(
+            table=table.name, columns=', '.join(columns), staging=STAGING_TABLE)).rowcount
+    count += connection.execute(
+        'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} WHERE id IS NULL ORDER BY {seq}'.format(
+            table=table.name, columns=', '.join(without_id), staging=STAGING_TABLE, seq=_STAGING_SEQ)).rowcount
+    connection.execute('TRUNCATE {}'.format(STAGING_TABLE))
+    return count
+
+
+class _LineReader(object):
+    """ 行のiteratorを、copy_expert が読み込むファイルオブジェクト(read(size))として扱うクラスです。 """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        total = len(self._buffer)
+        while size is None or size < 0 or total < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            total += len(line)
+        data = ''.join(chunks)
+        if size is None or size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
@@ -1,12 +1,32 @@
+import time
+import random
 import itertools
+import collections
+import ipaddress
 import validators
-from sqlalchemy import func
+from datetime import datetime
+from sqlalchemy import func, cast, case, and_, or_, select, bindparam, literal, text
+from sqlalchemy.types import String, BigInteger
+from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.orm.session import Session
 from .zonerecord import ZoneRecord
+from .rendercache import ZoneVersion, RenderedZone
+from .journal import ZoneJournal, ZoneSnapshot, OP_ADD, OP_DELETE, SNAPSHOT_INTERVAL
+from .journal import record_key, diff_records, encode_snapshot, decode_snapshot
 from . import utils as zutils
+from . import pgcopy
+from . import database
 
 EMSG_SESSION_TYPE_INVALID = 'Argument session must be an instance of sqlalchemy.orm.session.Session'
 EMSG_MULTIVALUE_TYPE_INVALID = "Record values must be a str or list/tuple of str"
+INSERT_BATCH_SIZE = 1000
+# 他の書き込みと競合した場合に、読み込みからやり直す回数と、待ち時間(秒)の基準値です。
+WRITE_RETRY_LIMIT = 5
+WRITE_RETRY_INTERVAL = 0.05
+
+
+class ConcurrentUpdateError(Exception):
+    """ 他の書き込みと競合し、WRITE_RETRY_LIMIT 回やり直しても変更できなかった場合の例外です。 """
 
 
 def get_records(session, namespace, origin, name=None, type=None):
@@ -22,10 +42,92 @@ def get_records(session, namespace, origin, name=None, type=None):
     if type:
         q = q.filter(ZoneRecord.type == type)
     records = q.all()
-    session.commit()
     return records
 
 
+def iter_records(session, namespace, origin, batch_size=INSERT_BATCH_SIZE):
+    """ namespace/originの全レコードを、DNSの正規順序(sort_key順)でDBから逐次取得するiteratorを返します。
+    DB側でソート済みのため、ZoneFile.iter_zonefile(records, sort=False) でそのまま出力できます。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    q = session.query(ZoneRecord)
+    q = q.filter(
+        ZoneRecord.namespace == namespace,
+        ZoneRecord.origin == originWithDot)
+    q = q.order_by(ZoneRecord.sort_key, ZoneRecord.type, ZoneRecord.id)
+    return q.yield_per(batch_size)
+
+
+def find_by_address(session, address, namespace=None):
+    """ A/AAAAレコードのうち、値がaddressに一致するレコードを返します。
+    addressには "192.0.2.0/24" のようなCIDR表記も指定できます。この場合は範囲内のすべてのレコードを返します。
+    検索には rdata_address カラムのインデックスを使用します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    network = ipaddress.ip_network(address, strict=False)
+    q = session.query(ZoneRecord)
+    q = q.filter(
+        ZoneRecord.type == ('A' if network.version == 4 else 'AAAA'),
+        ZoneRecord.rdata_address.between(network.network_address.packed, network.broadcast_address.packed))
+    if namespace is not None:
+        q = q.filter(ZoneRecord.namespace == namespace)
+    q = q.order_by(ZoneRecord.rdata_address, ZoneRecord.namespace, ZoneRecord.sort_key, ZoneRecord.id)
+    records = q.all()
+    return records
+
+
+def iter_address_records(session, namespace, batch_size=INSERT_BATCH_SIZE):
+    """ namespaceのすべてのA/AAAAレコードを、1回のクエリで逐次取得するiteratorを返します。
+    逆引きzoneの生成に使用します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    q = session.query(ZoneRecord)
+    q = q.filter(
+        ZoneRecord.namespace == namespace,
+        ZoneRecord.type.in_(['A', 'AAAA']),
+        ZoneRecord.rdata_address.isnot(None))
+    q = q.order_by(ZoneRecord.rdata_address, ZoneRecord.sort_key, ZoneRecord.id)
+    return q.yield_per(batch_size)
+
+
+def find_by_target(session, target, namespace=None, type=None):
+    """ CNAME/NS/PTR/MX/SRVレコードのうち、参照先がtargetに一致するレコードを返します。
+    targetはFQDNで指定します(末尾の"."と大文字/小文字は区別しません)。
+    検索には rdata_target カラムのインデックスを使用します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    q = session.query(ZoneRecord)
+    q = q.filter(ZoneRecord.rdata_target == zutils.normalize_target(target + '.'))
+    if namespace is not None:
+        q = q.filter(ZoneRecord.namespace == namespace)
+    if type is not None:
+        q = q.filter(ZoneRecord.type == type)
+    q = q.order_by(ZoneRecord.namespace, ZoneRecord.origin, ZoneRecord.sort_key, ZoneRecord.id)
+    records = q.all()
+    return records
+
+
+def get_ttl_histogram(session, namespace, origin):
+    """ namespace/originのSOA以外のレコードについて、{ttl: レコード数} のdictを返します。
+    コンパクト出力で $TTL を決めるために使用します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    q = session.query(ZoneRecord._ttl, func.count(ZoneRecord.id))
+    q = q.filter(
+        ZoneRecord.namespace == namespace,
+        ZoneRecord.origin == originWithDot,
+        ZoneRecord.type != 'SOA')
+    q = q.group_by(ZoneRecord._ttl)
+    return {ttl: count for ttl, count in q.all()}
+
+
 def get_namespace_zones(session, origin=None, namespace=None):
     if not isinstance(session, Session):
         raise ValueError(EMSG_SESSION_TYPE_INVALID)
@@ -37,10 +139,27 @@ def get_namespace_zones(session, origin=None, namespace=None):
         q = q.filter(ZoneRecord.origin == originWithDot)
     q = q.distinct(ZoneRecord.namespace, ZoneRecord.origin)
     records = q.all()
-    session.commit()
     return records
 
 
+def get_zone_digest(session, namespace, origins):
+    """ DB上の namespace/origin(複数指定可) のレコード集合のダイジェストを返します。
+    zutils.records_digest と同じ計算方法のため、パース結果と比較して変更の有無を判定できます。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    if isinstance(origins, str):
+        origins = [origins]
+    origins = [zutils.origin_with_dot(o) for o in origins]
+    q = session.query(ZoneRecord.name, ZoneRecord.type, ZoneRecord._ttl.label('ttl'),
+                      ZoneRecord.data, ZoneRecord.origin)
+    q = q.filter(
+        ZoneRecord.namespace == namespace,
+        ZoneRecord.origin.in_(origins))
+    records = q.all()
+    return zutils.records_digest(records)
+
+
 def set_records(session, origin, namespace, name, type, data, ttl=None):
     if not isinstance(session, Session):
         raise ValueError(EMSG_SESSION_TYPE_INVALID)
@@ -49,7 +168,14 @@ def set_records(session, origin, namespace, name, type, data, ttl=None):
         data = [data]
     elif not (isinstance(data, (list, tuple)) and all([isinstance(v, str) for v in data])):
         raise validators.utils.ValidationFailure(EMSG_MULTIVALUE_TYPE_INVALID)
+    return _retry_on_conflict(session, _set_records, originWithDot, namespace, name, type, data, ttl)
+
+
+def _set_records(session, originWithDot, namespace, name, type, data, ttl):
     try:
+        # PostgreSQLでは同じ名前を変更するトランザクションのみ直列化します(異なる名前の変更は互いに待ちません)。
+        # SQLiteではロックせず、versionの不一致(StaleDataError)を _retry_on_conflict でやり直します。
+        database.lock_for_update(session, 'record', namespace, originWithDot, name)
         q = session.query(ZoneRecord)
         q = q.filter(
             ZoneRecord.origin == originWithDot,
@@ -58,6 +184,8 @@ def set_records(session, origin, namespace, name, type, data, ttl=None):
         if type not in ('CNAME',):
             q = q.filter(ZoneRecord.type == type)
         records = q.all()
+        # _merge_set_records は既存のレコードを書き換えるため、変更前の値を先に控えます。
+        before = [record_key(r) for r in records]
 
         add_items = []
         if records is None or len(records) == 0:
@@ -69,6 +197,9 @@ def set_records(session, origin, namespace, name, type, data, ttl=None):
         for r in remove_items:
             session.delete(r)
         session.add_all(add_items)
+        deleted, added = diff_records(before, [record_key(r) for r in add_items])
+        write_journal(session, _journal_entries(namespace, originWithDot, deleted, added))
+        bump_generation(session, namespace, originWithDot)
         session.commit()
         session.flush()
         return [r.to_dict() for r in add_items], [r.to_dict() for r in remove_items]
@@ -77,11 +208,83 @@ def set_records(session, origin, namespace, name, type, data, ttl=None):
         raise
 
 
+def insert_records(session, namespace, records, batch_size=INSERT_BATCH_SIZE, errors=None, commit=True):
+    """ パース済みレコード(ParsedRecord/dict)のiterableを、namespaceのレコードとして追加します。
+    ORMのunit-of-workを経由せず、batch_size件ごとにINSERTをexecutemanyで実行し、最後にcommitします。
+    変更履歴(ZoneJournal)も同じトランザクションでバッチごとに追加します。
+    PostgreSQL(psycopg2)の場合は、COPY で一時テーブルに流し込んでから INSERT ... SELECT で追加します。
+    追加したレコード数を返します。
+    errors にlistを指定した場合、検証に失敗したレコードは登録せずに
+    {'line': None, 'text': レコード, 'reason': 理由} の形式で errors に追加して処理を続けます。
+    commit=False の場合はコミットしません(複数のzoneを1つのトランザクションで登録する場合に使用します)。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    table = ZoneRecord.__table__
+    count = 0
+    zones = set()
+    try:
+        if pgcopy.is_copy_supported(session):
+            rows = (r for batch in zutils.iter_batches(records, batch_size)
+                    for r in _to_insert_rows(batch, namespace, errors, zones))
+            count = pgcopy.copy_insert_rows(session, table, rows, journal_table=ZoneJournal.__table__)
+        else:
+            # 変更履歴のシリアルは、追加するSOAの値ではなく、追加する前のzoneのシリアルです。
+            # 後のバッチでは前のバッチで追加したSOAが見えるため、zoneごとに最初のバッチの前に取得します。
+            serials = {}
+            for batch in zutils.iter_batches(records, batch_size):
+                rows = _to_insert_rows(batch, namespace, errors, zones)
+                new_zones = set([(r['namespace'], r['origin']) for r in rows]) - serials.keys()
+                if new_zones:
+                    serials.update({z: 0 for z in new_zones})
+                    serials.update(_current_serials(session, new_zones))
+                # executemanyのパラメータはキーを揃える必要があるため、id指定の有無で分けます。
+                with_id = [r for r in rows if 'id' in r]
+                without_id = [r for r in rows if 'id' not in r]
+                for params in (with_id, without_id):
+                    if params:
+                        session.execute(table.insert(), params)
+                write_journal(session, [{'namespace': r['namespace'], 'origin': r['origin'], 'op': OP_ADD,
+                                         'name': r['name'], 'type': r['type'], 'ttl': r['ttl'], 'data': r['data'],
+                                         'serial': serials[(r['namespace'], r['origin'])]}
+                                        for r in rows])
+                count += len(rows)
+        for zone_namespace, origin in sorted(zones):
+            bump_generation(session, zone_namespace, origin)
+        if commit:
+            session.commit()
+        return count
+    except Exception:
+        session.rollback()
+        raise
+
+
+def _to_insert_rows(records, namespace, errors=None, zones=None):
+    if errors is None:
+        rows = [ZoneRecord.to_insert_row(r, namespace) for r in records]
+    else:
+        rows = []
+        for r in records:
+            try:
+                rows.append(ZoneRecord.to_insert_row(r, namespace))
+            except ValueError as e:
+                errors.append({'line': None, 'text': str(dict(r)), 'reason': str(e)})
+    if zones is not None:
+        zones.update([(r['namespace'], r['origin']) for r in rows])
+    return rows
+
+
 def delete_records(session, origin, namespace, name=None, type=None):
     if not isinstance(session, Session):
         raise ValueError(EMSG_SESSION_TYPE_INVALID)
     originWithDot = zutils.origin_with_dot(origin)
+    return _retry_on_conflict(session, _delete_records, originWithDot, namespace, name, type)
+
+
+def _delete_records(session, originWithDot, namespace, name, type):
     try:
+        if name is not None:
+            database.lock_for_update(session, 'record', namespace, originWithDot, name)
         q = session.query(ZoneRecord)
         q = q.filter(
             ZoneRecord.origin == originWithDot,
@@ -94,13 +297,34 @@ def delete_records(session, origin, namespace, name=None, type=None):
 
         for r in records:
             session.delete(r)
+        if records:
+            write_journal(session, _journal_entries(namespace, originWithDot, [record_key(r) for r in records], []))
+            bump_generation(session, namespace, originWithDot)
         session.commit()
         session.flush()
         return [r.to_dict() for r in records]
+    except StaleDataError:
+        session.rollback()
+        raise
     except Exception:
         session.rollback()
 
 
+def _retry_on_conflict(session, func, *args):
+    # ORMのUPDATE/DELETEは読み込んだ時点のversionを条件に実行されます。
+    # 読み込んでから変更するまでの間に他の書き込みで変更されていた場合(StaleDataError)は、
+    # ロールバックして読み込みからやり直します。待ち時間は回数ごとに倍にし、ランダムにずらします。
+    for attempt in range(WRITE_RETRY_LIMIT):
+        try:
+            return func(session, *args)
+        except StaleDataError as e:
+            session.rollback()
+            error = e
+            time.sleep(WRITE_RETRY_INTERVAL * (2 ** attempt) * random.random())
+    raise ConcurrentUpdateError('Records were modified by another transaction. retried {} times'.format(
+        WRITE_RETRY_LIMIT)) from error
+
+
 def _merge_set_records(records, originWithDot, namespace, name, type, data, ttl=None):
     # 既存レコードが存在する場合はレコード数に合わせてUPDATE/INSERT/DELETEします。
     add = []
@@ -118,6 +342,8 @@ def _merge_set_records(records, originWithDot, namespace, name, type, data, ttl=
         else:
             r.data = v
             r.type = type
+            r.sort_key = r.get_sort_key()
+            r.update_rdata_columns()
             if ttl is not None:
                 r.ttl = ttl
             add.append(r)
@@ -129,7 +355,14 @@ def set_soa_records(session, origin, namespace, nameserver, email,
     if not isinstance(session, Session):
         raise ValueError(EMSG_SESSION_TYPE_INVALID)
     originWithDot = zutils.origin_with_dot(origin)
+    return _retry_on_conflict(session, _set_soa_records, originWithDot, namespace, nameserver, email,
+                              name, serial, refresh, retry, expire, minimum)
+
+
+def _set_soa_records(session, originWithDot, namespace, nameserver, email,
+                     name, serial, refresh, retry, expire, minimum):
     try:
+        database.lock_for_update(session, 'record', namespace, originWithDot, name)
         q = session.query(ZoneRecord)
         q = q.filter(
             ZoneRecord.origin == originWithDot,
@@ -144,11 +377,20 @@ def set_soa_records(session, origin, namespace, nameserver, email,
             'mname': mname, 'rname': rname,
             'serial': serial, 'refresh': refresh, 'retry': retry,
             'expire': expire, 'minimum': minimum}
+        before = [record_key(r) for r in records[:1]]
+        if records:
+            before_serial = records[0].soa_serial
+        else:
+            # SOAを新しく作成する場合も、作成する前のzoneのシリアルで記録します。
+            before_serial = _current_serials(session, {(namespace, originWithDot)}).get((namespace, originWithDot), 0)
         if records:
             record = records[0]
+            params = record.get_soa_params()
             for k, v in updates.items():
                 if v is not None:
-                    setattr(record, k, v)
+                    params[k] = v
+            record.data = zutils.soa_parameters_to_data(**params)
+            record.update_rdata_columns()
         else:
             params = zutils.create_default_soa_params()
             for k, v in updates.items():
@@ -159,6 +401,12 @@ def set_soa_records(session, origin, namespace, nameserver, email,
                                  'origin': originWithDot, 'namespace': namespace,
                                  'name': name, 'type': 'SOA', 'data': soa})
         session.add(record)
+        deleted, added = diff_records(before, [record_key(record)])
+        # シリアルを変更した場合も、update_serial と同じく変更前のシリアルで記録します。
+        entries = [{**e, 'serial': before_serial}
+                   for e in _journal_entries(namespace, originWithDot, deleted, added)]
+        write_journal(session, entries)
+        bump_generation(session, namespace, originWithDot)
         session.commit()
         session.flush()
         return record.to_dict()
@@ -178,36 +426,520 @@ def update_serial(session, origin, namespace, serial=None, force=False):
             ZoneRecord.namespace == namespace)
         lastup = q.one()[0]
 
-        q = session.query(ZoneRecord)
-        q = q.filter(
+        criteria = [
             ZoneRecord.origin == originWithDot,
             ZoneRecord.namespace == namespace,
             ZoneRecord.name == '@',
-            ZoneRecord.type == 'SOA')
-        records = q.all()
-        for r in records:
-            if serial is not None:
-                soa_params = zutils.soa_parameters_from_data(r.data)
-                soa_params['serial'] = serial
-                soa = zutils.soa_parameters_to_data(**soa_params)
-                r.data = soa
-                session.add(r)
-            elif force or r.modified_at < lastup:
-                soa_params = zutils.soa_parameters_from_data(r.data)
-                old_serial = int(soa_params['serial'])
-                soa_params['serial'] = old_serial + 1
-                soa = zutils.soa_parameters_to_data(**soa_params)
-                r.data = soa
-                session.add(r)
+            ZoneRecord.type == 'SOA',
+            ZoneRecord.soa_serial.isnot(None)]
+        values = None
+        if serial is not None:
+            values = soa_serial_values(int(serial))
+        elif force or lastup is not None:
+            if not force:
+                criteria.append(ZoneRecord.modified_at < lastup)
+            values = soa_serial_values(ZoneRecord.soa_serial + 1)
+        count = 0
+        if values is not None:
+            _journal_soa_updates(session, criteria, values)
+            count = session.query(ZoneRecord).filter(*criteria).update(values, synchronize_session=False)
+        if count:
+            bump_generation(session, namespace, originWithDot)
         session.commit()
-        session.flush()
+        records = session.query(ZoneRecord).filter(
+            ZoneRecord.origin == originWithDot,
+            ZoneRecord.namespace == namespace,
+            ZoneRecord.name == '@',
+            ZoneRecord.type == 'SOA').all()
         return [r.to_dict() for r in records]
     except Exception:
         session.rollback()
         raise
 
 
+def update_serials(session, zones=None, force=False, date_serial=False):
+    """ 複数のzoneのSOAシリアルを1つのトランザクションでまとめて更新します。
+    zones には (namespace, origin) のlistを指定します。Noneの場合はすべてのzoneが対象です。
+
+    SOAより後に変更されたレコードがあるzoneを、GROUP BYを使用した1回のSELECTで求めて、
+    それらのSOAをUPDATE文で一括して更新します。force=True の場合は対象のすべてのzoneを更新します。
+    date_serial=True の場合は日付形式(YYYYMMDDnn)のシリアルにします(当日の値であれば1つ進めます)。
+    SOAの変更履歴も INSERT ... SELECT で、zoneの数に関わらずバッチごとに1回で追加します。
+    更新したzoneの (namespace, origin, serial) のlistを返します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    if zones is not None:
+        zones = {(namespace, zutils.origin_with_dot(origin)) for namespace, origin in zones}
+        if not zones:
+            return []
+    try:
+        q = session.query(ZoneRecord.id, ZoneRecord.namespace, ZoneRecord.origin)
+        q = q.filter(
+            ZoneRecord.name == '@',
+            ZoneRecord.type == 'SOA',
+            ZoneRecord.soa_serial.isnot(None))
+        if zones is not None:
+            q = q.filter(*_zones_filter(ZoneRecord, zones))
+        if not force:
+            lastup = session.query(
+                ZoneRecord.namespace, ZoneRecord.origin, func.max(ZoneRecord.modified_at).label('lastup'))
+            if zones is not None:
+                lastup = lastup.filter(*_zones_filter(ZoneRecord, zones))
+            lastup = lastup.group_by(ZoneRecord.namespace, ZoneRecord.origin).subquery()
+            q = q.join(lastup, and_(
+                lastup.c.namespace == ZoneRecord.namespace,
+                lastup.c.origin == ZoneRecord.origin))
+            q = q.filter(ZoneRecord.modified_at < lastup.c.lastup)
+        targets = [row for row in q if zones is None or (row.namespace, row.origin) in zones]
+        if not targets:
+            session.commit()
+            return []
+
+        if date_serial:
+            base = zutils.date_serial_base()
+            serial = case([(ZoneRecord.soa_serial < base, base)], else_=ZoneRecord.soa_serial + 1)
+        else:
+            serial = ZoneRecord.soa_serial + 1
+        ids = [row.id for row in targets]
+        for batch in zutils.iter_batches(ids, INSERT_BATCH_SIZE):
+            _journal_soa_updates(session, [ZoneRecord.id.in_(batch)], soa_serial_values(serial))
+            session.query(ZoneRecord).filter(ZoneRecord.id.in_(batch)).update(
+                soa_serial_values(serial), synchronize_session=False)
+        bump_generations(session, [(row.namespace, row.origin) for row in targets])
+
+        updated = []
+        for batch in zutils.iter_batches(ids, INSERT_BATCH_SIZE):
+            q = session.query(ZoneRecord.namespace, ZoneRecord.origin, ZoneRecord.soa_serial)
+            updated.extend([tuple(row) for row in q.filter(ZoneRecord.id.in_(batch))])
+        session.commit()
+        return sorted(updated)
+    except Exception:
+        session.rollback()
+        raise
+
+
+def _zones_filter(model, zones):
+    # (namespace, origin) の組み合わせはDBによって扱いが異なるため、それぞれのIN句で絞り込みます。
+    # 呼び出し元で組み合わせを確認してください。
+    return (model.namespace.in_({z[0] for z in zones}), model.origin.in_({z[1] for z in zones}))
+
+
 get_record = get_records
 set_record = set_records
 delete_record = delete_records
 set_soa_record = set_soa_records
+
+
+def soa_serial_values(serial):
+    """ SOAのシリアルを serial (値またはSQL式) に更新するUPDATE文の値をdictで返します。
+    dataカラムも分解済みのカラム(soa_*)からSQL上で組み立て直すため、行ごとの解析は不要です。
+    ORMで読み込み済みのSOAを変更する書き込みと競合を検出できるよう、versionも1つ進めます。
+    """
+    serial = cast(serial, BigInteger)
+    text = (ZoneRecord.soa_mname + ' ' + ZoneRecord.soa_rname + ' ( ' + cast(serial, String) + ' '
+            + cast(ZoneRecord.soa_refresh, String) + ' ' + cast(ZoneRecord.soa_retry, String) + ' '
+            + cast(ZoneRecord.soa_expire, String) + ' ' + cast(ZoneRecord.soa_minimum, String) + ' )')
+    return {ZoneRecord.soa_serial: serial, ZoneRecord.data: text, ZoneRecord.version: ZoneRecord.version + 1}
+
+
+def fill_record_columns(session, batch_size=INSERT_BATCH_SIZE):
+    """ sort_key が未設定のレコード(sort_key/rdata_*/soa_* のカラムを追加する前に登録されたレコード)に、
+    name/type/data から求めたこれらのカラムの値を設定し、設定したレコード数を返します。
+    batch_size 件ごとにコミットします。中断した場合も、再度実行すると残りのレコードから再開します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    table = ZoneRecord.__table__
+    columns = ('sort_key',) + zutils.RDATA_COLUMNS + zutils.SOA_COLUMNS
+    stmt = table.update().where(table.c.id == bindparam('_id')).values({c: bindparam(c) for c in columns})
+    count = 0
+    last_id = None
+    while True:
+        q = select([table.c.id, table.c.type, table.c.data, table.c.origin, table.c.fqdn])
+        q = q.where(table.c.sort_key.is_(None))
+        if last_id is not None:
+            q = q.where(table.c.id > last_id)
+        rows = session.execute(q.order_by(table.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        values = []
+        for row in rows:
+            value = {'_id': row.id, 'sort_key': zutils.canonical_sort_key(row.fqdn, row.type, row.origin)}
+            value.update(zutils.rdata_columns(row.type, row.data, row.origin))
+            value.update(zutils.soa_columns(row.type, row.data))
+            values.append(value)
+        session.execute(stmt, values)
+        session.commit()
+        count += len(rows)
+        last_id = rows[-1].id
+    return count
+
+
+def bump_generation(session, namespace, origin):
+    """ namespace/originの世代番号を1つ進めます。レコードを変更するトランザクションの中で呼び出してください。
+    コミットは呼び出し元で行います。
+    """
+    bump_generations(session, [(namespace, origin)])
+
+
+def bump_generations(session, zones):
+    """ 複数のzone((namespace, origin) のiterable)の世代番号をまとめて1つずつ進めます。
+    zoneの数に関わらず実行するSQLの数は一定です(バッチごと)。
+    世代番号の行がないzoneは1で作成します。同じzoneの最初の変更が同時に行われても、
+    INSERT ... ON CONFLICT で加算されるため主キーの重複エラーにはなりません。
+    """
+    table = ZoneVersion.__table__
+    zones = sorted(set(zones))
+    if not zones:
+        return
+    if session.get_bind().dialect.name not in ('postgresql', 'sqlite'):
+        _bump_generations_compat(session, zones)
+        return
+    # INSERT ... ON CONFLICT は PostgreSQL(9.5以降) と SQLite(3.24以降) で同じ構文です。
+    upsert = text(
+        'INSERT INTO {0} (namespace, origin, generation, modified_at) VALUES (:namespace, :origin, 1, :now) '
+        'ON CONFLICT (namespace, origin) DO UPDATE SET generation = {0}.generation + 1, modified_at = :now'
+        .format(table.name))
+    now = datetime.now()
+    for batch in zutils.iter_batches(zones, INSERT_BATCH_SIZE):
+        session.execute(upsert, [{'namespace': z[0], 'origin': z[1], 'now': now} for z in batch])
+
+
+def _bump_generations_compat(session, zones):
+    # INSERT ... ON CONFLICT を使用できないDBでは、UPDATEで更新できなかったzoneの行をINSERTします。
+    table = ZoneVersion.__table__
+    existing = set()
+    for batch in zutils.iter_batches(zones, INSERT_BATCH_SIZE):
+        rows = session.execute(
+            select([table.c.namespace, table.c.origin])
+            .where(table.c.namespace.in_({z[0] for z in batch}))
+            .where(table.c.origin.in_({z[1] for z in batch})))
+        existing.update([(row[0], row[1]) for row in rows])
+    updates = [{'b_namespace': z[0], 'b_origin': z[1]} for z in zones if z in existing]
+    inserts = [{'namespace': z[0], 'origin': z[1], 'generation': 1} for z in zones if z not in existing]
+    if updates:
+        session.execute(
+            table.update()
+            .where(table.c.namespace == bindparam('b_namespace'))
+            .where(table.c.origin == bindparam('b_origin'))
+            .values(generation=table.c.generation + 1, modified_at=func.now()),
+            updates)
+    if inserts:
+        session.execute(table.insert(), inserts)
+
+
+def get_generation(session, namespace, origin):
+    """ namespace/originの現在の世代番号を返します。一度も変更されていない場合は0です。 """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    q = session.query(ZoneVersion.generation)
+    q = q.filter(
+        ZoneVersion.namespace == namespace,
+        ZoneVersion.origin == originWithDot)
+    row = q.one_or_none()
+    return row[0] if row is not None else 0
+
+
+def get_generation_total(session, namespace=None, origin=None):
+    """ 条件に一致するzoneの (zone数, 世代番号の合計) を返します。
+    世代番号は減ることがないため、いずれかのzoneが変更/追加されると値が変わります。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    q = session.query(func.count(ZoneVersion.generation), func.coalesce(func.sum(ZoneVersion.generation), 0))
+    if namespace:
+        q = q.filter(ZoneVersion.namespace == namespace)
+    if origin:
+        q = q.filter(ZoneVersion.origin == zutils.origin_with_dot(origin))
+    count, total = q.one()
+    return int(count), int(total)
+
+
+def write_journal(session, entries):
+    """ 変更履歴(ZoneJournal)を追加します。entries には namespace/origin/op/name/type/ttl/data のdictのiterableを指定します。
+    serial には各zoneの現在のSOAシリアルが入ります(entriesにserialを指定した場合はその値)。
+    レコードを変更するトランザクションの中で呼び出してください。
+    コミットは呼び出し元で行います。
+    """
+    entries = list(entries)
+    if not entries:
+        return
+    serials = _current_serials(session, {(e['namespace'], e['origin']) for e in entries})
+    now = datetime.now()
+    session.execute(ZoneJournal.__table__.insert(), [
+        {'serial': serials.get((e['namespace'], e['origin']), 0), **e, 'created_at': now} for e in entries])
+
+
+def _journal_entries(namespace, origin, deleted, added):
+    entries = []
+    for op, keys in ((OP_DELETE, deleted), (OP_ADD, added)):
+        for name, type, ttl, data in keys:
+            entries.append({'namespace': namespace, 'origin': origin, 'op': op,
+                            'name': name, 'type': type, 'ttl': ttl, 'data': data})
+    return entries
+
+
+def _current_serials(session, zones):
+    # zoneごとの現在のSOAシリアルです。SOAがないzone(deletezoneで削除した後など)は、
+    # 変更履歴に記録した最後のシリアルを返します。どちらもないzoneは含まれません(0として扱います)。
+    serials = {}
+    for batch in zutils.iter_batches(sorted(zones), INSERT_BATCH_SIZE):
+        q = session.query(ZoneRecord.namespace, ZoneRecord.origin, ZoneRecord.soa_serial)
+        q = q.filter(
+            ZoneRecord.name == '@',
+            ZoneRecord.type == 'SOA',
+            ZoneRecord.soa_serial.isnot(None),
+            *_zones_filter(ZoneRecord, batch))
+        serials.update({(row[0], row[1]): row[2] for row in q if (row[0], row[1]) in zones})
+    missing = sorted(set(zones) - serials.keys())
+    for batch in zutils.iter_batches(missing, INSERT_BATCH_SIZE):
+        q = session.query(ZoneJournal.namespace, ZoneJournal.origin, func.max(ZoneJournal.serial))
+        q = q.filter(*_zones_filter(ZoneJournal, batch))
+        q = q.group_by(ZoneJournal.namespace, ZoneJournal.origin)
+        serials.update({(row[0], row[1]): row[2] for row in q if (row[0], row[1]) in zones})
+    return serials
+
+
+def _journal_soa_updates(session, criteria, values):
+    # criteria に該当するSOAを values(soa_serial_values) で更新する前に、
+    # 変更前のSOAの削除と変更後のSOAの追加を、変更前のシリアルで記録します。
+    table = ZoneJournal.__table__
+    columns = ['namespace', 'origin', 'serial', 'op', 'name', 'type', 'ttl', 'data', 'created_at']
+    now = datetime.now()
+    for op, data in ((OP_DELETE, ZoneRecord.data), (OP_ADD, values[ZoneRecord.data])):
+        q = select([ZoneRecord.namespace, ZoneRecord.origin, ZoneRecord.soa_serial, literal(op),
+                    ZoneRecord.name, ZoneRecord.type, ZoneRecord._ttl, data, literal(now)])
+        q = q.where(and_(*criteria)).order_by(ZoneRecord.id)
+        session.execute(table.insert().from_select(columns, q))
+
+
+def get_journal_changes(session, namespace, origin, serial=0):
+    """ namespace/originの、シリアルが serial 以降の変更履歴をIXFRと同様の形式で返します。
+    [{'serial': シリアル, 'del': [ZoneJournal, ...], 'add': [ZoneJournal, ...]}, ...] のlistで、
+    古いシリアルから順に並びます。同じシリアルの間に追加して削除した値などは相殺されます。
+    serial のzoneを保持している場合、各シリアルの 'del' を削除してから 'add' を追加すると最新の状態になります。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    q = session.query(ZoneJournal)
+    q = q.filter(
+        ZoneJournal.namespace == namespace,
+        ZoneJournal.origin == originWithDot,
+        ZoneJournal.serial >= serial)
+    q = q.order_by(ZoneJournal.id)
+    changes = []
+    for serial, entries in itertools.groupby(q, key=lambda e: e.serial):
+        # 値ごとに追加を+1、削除を-1として集計し、差し引きが残ったものだけを返します。
+        counts = {}
+        for entry in entries:
+            key = record_key(entry)
+            if key not in counts:
+                counts[key] = [0, entry]
+            counts[key][0] += 1 if entry.op == OP_ADD else -1
+        changes.append({
+            'serial': serial,
+            OP_DELETE: [entry for count, entry in counts.values() for _ in range(-count)],
+            OP_ADD: [entry for count, entry in counts.values() for _ in range(count)]})
+    return changes
+
+
+def compact_journal(session, zones=None, serial=None, before=None):
+    """ 変更履歴のうち、シリアルが serial より前のもの、または before(datetime) より前に記録されたものを削除します。
+    zones には (namespace, origin) のlistを指定します。Noneの場合はすべてのzoneが対象です。
+    削除する範囲の最後の時点のzoneの内容をスナップショットとして保存し、それより古いスナップショットは削除します。
+    そのため、削除した範囲より後の時点は get_records_as_of で引き続き再構成できます。
+    削除した変更履歴の件数を返します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    if serial is None and before is None:
+        raise ValueError('Argument serial or before must be specified')
+    if zones is not None:
+        zones = {(namespace, zutils.origin_with_dot(origin)) for namespace, origin in zones}
+        if not zones:
+            return 0
+    criteria = []
+    if serial is not None:
+        criteria.append(ZoneJournal.serial < serial)
+    if before is not None:
+        criteria.append(ZoneJournal.created_at < before)
+    try:
+        q = session.query(ZoneJournal.namespace, ZoneJournal.origin, func.max(ZoneJournal.id))
+        q = q.filter(or_(*criteria))
+        if zones is not None:
+            q = q.filter(*_zones_filter(ZoneJournal, zones))
+        q = q.group_by(ZoneJournal.namespace, ZoneJournal.origin)
+        targets = [tuple(row) for row in q if zones is None or (row[0], row[1]) in zones]
+        count = 0
+        for namespace, origin, journal_id in targets:
+            _save_snapshot(session, namespace, origin, journal_id)
+            count += session.query(ZoneJournal).filter(
+                ZoneJournal.namespace == namespace,
+                ZoneJournal.origin == origin,
+                ZoneJournal.id <= journal_id).delete(synchronize_session=False)
+            session.query(ZoneSnapshot).filter(
+                ZoneSnapshot.namespace == namespace,
+                ZoneSnapshot.origin == origin,
+                ZoneSnapshot.journal_id < journal_id).delete(synchronize_session=False)
+        session.commit()
+        return count
+    except Exception:
+        session.rollback()
+        raise
+
+
+def take_snapshots(session, zones=None, interval=SNAPSHOT_INTERVAL):
+    """ 前回のスナップショットから interval 件以上の変更履歴があるzoneのスナップショットを保存します。
+    定期的に実行すると、get_records_as_of が読み込む変更履歴は interval 件程度に抑えられます。
+    対象のzoneはGROUP BYを使用した1回のSELECTで求めます。
+    zones には (namespace, origin) のlistを指定します。Noneの場合はすべてのzoneが対象です。
+    保存したスナップショットの (namespace, origin, journal_id) のlistを返します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    if zones is not None:
+        zones = {(namespace, zutils.origin_with_dot(origin)) for namespace, origin in zones}
+        if not zones:
+            return []
+    try:
+        latest = session.query(
+            ZoneSnapshot.namespace, ZoneSnapshot.origin, func.max(ZoneSnapshot.journal_id).label('journal_id'))
+        latest = latest.group_by(ZoneSnapshot.namespace, ZoneSnapshot.origin).subquery()
+        q = session.query(ZoneJournal.namespace, ZoneJournal.origin, func.max(ZoneJournal.id))
+        q = q.outerjoin(latest, and_(
+            latest.c.namespace == ZoneJournal.namespace,
+            latest.c.origin == ZoneJournal.origin))
+        q = q.filter(ZoneJournal.id > func.coalesce(latest.c.journal_id, 0))
+        if zones is not None:
+            q = q.filter(*_zones_filter(ZoneJournal, zones))
+        q = q.group_by(ZoneJournal.namespace, ZoneJournal.origin)
+        q = q.having(func.count(ZoneJournal.id) >= max(interval, 1))
+        targets = sorted([tuple(row) for row in q if zones is None or (row[0], row[1]) in zones])
+        for namespace, origin, journal_id in targets:
+            _save_snapshot(session, namespace, origin, journal_id)
+        session.commit()
+        return targets
+    except Exception:
+        session.rollback()
+        raise
+
+
+def get_records_as_of(session, namespace, origin, as_of):
+    """ namespace/originの過去の時点のレコードを、スナップショットと変更履歴から再構成して返します。
+    as_of には日時(datetime)またはSOAシリアル(int)を指定します。
+    シリアルの場合は、シリアルが as_of より前の変更をすべて反映した状態(シリアル as_of として公開された内容)です。
+    返すZoneRecordはSessionに属さず、idはありません。正規順序(sort_key順)に並んでいます。
+    変更履歴が compact_journal で削除済みの時点を指定した場合は ValueError になります。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    if isinstance(as_of, datetime):
+        criteria, snapshot_criteria = [ZoneJournal.created_at <= as_of], [ZoneSnapshot.journal_at <= as_of]
+    else:
+        criteria, snapshot_criteria = [ZoneJournal.serial < as_of], [ZoneSnapshot.serial < as_of]
+    keys = _replay_journal(session, namespace, originWithDot, criteria, snapshot_criteria)
+    records = [ZoneRecord({'namespace': namespace, 'origin': originWithDot,
+                           'name': name, 'type': type, 'ttl': ttl, 'data': data})
+               for name, type, ttl, data in keys]
+    return sorted(records, key=lambda r: (r.sort_key, r.type))
+
+
+def _replay_journal(session, namespace, origin, criteria, snapshot_criteria):
+    # snapshot_criteria に該当する最新のスナップショットに、それ以降で criteria に該当する変更履歴を適用します。
+    q = session.query(ZoneSnapshot)
+    q = q.filter(
+        ZoneSnapshot.namespace == namespace,
+        ZoneSnapshot.origin == origin,
+        *snapshot_criteria)
+    snapshot = q.order_by(ZoneSnapshot.journal_id.desc()).first()
+    counts = collections.Counter()
+    if snapshot is not None:
+        counts.update(decode_snapshot(snapshot.content))
+        start = snapshot.journal_id
+    else:
+        # スナップショットより前の変更履歴が削除済みの場合は、zoneの作成時から再構成できません。
+        oldest = session.query(func.min(ZoneSnapshot.journal_id)).filter(
+            ZoneSnapshot.namespace == namespace, ZoneSnapshot.origin == origin).scalar()
+        first = session.query(func.min(ZoneJournal.id)).filter(
+            ZoneJournal.namespace == namespace, ZoneJournal.origin == origin).scalar()
+        if oldest is not None and (first is None or first > oldest):
+            raise ValueError('Journal of {}/{} at the specified point has been compacted'.format(namespace, origin))
+        start = 0
+    q = session.query(ZoneJournal.op, ZoneJournal.name, ZoneJournal.type, ZoneJournal.ttl, ZoneJournal.data)
+    q = q.filter(
+        ZoneJournal.namespace == namespace,
+        ZoneJournal.origin == origin,
+        ZoneJournal.id > start,
+        *criteria)
+    for op, name, type, ttl, data in q.order_by(ZoneJournal.id).yield_per(INSERT_BATCH_SIZE):
+        counts[(name, type, ttl, data)] += 1 if op == OP_ADD else -1
+    return list((+counts).elements())
+
+
+def _save_snapshot(session, namespace, origin, journal_id):
+    # journal_id(namespace/originの変更履歴のid)までを反映したスナップショットを保存します。
+    q = session.query(ZoneSnapshot.id).filter(
+        ZoneSnapshot.namespace == namespace,
+        ZoneSnapshot.origin == origin,
+        ZoneSnapshot.journal_id == journal_id)
+    if q.first() is not None:
+        return
+    entry = session.query(ZoneJournal.serial, ZoneJournal.created_at).filter(ZoneJournal.id == journal_id).one()
+    keys = _replay_journal(session, namespace, origin,
+                           [ZoneJournal.id <= journal_id], [ZoneSnapshot.journal_id <= journal_id])
+    session.execute(ZoneSnapshot.__table__.insert(), {
+        'namespace': namespace, 'origin': origin, 'journal_id': journal_id,
+        'serial': entry.serial, 'journal_at': entry.created_at,
+        'record_count': len(keys), 'content': encode_snapshot(keys), 'created_at': datetime.now()})
+
+
+def get_rendered_zone(session, namespace, origin, variant):
+    """ 出力済みzoneのキャッシュ(圧縮データ)を返します。
+    キャッシュの世代番号が現在の世代番号と一致しない場合はNoneを返します。
+    世代番号の比較はDB上で1回のSELECTで行うため、古い内容が返ることはありません。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    q = session.query(RenderedZone.content)
+    q = q.outerjoin(ZoneVersion, (ZoneVersion.namespace == RenderedZone.namespace)
+                    & (ZoneVersion.origin == RenderedZone.origin))
+    q = q.filter(
+        RenderedZone.namespace == namespace,
+        RenderedZone.origin == originWithDot,
+        RenderedZone.variant == variant,
+        RenderedZone.generation == func.coalesce(ZoneVersion.generation, 0))
+    row = q.one_or_none()
+    return row[0] if row is not None else None
+
+
+def put_rendered_zone(session, namespace, origin, variant, generation, content, digest):
+    """ 出力済みzoneの圧縮データをキャッシュとして保存します。
+    generation には、出力のためにレコードを読み込む前に get_generation で取得した値を指定します。
+    保存時点で世代番号が進んでいる場合は保存せずにFalseを返します。
+    """
+    if not isinstance(session, Session):
+        raise ValueError(EMSG_SESSION_TYPE_INVALID)
+    originWithDot = zutils.origin_with_dot(origin)
+    try:
+        if get_generation(session, namespace, originWithDot) != generation:
+            session.rollback()
+            return False
+        table = RenderedZone.__table__
+        session.execute(
+            table.delete()
+            .where(table.c.namespace == namespace)
+            .where(table.c.origin == originWithDot)
+            .where(table.c.variant == variant))
+        session.execute(table.insert(), {
+            'namespace': namespace, 'origin': originWithDot, 'variant': variant,
+            'generation': generation, 'digest': digest, 'content': content})
+        session.commit()
+        return True
+    except Exception:
+        session.rollback()
+        raise
@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from . import utils as zutils
+from . import query
+
+__all__ = ["QueryCache", "CachedRecord", "get_shared_cache"]
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 300.0
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+class CachedRecord(namedtuple('CachedRecord', ['id', 'namespace', 'origin', 'name', 'type', 'ttl', 'data',
+                                               'fqdn', 'text'])):
+    """ QueryCache.get_records が返す、変更できないレコードです。
+    text は ZoneRecord.to_record() の値(zoneのoriginからの相対名で、idのコメント付き)で、取得時に1回だけ作成します。
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.id, record.namespace, record.origin, record.name, record.type, record.ttl, record.data,
+                   record.fqdn, record.to_record())
+
+
+def get_shared_cache():
+    """ プロセス内で共有する QueryCache を返します(bind9zone get --query-cache が使用します)。
+    初回の呼び出し時に、次の環境変数の値で作成します。
+
+    - QUERY_CACHE_MAX_ENTRIES: 保持するエントリ数の上限 (デフォルト: 1024)
+    - QUERY_CACHE_TTL:         エントリの有効期間(秒) (デフォルト: 300)
+    - QUERY_CACHE_STALE:       世代番号を確認しない期間(秒) (デフォルト: 0 = 毎回確認する)
+    """
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = QueryCache(
+                max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+                ttl=float(os.getenv('QUERY_CACHE_TTL', DEFAULT_TTL)),
+                stale=float(os.getenv('QUERY_CACHE_STALE', 0.0)))
+        return _shared_cache
+
+
+class QueryCache(object):
+    """ query.get_records / query.get_namespace_zones の結果をプロセス内に保持するキャッシュです。
+
+    各エントリは取得時のzoneの世代番号(ZoneVersion)とともに保存され、
+    世代番号が一致する場合のみ有効と判定されます。世代番号はレコードを変更する query.py の関数が進めます。
+
+    - max_entries: 保持するエントリ数の上限です。超過した場合は最後に参照されたのが古いものから削除します(LRU)。
+    - ttl:         世代番号に関わらず、この秒数を過ぎたエントリは取得し直します。
+    - stale:       世代番号を確認してからこの秒数の間は、確認せずにキャッシュを返します(0の場合は毎回確認します)。
+
+    get_records はキャッシュしている CachedRecord(namedtuple)をそのまま返すため、ヒット時にZoneRecordを作成し直しません。
+    レコードの変更には query.set_records 等を使用してください。
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, stale=0.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale = stale
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'validations': 0, 'evictions': 0}
+
+    def get_records(self, session, namespace, origin, name=None, type=None):
+        """ query.get_records と同じ条件で、CachedRecord のlistを返します。 """
+        originWithDot = zutils.origin_with_dot(origin)
+        key = ('records', namespace, originWithDot, name, type)
+
+        def version():
+            return query.get_generation(session, namespace, originWithDot)
+
+        def load():
+            return tuple([CachedRecord.from_record(r)
+                          for r in query.get_records(session, namespace, originWithDot, name=name, type=type)])
+
+        return list(self._get(key, version, load))
+
+    def get_namespace_zones(self, session, origin=None, namespace=None):
+        """ query.get_namespace_zones と同じ条件で (namespace, origin) のlistを返します。 """
+        key = ('zones', namespace, zutils.origin_with_dot(origin) if origin else None)
+
+        def version():
+            return query.get_generation_total(session, namespace=namespace, origin=origin)
+
+        def load():
+            return tuple([tuple(row) for row in query.get_namespace_zones(session, origin=origin, namespace=namespace)])
+
+        return list(self._get(key, version, load))
+
+    def invalidate(self, namespace=None, origin=None):
+        """ namespace/originに該当するエントリを削除します。どちらも指定しない場合はすべて削除します。 """
+        originWithDot = zutils.origin_with_dot(origin) if origin else None
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if namespace is not None and key[1] != namespace:
+                    continue
+                if originWithDot is not None and key[2] not in (originWithDot, None):
+                    continue
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        """ {'hits', 'misses', 'validations', 'evictions', 'size'} のdictを返します。
+        validations は世代番号を確認した回数です。
+        """
+        with self._lock:
+            return {**self._stats, 'size': len(self._entries)}
+
+    def _get(self, key, version, load):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and now - entry['loaded_at'] < self.ttl:
+            with self._lock:
+                if now - entry['checked_at'] < self.stale:
+                    self._stats['hits'] += 1
+                    return entry['value']
+                self._stats['validations'] += 1
+            # 世代番号の確認(DBへの問い合わせ)の間はロックを保持しません。
+            if version() == entry['version']:
+                with self._lock:
+                    entry['checked_at'] = max(entry['checked_at'], now)
+                    self._stats['hits'] += 1
+                return entry['value']
+        self._count('misses')
+        # 世代番号を先に取得します。取得中に変更された場合は、次回の確認で取得し直されます。
+        current = version()
+        value = load()
+        with self._lock:
+            self._entries[key] = {'version': current, 'value': value, 'loaded_at': now, 'checked_at': now}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return value
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
@@ -0,0 +1,246 @@
+import re
+import time
+import base64
+import struct
+import calendar
+import itertools
+import ipaddress
+from . import utils as zutils
+
+__all__ = ["write_raw_zone", "iter_raw_zone", "name_to_wire", "rdata_to_wire", "RRTYPE_CODES", "RawFormatError"]
+
+# BIND9 の masterfile-format raw (lib/dns/masterdump.c) のヘッダ値です。
+RAW_FORMAT = 2
+RAW_VERSION = 1
+RDCLASS_IN = 1
+# TTLが未設定のレコードには、テキスト形式の出力($TTL 600)と同じ値を使用します。
+DEFAULT_TTL = 600
+
+RRTYPE_CODES = {
+    'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16,
+    'SIG': 24, 'KEY': 25, 'AAAA': 28, 'SRV': 33, 'KX': 36, 'CERT': 37, 'RRSIG': 46,
+}
+# 署名するtype(covers)ごとに別のRRsetとして書き出すtypeです(BIND9と同じ)。
+SIGNATURE_TYPES = ('SIG', 'RRSIG')
+
+# DNSSECのアルゴリズム(KEY/SIG/CERT)と、CERTの証明書タイプのニーモニックです。数値でも指定できます。
+ALGORITHM_CODES = {
+    'RSAMD5': 1, 'DH': 2, 'DSA': 3, 'RSASHA1': 5, 'DSA-NSEC3-SHA1': 6, 'RSASHA1-NSEC3-SHA1': 7,
+    'RSASHA256': 8, 'RSASHA512': 10, 'ECC-GOST': 12, 'ECDSAP256SHA256': 13, 'ECDSAP384SHA384': 14,
+    'ED25519': 15, 'ED448': 16, 'INDIRECT': 252, 'PRIVATEDNS': 253, 'PRIVATEOID': 254,
+}
+CERT_TYPE_CODES = {
+    'PKIX': 1, 'SPKI': 2, 'PGP': 3, 'IPKIX': 4, 'ISPKI': 5, 'IPGP': 6, 'ACPKIX': 7, 'IACPKIX': 8,
+    'URI': 253, 'OID': 254,
+}
+
+_HEADER = struct.Struct('!IIIIII')
+_RDATASET_HEADER = struct.Struct('!IHHHII')
+_LABEL_SPLITTER = re.compile(r'(?<!\\)\.')
+_ESCAPE = re.compile(r'\\(\d{3}|.)')
+_TXT_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+_GENERIC_RDATA = re.compile(r'^\\#\s+(\d+)\s*(.*)$')
+_SIG_TIME = re.compile(r'^\d{14}$')
+
+
+class RawFormatError(ValueError):
+    """ レコードをraw形式に変換できない場合(未対応のtype、解析できない値)の例外です。 """
+
+
+def write_raw_zone(records, output, dumptime=None):
+    """ ZoneRecordのiterableを、BIND9の raw 形式(masterfile-format raw)でバイナリストリームに書き出します。
+    named.conf で masterfile-format raw; を指定したゾーンは、named-compilezone を使わずにそのまま読み込めます。
+
+    同一名/同一typeのレコードは1つのRRsetにまとめられます。RRsetのTTLは最初のレコードの値です。
+    SIG/RRSIGは、さらに署名するtype(値の最初のフィールド)ごとに別のRRsetになります。
+    まとめる対象は連続したレコードのみのため、recordsは query.iter_records や
+    ZoneFile.sort_records で並べ替えたものを指定してください。
+    書き出したRRsetの数を返します。
+    """
+    count = -1
+    for chunk in iter_raw_zone(records, dumptime):
+        output.write(chunk)
+        count += 1
+    return count
+
+
+def iter_raw_zone(records, dumptime=None):
+    """ write_raw_zone と同じ内容を、ヘッダ、RRsetごとの bytes のiteratorとして返します。 """
+    if dumptime is None:
+        dumptime = int(time.time())
+    yield _HEADER.pack(RAW_FORMAT, RAW_VERSION, dumptime & 0xffffffff, 0, 0, 0)
+    for (_, type), rrset in itertools.groupby(records, key=lambda r: (r.fqdn.lower(), r.type)):
+        if type in SIGNATURE_TYPES:
+            # 同じ名前のSIGは、署名するtypeごとにまとめます(連続していなくてもまとめます)。
+            rrsets = {}
+            for r in rrset:
+                rrsets.setdefault(_covered_type(r), []).append(r)
+            for covers, sigs in rrsets.items():
+                yield _rdataset_to_wire(sigs, covers)
+        else:
+            yield _rdataset_to_wire(list(rrset))
+
+
+def _covered_type(record):
+    try:
+        return _type_code(record.data.replace('(', ' ').split()[0])
+    except (ValueError, IndexError) as e:
+        raise RawFormatError('Invalid record for raw format. name={} type={} data=[{}] ({})'.format(
+            record.fqdn, record.type, record.data, e))
+
+
+def _rdataset_to_wire(rrset, covers=0):
+    first = rrset[0]
+    if first.type not in RRTYPE_CODES:
+        raise RawFormatError('Record type "{}" is not supported in raw format. name={}'.format(
+            first.type, first.fqdn))
+    ttl = first.ttl if first.ttl is not None else DEFAULT_TTL
+    body = [_with_length(name_to_wire(first.fqdn + '.'))]
+    for r in rrset:
+        data = r.get_soa_text() if r.type == 'SOA' else r.data
+        try:
+            body.append(_with_length(rdata_to_wire(r.type, data, r.origin)))
+        except RawFormatError:
+            raise
+        except (ValueError, IndexError, struct.error) as e:
+            raise RawFormatError('Invalid record for raw format. name={} type={} data=[{}] ({})'.format(
+                r.fqdn, r.type, data, e))
+    body = b''.join(body)
+    header = _RDATASET_HEADER.pack(_RDATASET_HEADER.size + len(body), RDCLASS_IN,
+                                   RRTYPE_CODES[first.type], covers, ttl, len(rrset))
+    return header + body
+
+
+def _with_length(data):
+    if len(data) > 0xffff:
+        raise ValueError('Record data is too long.')
+    return struct.pack('!H', len(data)) + data
+
+
+def name_to_wire(name, origin=None):
+    """ ドメイン名を非圧縮のワイヤ形式に変換します。
+    "@" と末尾が "." でない名前は origin からの相対名として扱います。
+    """
+    if name == '@':
+        name = origin
+    elif not name.endswith('.') or name.endswith('\\.'):
+        if origin is None:
+            raise ValueError('Relative name "{}" requires origin.'.format(name))
+        name = name + '.' + origin
+    labels = [_unescape(label) for label in _LABEL_SPLITTER.split(name.rstrip('.'))] if name != '.' else []
+    wire = []
+    for label in labels:
+        if len(label) == 0 or len(label) > 63:
+            raise ValueError('Invalid label length in "{}".'.format(name))
+        wire.append(bytes([len(label)]) + label)
+    wire.append(b'\x00')
+    wire = b''.join(wire)
+    if len(wire) > 255:
+        raise ValueError('Domain name "{}" is too long.'.format(name))
+    return wire
+
+
+def rdata_to_wire(type, data, origin):
+    """ レコードの値(zonefile上の表記)を非圧縮のワイヤ形式に変換します。 """
+    data = data.strip()
+    generic = _GENERIC_RDATA.match(data)
+    if generic:
+        # RFC 3597 の汎用表記 (\# <length> <hex>)
+        wire = bytes.fromhex(''.join(generic.group(2).split()))
+        if len(wire) != int(generic.group(1)):
+            raise ValueError('RDATA length mismatch. data=[{}]'.format(data))
+        return wire
+    if type == 'A':
+        return ipaddress.IPv4Address(data).packed
+    if type == 'AAAA':
+        return ipaddress.IPv6Address(data).packed
+    if type in ('NS', 'CNAME', 'PTR'):
+        return name_to_wire(data, origin)
+    if type in ('MX', 'KX'):
+        preference, exchange = data.split()
+        return struct.pack('!H', int(preference)) + name_to_wire(exchange, origin)
+    if type == 'SRV':
+        priority, weight, port, target = data.split()
+        return struct.pack('!HHH', int(priority), int(weight), int(port)) + name_to_wire(target, origin)
+    if type == 'TXT':
+        return b''.join([_character_string(s) for s in _txt_strings(data)])
+    if type == 'SOA':
+        params = zutils.soa_parameters_from_data(data)
+        if params is None:
+            raise ValueError('Invalid SOA data. data=[{}]'.format(data))
+        return (name_to_wire(params['mname'], origin) + name_to_wire(params['rname'], origin)
+                + struct.pack('!IIIII', *[int(params[k]) for k in ('serial', 'refresh', 'retry', 'expire', 'minimum')]))
+    if type in ('KEY', 'SIG', 'RRSIG', 'CERT'):
+        # 値が複数行に分かれている場合の括弧を除きます。
+        fields = data.replace('(', ' ').replace(')', ' ').split()
+        if type == 'KEY':
+            # RFC 2535: flags protocol algorithm public-key(base64)
+            return (struct.pack('!HBB', int(fields[0]), int(fields[1]), _mnemonic(fields[2], ALGORITHM_CODES))
+                    + _base64(fields[3:]))
+        if type in SIGNATURE_TYPES:
+            # RFC 2535/4034: type-covered algorithm labels original-ttl expiration inception key-tag signer signature
+            return (struct.pack('!HBBIIIH', _type_code(fields[0]), _mnemonic(fields[1], ALGORITHM_CODES),
+                                int(fields[2]), int(fields[3]), _sig_time(fields[4]), _sig_time(fields[5]),
+                                int(fields[6]))
+                    + name_to_wire(fields[7], origin) + _base64(fields[8:]))
+        # RFC 4398: type key-tag algorithm certificate(base64)
+        return (struct.pack('!HHB', _mnemonic(fields[0], CERT_TYPE_CODES), int(fields[1]),
+                            _mnemonic(fields[2], ALGORITHM_CODES))
+                + _base64(fields[3:]))
+    raise RawFormatError('Record type "{}" is not supported in raw format.'.format(type))
+
+
+def _mnemonic(value, codes):
+    if value.upper() in codes:
+        return codes[value.upper()]
+    return int(value)
+
+
+def _type_code(value):
+    # RFC 3597 の "TYPE<番号>" 表記も受け付けます。
+    value = value.upper()
+    if value in RRTYPE_CODES:
+        return RRTYPE_CODES[value]
+    if value.startswith('TYPE') and value[4:].isdigit():
+        return int(value[4:])
+    raise ValueError('Unknown record type "{}".'.format(value))
+
+
+def _sig_time(value):
+    # YYYYMMDDHHmmSS(UTC) または 1970-01-01 からの秒数です。
+    if _SIG_TIME.match(value):
+        return calendar.timegm(time.strptime(value, '%Y%m%d%H%M%S'))
+    return int(value)
+
+
+def _base64(fields):
+    if not fields:
+        raise ValueError('Base64 data required.')
+    return base64.b64decode(''.join(fields), validate=True)
+
+
+def _txt_strings(data):
+    strings = []
+    for match in _TXT_TOKEN.finditer(data):
+        quoted, bare = match.groups()
+        strings.append(_unescape(quoted if quoted is not None else bare))
+    return strings
+
+
+def _character_string(value):
+    # 255バイトを超える文字列は、BIND9と同様に複数のcharacter-stringに分割します。
+    chunks = [value[i:i + 255] for i in range(0, len(value), 255)] or [b'']
+    return b''.join([bytes([len(chunk)]) + chunk for chunk in chunks])
+
+
+def _unescape(text):
+    # "\." や "\DDD" (10進数のバイト値) のエスケープを解除してバイト列にします。
+    wire = bytearray()
+    pos = 0
+    for match in _ESCAPE.finditer(text):
+        wire += text[pos:match.start()].encode('utf-8')
+        escaped = match.group(1)
+        wire += bytes([int(escaped)]) if len(escaped) == 3 else escaped.encode('utf-8')
+        pos = match.end()
+    wire += text[pos:].encode('utf-8')
+    return bytes(wire)
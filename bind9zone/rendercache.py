@@ -0,0 +1,59 @@
+import zlib
+import hashlib
+from datetime import datetime
+from sqlalchemy import Column
+from sqlalchemy.types import DateTime, String, Integer, BigInteger, LargeBinary
+from .zonerecord import Base
+
+__all__ = ["ZoneVersion", "RenderedZone", "compress_zone", "iter_zone_chunks"]
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ZoneVersion(Base):
+    """ namespace/originごとの世代番号を保持するテーブルです。
+    query.py のレコードを変更する関数は、同じトランザクション内で generation を1つ進めます。
+    """
+
+    __tablename__ = "bind9zone_zone_versions"
+
+    namespace = Column('namespace', String(), primary_key=True)
+    origin = Column('origin', String(), primary_key=True)
+    generation = Column('generation', BigInteger().with_variant(Integer, "sqlite"),
+                        nullable=False, default=0)
+    modified_at = Column('modified_at', DateTime(timezone=False),
+                         default=datetime.now, onupdate=datetime.now)
+
+
+class RenderedZone(Base):
+    """ 出力済みのzoneファイルを圧縮して保持するテーブルです。
+    variant には出力形式とオプション(例: "text", "text-compact-nometa", "raw")が入ります。
+    generation が ZoneVersion の値と一致する場合のみ有効です。
+    """
+
+    __tablename__ = "bind9zone_rendered_zones"
+
+    namespace = Column('namespace', String(), primary_key=True)
+    origin = Column('origin', String(), primary_key=True)
+    variant = Column('variant', String(), primary_key=True)
+    generation = Column('generation', BigInteger().with_variant(Integer, "sqlite"), nullable=False)
+    digest = Column('digest', String(), nullable=False)
+    content = Column('content', LargeBinary(), nullable=False)
+    created_at = Column('created_at', DateTime(timezone=False), default=datetime.now)
+
+
+def compress_zone(content):
+    """ 出力済みのzoneファイル(bytes)を圧縮し、(圧縮データ, 元データのSHA-256) を返します。 """
+    return zlib.compress(content), hashlib.sha256(content).hexdigest()
+
+
+def iter_zone_chunks(compressed, chunk_size=CHUNK_SIZE):
+    """ 圧縮データを chunk_size ごとに展開しながら返します。展開後のデータ全体をメモリに保持しません。 """
+    decompressor = zlib.decompressobj()
+    for pos in range(0, len(compressed), chunk_size):
+        chunk = decompressor.decompress(compressed[pos:pos + chunk_size])
+        if chunk:
+            yield chunk
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
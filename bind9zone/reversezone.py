@@ -0,0 +1,134 @@
+import re
+import bisect
+import hashlib
+import ipaddress
+from . import utils as zutils
+
+__all__ = ["ReverseZoneIndex", "reverse_zone_origin", "build_reverse_zones",
+           "render_reverse_zone", "reverse_zone_digest", "read_reverse_zone_header"]
+
+_HEADER_FORMAT = '; bind9zone reverse zone digest={} serial={}'
+_HEADER_PATTERN = re.compile(r'^; bind9zone reverse zone digest=(?P<digest>[0-9a-f]+) serial=(?P<serial>[0-9]+)')
+
+
+def reverse_zone_origin(network):
+    """ プレフィックス(ipaddress.IPv4Network/IPv6Network)に対応する逆引きzoneのorigin(末尾"."付き)を返します。
+    IPv4はオクテット単位(/8, /16, /24)、IPv6はニブル単位(4の倍数)のプレフィックス長のみ指定できます。
+    """
+    if network.version == 4:
+        if network.prefixlen not in (8, 16, 24):
+            raise ValueError('IPv4 reverse zone prefix length must be 8, 16 or 24. prefix={}'.format(network))
+        labels = str(network.network_address).split('.')[:network.prefixlen // 8]
+        return '.'.join(reversed(labels)) + '.in-addr.arpa.'
+    if network.prefixlen % 4 != 0 or network.prefixlen == 0:
+        raise ValueError('IPv6 reverse zone prefix length must be a multiple of 4. prefix={}'.format(network))
+    nibbles = network.network_address.exploded.replace(':', '')[:network.prefixlen // 4]
+    return '.'.join(reversed(nibbles)) + '.ip6.arpa.'
+
+
+class ReverseZoneIndex(object):
+    """ 逆引きzoneのプレフィックスを区間として保持し、アドレスが含まれるzoneを二分探索で求めるクラスです。
+    プレフィックスの数に関わらず、1アドレスあたりの検索は O(log n) です。
+    重複するプレフィックスは指定できません。
+    """
+
+    def __init__(self, prefixes):
+        intervals = {4: [], 6: []}
+        for prefix in prefixes:
+            network = ipaddress.ip_network(prefix, strict=False)
+            intervals[network.version].append((
+                int(network.network_address), int(network.broadcast_address), reverse_zone_origin(network)))
+        self._starts = {}
+        self._intervals = {}
+        for version, items in intervals.items():
+            items.sort()
+            for prev, item in zip(items, items[1:]):
+                if item[0] <= prev[1]:
+                    raise ValueError('Reverse zone prefixes overlap. {} and {}'.format(prev[2], item[2]))
+            self._starts[version] = [item[0] for item in items]
+            self._intervals[version] = items
+
+    @property
+    def origins(self):
+        return [item[2] for version in (4, 6) for item in self._intervals[version]]
+
+    def lookup(self, address):
+        """ アドレス(ipaddressのオブジェクト、またはrdata_addressカラムのbytes)が含まれるzoneのoriginを返します。
+        どのプレフィックスにも含まれない場合はNoneを返します。
+        """
+        if isinstance(address, bytes):
+            address = ipaddress.ip_address(address)
+        value = int(address)
+        i = bisect.bisect_right(self._starts[address.version], value) - 1
+        if i >= 0:
+            start, end, origin = self._intervals[address.version][i]
+            if value <= end:
+                return origin
+        return None
+
+
+def build_reverse_zones(records, index):
+    """ A/AAAAレコード(rdata_addressが設定されたZoneRecord)のiterableを1回だけ走査して、
+    逆引きzoneごとのPTRレコードを {origin: [(相対名, ttl, 参照先FQDN), ...]} の形式で返します。
+    index のすべてのzoneがキーに含まれます(PTRレコードがない場合は空のlist)。
+    """
+    zones = {origin: [] for origin in index.origins}
+    for r in records:
+        if r.rdata_address is None:
+            continue
+        address = ipaddress.ip_address(r.rdata_address)
+        origin = index.lookup(address)
+        if origin is None:
+            continue
+        name = address.reverse_pointer + '.'
+        zones[origin].append((int(address), name[:-len(origin) - 1], r.ttl, r.fqdn + '.'))
+    # アドレス順に並べます。
+    return {origin: [e[1:] for e in sorted(entries, key=lambda e: (e[0], e[3]))]
+            for origin, entries in zones.items()}
+
+
+def reverse_zone_digest(origin, entries, nameserver, email):
+    """ 逆引きzoneの内容(SOAのシリアルを除く)のダイジェストを返します。 """
+    h = hashlib.sha256()
+    h.update('{}\0{}\0{}\n'.format(origin, nameserver, email).encode('utf-8'))
+    for name, ttl, target in entries:
+        h.update('{}\0{}\0{}\n'.format(name, ttl, target).encode('utf-8'))
+    return h.hexdigest()
+
+
+def next_serial(serial=None):
+    """ 次のSOAシリアルを返します。日付形式(YYYYMMDDnn)より小さくならないようにします。 """
+    base = zutils.date_serial_base()
+    if serial is None:
+        return base
+    return max(int(serial) + 1, base)
+
+
+def render_reverse_zone(origin, entries, nameserver, email, serial, digest):
+    """ 逆引きzoneのzoneファイルの行のiteratorを返します。
+    先頭行のコメントにダイジェストとシリアルを出力し、次回の生成時に変更の有無を判定します。
+    """
+    params = zutils.create_default_soa_params()
+    params.update({'mname': zutils.origin_with_dot(nameserver), 'rname': zutils.email_to_rname(email),
+                   'serial': serial})
+    yield _HEADER_FORMAT.format(digest, serial)
+    yield '$ORIGIN {}'.format(origin)
+    yield '$TTL {}'.format(600)
+    yield '@ 600 IN SOA {}'.format(zutils.soa_parameters_to_data(**params))
+    yield '@ 600 IN NS {}'.format(params['mname'])
+    for name, ttl, target in entries:
+        yield '{} {} IN PTR {}'.format(name, ttl if ttl is not None else '', target)
+
+
+def read_reverse_zone_header(path):
+    """ 生成済みの逆引きzoneファイルから (digest, serial) を読み出します。
+    ファイルが存在しないか、ヘッダがない場合は (None, None) を返します。
+    """
+    try:
+        with open(path, mode='r') as reader:
+            match = _HEADER_PATTERN.match(reader.readline())
+    except OSError:
+        return None, None
+    if match is None:
+        return None, None
+    return match.group('digest'), int(match.group('serial'))
@@ -1,7 +1,22 @@
+import os
 import re
 import sys
+import hashlib
+import functools
+import itertools
+import ipaddress
+from datetime import datetime
 import validators
 
+_LABEL_SPLITTER = re.compile(r'(?<!\\)\.')
+# 検証結果をキャッシュする文字列の最大数です。
+VALIDATION_CACHE_SIZE = 4096
+# validators.domain が受け付ける形式のうち、ASCIIのみで構成される一般的なドメイン名にだけ一致する正規表現です。
+# 一致しない場合は validators.domain (IDNを含む) で判定します。
+_FAST_DOMAIN = re.compile(
+    r'^(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z]$', re.IGNORECASE)
+_SLUG = re.compile(r'^[-a-zA-Z0-9_]+$')
+
 
 def create_default_soa_params():
     return {'serial': 1, 'refresh': 3600, 'retry': 1200,
@@ -25,6 +40,31 @@ def soa_parameters_from_data(data):
         return match.groupdict()
 
 
+SOA_COLUMNS = ('soa_mname', 'soa_rname', 'soa_serial', 'soa_refresh', 'soa_retry', 'soa_expire', 'soa_minimum')
+
+
+def soa_columns(type, data):
+    """ SOAレコードの値を解析して、SOA_COLUMNS の値をdictで返します。
+    SOA以外のレコードや、解析できない値の場合は各カラムがNoneになります。
+    """
+    columns = dict.fromkeys(SOA_COLUMNS)
+    if type != 'SOA' or data is None:
+        return columns
+    params = soa_parameters_from_data(data)
+    if params is None:
+        return columns
+    columns['soa_mname'] = params['mname']
+    columns['soa_rname'] = params['rname']
+    for k in ('serial', 'refresh', 'retry', 'expire', 'minimum'):
+        columns['soa_' + k] = int(params[k])
+    return columns
+
+
+def date_serial_base(now=None):
+    """ 日付形式(YYYYMMDDnn)のSOAシリアルの、当日の最小値を返します。 """
+    return int((now or datetime.now()).strftime('%Y%m%d00'))
+
+
 def email_to_rname(email):
     """ Normalize email value into SOA's RNAME style.
     This method will convert "@" to "." and "." in user-parts to "\\.".
@@ -38,6 +78,27 @@ def email_to_rname(email):
         raise ValueError('Invalid email specified.')
 
 
+@functools.lru_cache(maxsize=VALIDATION_CACHE_SIZE)
+def is_domain(value):
+    """ validators.domain と同じ判定を行い、結果をboolで返します。
+    同じ文字列の判定結果はキャッシュされます。
+    """
+    if not isinstance(value, str):
+        return False
+    if _FAST_DOMAIN.match(value):
+        return True
+    return bool(validators.domain(value))
+
+
+@functools.lru_cache(maxsize=VALIDATION_CACHE_SIZE)
+def is_slug(value):
+    """ validators.slug と同じ判定を行い、結果をboolで返します。
+    同じ文字列の判定結果はキャッシュされます。
+    """
+    return isinstance(value, str) and _SLUG.match(value) is not None
+
+
+@functools.lru_cache(maxsize=VALIDATION_CACHE_SIZE)
 def origin_with_dot(origin, suffix=None, loose=True):
     """ Normalize "origin" value into FQDN with trailing dot(".")
     """
@@ -46,7 +107,7 @@ def origin_with_dot(origin, suffix=None, loose=True):
             origin = origin + '.' + suffix
         elif not loose:
             raise ValueError('Origin "{}" is not FQDN and suffix not specified.'.format(origin))
-    if not validators.domain(re.sub(r'\.$', '', origin)):
+    if not is_domain(re.sub(r'\.$', '', origin)):
         raise ValueError('Invalid Origin Name, {}'.format(origin))
     return origin.rstrip('.') + '.'
 
@@ -67,12 +128,131 @@ def normalize_ttl(ttl):
             raise ValueError('TTL must be a digit.')
 
 
+def records_digest(records):
+    """ レコード集合(name, type, ttl, data, origin を持つdict/ZoneRecord)のダイジェストを返します。
+    レコードの並び順やidには依存しません。
+    """
+    def row(r):
+        if isinstance(r, dict):
+            values = (r.get('name'), r.get('type'), r.get('ttl'), r.get('data'), r.get('origin'))
+        else:
+            values = (r.name, r.type, r.ttl, r.data, r.origin)
+        name, rtype, ttl, data, origin = values
+        ttl = normalize_ttl(ttl)
+        return '\t'.join(['' if v is None else str(v) for v in (name, rtype, ttl, data, origin)])
+    h = hashlib.sha256()
+    for line in sorted(row(r) for r in records):
+        h.update(line.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+RDATA_COLUMNS = ('rdata_address', 'rdata_target', 'rdata_priority', 'rdata_weight', 'rdata_port')
+
+
+def rdata_columns(type, data, origin):
+    """ レコードの値を解析して、検索用のカラム(RDATA_COLUMNS)の値をdictで返します。
+
+    - rdata_address:  A/AAAAのアドレス(IPv4は4バイト、IPv6は16バイトのbytes)
+    - rdata_target:   CNAME/NS/PTR/MX/SRVの参照先(fqdnカラムと同じく末尾の"."を除いたFQDN、小文字)
+    - rdata_priority: MXのpreference、SRVのpriority
+    - rdata_weight:   SRVのweight
+    - rdata_port:     SRVのport
+
+    解析できない値の場合、各カラムはNoneになります(レコードの登録自体は妨げません)。
+    """
+    columns = dict.fromkeys(RDATA_COLUMNS)
+    if data is None:
+        return columns
+    fields = data.split()
+    try:
+        if type == 'A':
+            columns['rdata_address'] = ipaddress.IPv4Address(data.strip()).packed
+        elif type == 'AAAA':
+            columns['rdata_address'] = ipaddress.IPv6Address(data.strip()).packed
+        elif type in ('CNAME', 'NS', 'PTR') and len(fields) == 1:
+            columns['rdata_target'] = normalize_target(fields[0], origin)
+        elif type == 'MX' and len(fields) == 2:
+            columns['rdata_priority'] = int(fields[0])
+            columns['rdata_target'] = normalize_target(fields[1], origin)
+        elif type == 'SRV' and len(fields) == 4:
+            columns['rdata_priority'] = int(fields[0])
+            columns['rdata_weight'] = int(fields[1])
+            columns['rdata_port'] = int(fields[2])
+            columns['rdata_target'] = normalize_target(fields[3], origin)
+    except ValueError:
+        return dict.fromkeys(RDATA_COLUMNS)
+    return columns
+
+
+def normalize_target(name, origin=None):
+    """ レコードの値に含まれる名前を、末尾の"."を除いた小文字のFQDNにします。
+    "@" と末尾が"."でない名前は origin からの相対名として扱います。
+    """
+    if name == '@':
+        name = origin or ''
+    elif not name.endswith('.') and origin:
+        name = name + '.' + origin
+    return name.rstrip('.').lower()
+
+
+def canonical_sort_key(fqdn, type, origin):
+    """ DNSの正規順序(RFC 4034 6.1)でレコードを並べるためのソートキー文字列を返します。
+
+    先頭1文字は優先度で、apexのSOAが"0"、apexのNSが"1"、それ以外が"2"です。
+    続いて、所有者名のラベルを逆順(TLD側から)に並べ、各ラベルを小文字UTF-8のhex表記 + "00"
+    で連結します。hexは[0-9a-f]のみで構成されるため、DBの照合順序に依存せず、
+    文字列比較の結果が正規順序(短いラベルが先、ラベルはバイト列として比較)と一致します。
+    """
+    if fqdn is None:
+        return '9'
+    name = fqdn.rstrip('.').lower()
+    apex = origin is not None and name == origin.rstrip('.').lower()
+    if apex and type == 'SOA':
+        priority = '0'
+    elif apex and type == 'NS':
+        priority = '1'
+    else:
+        priority = '2'
+    labels = _LABEL_SPLITTER.split(name) if name else []
+    return priority + ''.join([label.encode('utf-8').hex() + '00' for label in reversed(labels)])
+
+
+def iter_batches(iterable, size):
+    """ iterableを最大size件ずつのlistに分割して返すイテレータです。
+    """
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+async def aiter_batches(aiterable, size):
+    """ iter_batches の非同期版です。非同期iterableを最大size件ずつのlistに分割します。
+    パース中に前のバッチのDB登録(run_in_executor等)を並行して進める用途を想定しています。
+    """
+    batch = []
+    async for item in aiterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def remove_zonefile_metadata(stream):
     lines = [re.sub(r' *; .*$', '', line.strip()) for line in stream]
     lines = [s for s in filter(lambda s: s != '', lines)]
     return lines
 
 
+def env_flag(name):
+    """ 環境変数を真偽値として読み込みます。"1"/"true"/"yes"(大文字小文字を区別しない)の場合のみTrueです。 """
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes')
+
+
 def output(message, args=[], file=None):
     text = message.format(*args) if args else message
     if file is None:
@@ -93,3 +273,13 @@ def log_error(message, args=[], file=sys.stderr):
         print(message.format(*args), file=file)
     else:
         print(message, file=file)
+
+
+def most_common_ttl(histogram, default=600):
+    """ {ttl: レコード数} の形式のヒストグラムから、最も多く使われているTTLを返します。
+    同数の場合は小さいTTLを優先します。ヒストグラムが空の場合は default を返します。
+    """
+    candidates = [(count, -ttl) for ttl, count in histogram.items() if ttl is not None]
+    if not candidates:
+        return default
+    return -max(candidates)[1]
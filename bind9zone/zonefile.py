@@ -1,7 +1,229 @@
 import re
+import codecs
+import asyncio
+import collections
+from collections import namedtuple
 from .zonerecord import ZoneRecord
 from . import utils as zutils
 
+_PARSED_KEYS = ('name', 'ttl', 'class', 'type', 'data', 'origin')
+_PARSED_KEYS_WITH_ID = _PARSED_KEYS + ('id',)
+ASYNC_YIELD_LINES = 1000
+
+
+class ParsedRecord(namedtuple('ParsedRecord', ['name', 'ttl', 'rclass', 'type', 'data', 'origin', 'id'])):
+    """ ZoneFile.from_stream がパース結果として返すレコードです。
+
+    1レコードあたりのメモリ使用量を抑えるため、dictではなく空の__slots__を持つnamedtupleとして保持します。
+    dictと同様に record['name'] や {**record} でも参照できるため、ZoneRecord(record) にそのまま渡せます。
+    "class" は予約語のため、属性名は rclass です(キーとしては "class" で参照できます)。
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, ttl, rclass, type, data, origin, id=None):
+        return super().__new__(cls, name, ttl, rclass, type, data, origin, id)
+
+    def keys(self):
+        return _PARSED_KEYS if self.id is None else _PARSED_KEYS_WITH_ID
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'class':
+                return self.rclass
+            if key in _PARSED_KEYS_WITH_ID:
+                return getattr(self, key)
+            raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+
+class ZoneParseError(ValueError):
+    """ zoneファイルの行が解釈できなかった場合に発生する例外です。
+    lineno には問題のあった行番号(1始まり)、text にはその行の内容が入ります。
+    """
+
+    def __init__(self, reason, lineno=None, text=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.lineno = lineno
+        self.text = text
+
+    def to_dict(self):
+        return {'line': self.lineno, 'text': self.text, 'reason': self.reason}
+
+
+class ZoneParser(object):
+    """ zoneファイルを1行ずつ受け取ってパースする状態機械です。
+    ZoneFile.from_stream (同期) と ZoneFile.from_async_stream (非同期) で共通に使用されます。
+
+    feed() に1行ずつ渡すと、レコードが確定した場合はParsedRecordを、それ以外はNoneを返します。
+    SOAレコードのように複数行にまたがるレコードは、最後の行を受け取った時点で返ります。
+    入力の終端では close() を呼び出してください。
+
+    missed_lines にlistを指定すると、解釈できない行があっても例外を発生させずに処理を続けます(寛容モード)。
+    この場合、解釈できなかった行は {'line': 行番号, 'text': 行の内容, 'reason': 理由} の形式で
+    missed_lines に追加されます。
+    """
+
+    def __init__(self, origin='.', ttl=None, missed_lines=None):
+        self.origin = origin
+        self.ttl = ttl
+        self.missed_lines = missed_lines
+        self.lastRecord = None
+        self.typeTopRecord = None
+        self.lineno = 0
+        # Not implemented yet, Force skip directive option.
+        self.skip_directives = True
+        self._soa_line = None
+        self._soa_meta = None
+        self._soa_lineno = None
+
+    def feed(self, line):
+        self.lineno += 1
+        try:
+            return self._feed(line)
+        except ValueError as e:
+            if not isinstance(e, ZoneParseError):
+                e = ZoneParseError(str(e), self.lineno, line.rstrip('\r\n'))
+            if self.missed_lines is None:
+                raise e
+            self._reset_soa()
+            self.missed_lines.append(e.to_dict())
+            return None
+
+    def _feed(self, line):
+        if self._soa_line is not None:
+            return self._feed_soa(line)
+
+        line = line.rstrip()
+        meta = ZoneFile.parser_metadata_comment(line)
+        line = ZoneFile.parser_remove_comment(line)
+        if line.strip() == '':
+            return None
+
+        # $GENERATE
+        generate = ZoneFile.parser_generate_directive(line, self.origin)
+        if generate and not self.skip_directives:
+            return {**meta, **generate} if meta else generate
+
+        # $ORIGIN, $TTL
+        directive = ZoneFile.parser_generic_directive(line)
+        if directive:
+            if directive["name"] == '$ORIGIN':
+                if directive["data"].endswith('.'):
+                    self.origin = directive["data"]
+                else:
+                    self.origin = directive["data"] + '.' + self.origin
+            elif directive["name"] == '$TTL':
+                self.ttl = int(directive["data"])
+            else:
+                raise ZoneParseError(
+                    'Unknown directive section found in zone file. line=[{}]'.format(line), self.lineno, line)
+            if not self.skip_directives:
+                return {**meta, **directive} if meta else directive
+            return None
+
+        # Resource record lines.
+        record = ZoneFile.parser_resource_record(line, self.origin)
+        if record:
+            if record.type != "SOA":
+                # SOAレコード以外は1行にまとまってないと駄目。
+                # nameフィールドが省略されたら、前段のレコードから取得(必須)
+                if record.name is None:
+                    if self.lastRecord is not None:
+                        record = record._replace(name=self.lastRecord.name)
+                    else:
+                        raise ZoneParseError(
+                            'Resource name omitted and last entry not found. line=[{}]'.format(line), self.lineno, line)
+
+                # classフィールドが省略されたら、前段のレコードから取得(必須)
+                if record.rclass is None:
+                    if self.lastRecord is not None:
+                        record = record._replace(rclass=self.lastRecord.rclass)
+                    else:
+                        raise ZoneParseError(
+                            'Resource class omitted and last entry not found. line=[{}], dict=[{}]'.format(line, str(record)),
+                            self.lineno, line)
+
+                # ttlフィールドは、先行する "同一名/同一typeのレコード"の値が優先されます。
+                # ただし、コードレベルではTTL値自体は登録可能ですので注意してください。
+                # 同一名/同一タイプで異なるTTLを指定した時、最初に現れたレコードの値が選択される動作はBIND9サーバの仕様です。
+                # 先行するrecordがない場合はゾーンファイルのデフォルト値から取得します。
+                if record.ttl is None:
+                    if self.typeTopRecord is not None and self.typeTopRecord.type == record.type:
+                        record = record._replace(ttl=self.typeTopRecord.ttl)
+                    else:
+                        record = record._replace(ttl=self.ttl)
+
+                # SOA以外のレコードはここから返ります。
+                return self._accept(record, meta)
+            else:
+                # SOAレコードは複数行になってもOK。その代わり"("までは行にまとまってないと駄目。
+                # 追加でSOAレコードの最後まで読み込む必要があります。
+                self._soa_line = line
+                self._soa_meta = meta
+                self._soa_lineno = self.lineno
+                return self._match_soa()
+        if self.missed_lines is not None:
+            # 寛容モードでは、どの形式にも一致しない行も記録します。
+            raise ZoneParseError('Unrecognized line', self.lineno, line)
+        return None
+
+    def close(self):
+        if self._soa_line is not None:
+            # SOAを読み込むために複数行の処理を開始したが、
+            # 適切なSOAが識別できないまま入力が終了した場合は例外を発生させます。
+            e = ZoneParseError(
+                "Valid SOA is not found or maybe longer than 1024 bytes. Buffer='{}'".format(self._soa_line),
+                self._soa_lineno, self._soa_line)
+            self._reset_soa()
+            if self.missed_lines is None:
+                raise e
+            self.missed_lines.append(e.to_dict())
+
+    def _reset_soa(self):
+        self._soa_line = None
+        self._soa_meta = None
+        self._soa_lineno = None
+
+    def _feed_soa(self, line):
+        self._soa_line += ' ' + ZoneFile.parser_remove_comment(line)
+        return self._match_soa()
+
+    def _match_soa(self):
+        line = self._soa_line
+        record = ZoneFile.parser_soa_record(line, self.origin)
+        if record:
+            # SOAレコードはここから返ります。
+            meta = self._soa_meta
+            self._reset_soa()
+            soa_params = zutils.soa_parameters_from_data(record.data)
+            record = record._replace(data=zutils.soa_parameters_to_data(**soa_params))
+            return self._accept(record, meta)
+        if len(line) > 1024:
+            # SOAを読み込むために複数行の処理を開始したが、
+            # 適切なSOAが識別できなかった場合は例外を発生させます。
+            raise ZoneParseError(
+                "Valid SOA is not found or maybe longer than 1024 bytes. Buffer='{}'".format(line),
+                self._soa_lineno, line)
+        return None
+
+    def _accept(self, record, meta):
+        self.lastRecord = record
+        if not (self.typeTopRecord is not None
+                and self.typeTopRecord.name == record.name
+                and self.typeTopRecord.type == record.type):
+            self.typeTopRecord = record
+        return record._replace(id=meta['id']) if meta else record
+
 
 class ZoneFile(object):
 
@@ -10,146 +232,135 @@ class ZoneFile(object):
         """
         ZoneRecordのリストを、BIND9 zonefile 形式の str に変換して返します。
         """
-        originWithDot = records[0].origin
+        return '\n'.join(cls.iter_zonefile(records, sort=sort))
+
+    @classmethod
+    def iter_zonefile(cls, records, sort=True, compact=False, with_meta=True, default_ttl=None):
+        """
+        ZoneRecordのiterableを、BIND9 zonefile 形式の行(改行なし)のiteratorとして返します。
+        sort=False の場合、recordsは並べ替えずにそのまま出力されるため、
+        query.iter_records のようにDB側でソート済みのレコードを逐次出力できます。
+
+        compact=True の場合は、ファイルサイズを抑えたコンパクトな形式で出力します。
+
+        - $TTL には最も多く使われているTTLを出力します(default_ttl で指定できます)。
+        - $TTLと同じ値で、パース時にも$TTLが補完されるTTLは省略します。
+        - 直前のレコードと同じ名前は省略します(SOAを除く)。
+
+        default_ttl を指定しないでコンパクト出力する場合、$TTLを決めるためにrecordsをすべて読み込みます。
+        with_meta=False の場合は "; meta=(id=N)" のコメントを出力しません。
+        出力は from_stream で読み込むと同じレコードの集合になります。
+        """
         if sort:
             records = cls.sort_records(records)
-        zonedata = '\n'.join([
-            '\n'.join(['$ORIGIN {}'.format(originWithDot)]),
-            '\n'.join(['$TTL {}'.format(600)]),
-            '\n'.join([r.to_record() for r in records]),
-        ])
-        return zonedata
+        if not compact:
+            default_ttl = 600
+        elif default_ttl is None:
+            records = list(records)
+            default_ttl = zutils.most_common_ttl(collections.Counter(
+                [r.ttl for r in records if r.type != 'SOA']))
+        originWithDot = None
+        lastName = None
+        typeTop = None
+        for r in records:
+            if originWithDot is None:
+                originWithDot = r.origin
+                yield '$ORIGIN {}'.format(originWithDot)
+                yield '$TTL {}'.format(default_ttl)
+            if not compact:
+                yield r.to_record(withId=with_meta)
+                continue
+            # ZoneParserが名前/TTLを補完する動作をなぞり、補完される値と同じであれば省略します。
+            # BIND9は省略されたTTLに$TTLを使用するため、TTLを省略するのは$TTLと同じ値の場合に限ります。
+            # TTLが未設定(None)のレコードは$TTLの値として扱います。
+            name = r.get_relative_name()
+            ttl = r.ttl
+            if r.type == 'SOA':
+                omitName = omitTtl = False
+            else:
+                omitName = lastName is not None and name == lastName
+                if typeTop is not None and typeTop[1] == r.type:
+                    inferred = typeTop[2]
+                else:
+                    inferred = default_ttl
+                if ttl is None:
+                    ttl = default_ttl
+                omitTtl = ttl == default_ttl and inferred == default_ttl
+            lastName = name
+            if not (typeTop is not None and typeTop[0] == name and typeTop[1] == r.type):
+                typeTop = (name, r.type, ttl)
+            if r.ttl is None and not omitTtl:
+                r = ZoneRecord({**r.to_dict(), 'ttl': ttl})
+            yield r.to_record(withId=with_meta, omitName=omitName, omitTtl=omitTtl)
 
     @classmethod
     def from_stream(cls, reader, origin='.', ttl=None, missed_lines=None):
         """
         def get_from_zonefile
 
-        Zoneファイルを行分割したイテレータを処理して有効な行のdictのiteratorを返します。
-        各dictの戻り値は record_match を参照してください。
-        処理できなかった行があると、missedLines引数の配列に格納されます。
+        Zoneファイルを行分割したイテレータを処理して有効な行のParsedRecordのiteratorを返します。
+        各レコードの項目は parser_resource_record を参照してください。
+        missed_lines にlistを指定した場合、処理できなかった行は例外にせず、
+        {'line': 行番号, 'text': 行の内容, 'reason': 理由} の形式で missed_lines に格納されます。
+        行の解釈は ZoneParser が行います。
         """
+        parser = ZoneParser(origin=origin, ttl=ttl, missed_lines=missed_lines)
         line = reader.readline()
-        lastRecord = None
-        typeTopRecord = None
-        # Not implemented yet, Force skip directive option.
-        skip_directives = True
         while line:
-            line = line.rstrip()
-            meta = cls.parser_metadata_comment(line)
-            line = cls.parser_remove_comment(line)
-            if line.strip() == '':
-                continue
+            record = parser.feed(line)
+            if record is not None:
+                yield record
+            line = reader.readline()
+        parser.close()
 
-            # $GENERATE
-            generate = cls.parser_generate_directive(line, origin)
-            if generate and not skip_directives:
-                yield {**meta, **generate} if meta else generate
-                line = reader.readline()
-                continue
+    @classmethod
+    async def from_async_stream(cls, stream, origin='.', ttl=None, missed_lines=None,
+                                encoding='utf-8', yield_every=ASYNC_YIELD_LINES):
+        """
+        from_stream の非同期版です。ParsedRecordの非同期iteratorを返します。
 
-            # $ORIGIN, $TTL
-            directive = cls.parser_generic_directive(line)
-            if directive:
-                if directive["name"] == '$ORIGIN':
-                    if directive["data"].endswith('.'):
-                        origin = directive["data"]
-                    else:
-                        origin = directive["data"] + '.' + origin
-                elif directive["name"] == '$TTL':
-                    ttl = int(directive["data"])
-                else:
-                    raise ValueError(
-                        'Unknown directive section found in zone file. line=[{}]'.format(line))
-                if not skip_directives:
-                    yield {**meta, **directive} if meta else directive
-                line = reader.readline()
-                continue
+        streamには下記のいずれかを指定します。
 
-            # Resource record lines.
-            record = cls.parser_resource_record(line, origin)
-            if record:
-                if record["type"] != "SOA":
-                    # SOAレコード以外は1行にまとまってないと駄目。
-                    # nameフィールドが省略されたら、前段のレコードから取得(必須)
-                    if record["name"] is None:
-                        if lastRecord is not None:
-                            record["name"] = lastRecord["name"]
-                        else:
-                            raise ValueError(
-                                'Resource name omitted and last entry not found. line=[{}]'.format(line))
-
-                    # classフィールドが省略されたら、前段のレコードから取得(必須)
-                    if record["class"] is None:
-                        if lastRecord is not None:
-                            record["class"] = lastRecord["class"]
-                        else:
-                            raise ValueError(
-                                'Resource class omitted and last entry not found. line=[{}], dict=[{}]'.format(line, str(record)))
-
-                    # ttlフィールドは、先行する "同一名/同一typeのレコード"の値が優先されます。
-                    # ただし、コードレベルではTTL値自体は登録可能ですので注意してください。
-                    # 同一名/同一タイプで異なるTTLを指定した時、最初に現れたレコードの値が選択される動作はBIND9サーバの仕様です。
-                    # 先行するrecordがない場合はゾーンファイルのデフォルト値から取得します。
-                    if record["ttl"] is None:
-                        if typeTopRecord is not None and typeTopRecord["type"] == record["type"]:
-                            record["ttl"] = typeTopRecord["ttl"]
-                        else:
-                            record["ttl"] = ttl
-
-                    # SOA以外のレコードはここから返ります。
-                    yield {**meta, **record} if meta else record
-                    lastRecord = record
-                    if not (typeTopRecord is not None
-                            and typeTopRecord['name'] == record['name']
-                            and typeTopRecord['type'] == record['type']):
-                        typeTopRecord = record
-                else:
-                    # SOAレコードは複数行になってもOK。その代わり"("までは行にまとまってないと駄目。
-                    # 追加でSOAレコードの最後まで読み込む必要があります。
-                    record = cls.parser_soa_record(line, origin)
-                    while record is None:
-                        nextline = reader.readline()
-                        if nextline is None:
-                            break
-                        line += ' ' + cls.parser_remove_comment(nextline)
-                        record = cls.parser_soa_record(line, origin)
-                        if record or len(line) > 1024:
-                            break
-                    if record:
-                        # SOAレコードはここから返ります。
-                        soa_params = zutils.soa_parameters_from_data(record['data'])
-                        record['data'] = zutils.soa_parameters_to_data(**soa_params)
-                        yield {**meta, **record} if meta else record
-                        lastRecord = record
-                        if not (typeTopRecord is not None
-                                and typeTopRecord['name'] == record['name']
-                                and typeTopRecord['type'] == record['type']):
-                            typeTopRecord = record
-                    else:
-                        # SOAを読み込むために複数行の処理を開始したが、
-                        # 適切なSOAが識別できなかった場合は例外を発生させます。
-                        raise Exception(
-                            "Valid SOA is not found or maybe longer than 1024 bytes. Buffer='{}'".format(line))
-            if missed_lines is not None and len(missed_lines) > 0 and len(line) > 0:
-                raise Exception("Invalid parser: {}".format(line))
-            line = reader.readline()
+        - bytes または str を返す非同期iterable (行単位である必要はありません。HTTPのボディチャンク等)
+        - readline() コルーチンを持つオブジェクト (asyncio.StreamReader 等)
+
+        入力は行単位で逐次パースされ、ファイル全体をバッファリングしません。
+        大きなチャンクを受け取った場合でもイベントループを占有しないよう、
+        yield_every 行ごとに制御をイベントループに返します。
+        """
+        parser = ZoneParser(origin=origin, ttl=ttl, missed_lines=missed_lines)
+        count = 0
+        async for line in _aiter_lines(stream, encoding):
+            record = parser.feed(line)
+            if record is not None:
+                yield record
+            count += 1
+            if yield_every and count % yield_every == 0:
+                await asyncio.sleep(0)
+        parser.close()
 
     @staticmethod
-    def sort_records(records, types=['SOA'], names=['@']):
+    def sort_records(records, types=None, names=None):
         """
-        sort_records(records, order=[]):
-        型、レコード名に応じてZoneRecordのlistをソートして返します。
-        order変数にはソート時に優先されるZoneRecordのtype値を指定します。
-        ソート時の優先度は、order変数に指定したtype順 -> nameのアルファベッド順 -> type順 です。
+        sort_records(records, types=None, names=None):
+        ZoneRecordのlistをDNSの正規順序でソートして返します。
+        ソート時の優先度は、apexのSOA -> apexのNS -> 所有者名の正規順序(ラベルを逆順に比較) -> type順 です。
+        DB上のレコードは sort_key カラムに同じキーを保持しているため、
+        query.iter_records を使用すればDB側でソートできます。
+        以前のバージョンとの互換のため、types/namesにtype値/レコード名のlistを指定すると、
+        types に指定したtype順 -> names に指定したレコード名順 を正規順序より優先します。
         """
+        types = list(types or [])
+        names = list(names or [])
+
         def keyfunc(r):
             if not isinstance(r, ZoneRecord):
                 raise TypeError(
                     'This function only accept for a list of ZoneRecord objects.')
-            typeorder = types.index(r.type) if r.type in types else 'zz'
-            nameorder = names.index(r.name) if r.name in names else 'z'
-            return '{}:{}:{}:{}'.format(typeorder, nameorder, r.name, r.type)
+            typeorder = types.index(r.type) if r.type in types else len(types)
+            nameorder = names.index(r.name) if r.name in names else len(names)
+            sort_key = r.sort_key if r.sort_key is not None else r.get_sort_key()
+            return (typeorder, nameorder, sort_key, r.type or '', r.id is not None, r.id or 0)
         return sorted(records, key=keyfunc)
 
     @staticmethod
@@ -244,7 +455,7 @@ class ZoneFile(object):
 
         Zoneファイルのリソースレコード1行をパースします。
         currentOriginには現在処理中のゾーンファイル上で、有効な$ORIGIN値を指定します。
-        戻りはdictで下記項目です。
+        戻りはParsedRecordで下記項目です(dictと同様にキーでも参照できます)。
 
         - name:    リソース名(先頭)に指定された値
         - ttl:     有効期限
@@ -273,15 +484,8 @@ class ZoneFile(object):
         pattern = r'^(?P<name>[0-9A-Za-z*._-]+|@)?\s+(?:(?P<ttl>[1-9][0-9]*[MHDW]?)\s+)?(?:(?P<class>IN)\s+)?(?:(?P<type>A|AAAA|AFSDB|APL|CAA|CDNSKEY|CDS|CERT|CNAME|DHCID|DLV|DNAME|DNSKEY|DS|HIP|IPSECKEY|KEY|KX|LOC|MX|NAPTR|NS|NSEC|NSEC3|NSEC3PARAM|PTR|RRSIG|RP|SIG|SOA|SRV|SSHFP|TA|TKEY|TLSA|TSIG|TXT)\s+)(?P<data>\S.*)$'
         match = re.match(pattern, line)
         if match:
-            record = {
-                "name": match.group("name"),
-                "ttl": match.group("ttl"),
-                "class": match.group("class"),
-                "type": match.group("type"),
-                "data": match.group("data"),
-                "origin": currentOrigin,
-            }
-            return record
+            return ParsedRecord(match.group("name"), match.group("ttl"), match.group("class"),
+                                match.group("type"), match.group("data"), currentOrigin)
 
     @staticmethod
     def parser_soa_record(line, currentOrigin):
@@ -291,7 +495,7 @@ class ZoneFile(object):
         Zoneファイルのリソースレコード1行をパースします。この関数はrecord_matchのSOAのみに反応する版です。
         currentOriginには現在処理中のゾーンファイル上で、有効な$ORIGIN値を指定します。
 
-        戻りはdictで下記項目です。
+        戻りはParsedRecordで下記項目です。
 
         - name:    リソース名(先頭)に指定された値
         - ttl:     有効期限
@@ -306,12 +510,34 @@ class ZoneFile(object):
         pattern = r'^(?P<name>[0-9A-Za-z*._-]+|@)?\s+(?:(?P<ttl>[1-9][0-9]*)\s+)?(?:(?P<class>IN)\s+)?(?:(?P<type>SOA)\s+)(?P<data>(?:(?P<dns>[0-9A-Za-z.-]+)\s+)(?:(?P<email>[0-9A-Za-z.\\-]+)\s+)\(\s*(?P<serial>[0-9]+)\s+(?P<refresh>[0-9]+)\s+(?P<retry>[0-9]+)\s+(?P<expire>[0-9]+)\s+(?P<minimum>[0-9]+)\s*\))$'
         match = re.match(pattern, line)
         if match:
-            record = {
-                "name": match.group("name"),
-                "ttl": match.group("ttl"),
-                "class": match.group("class"),
-                "type": match.group("type"),
-                "data": match.group("data"),
-                "origin": currentOrigin,
-            }
-            return record
+            return ParsedRecord(match.group("name"), match.group("ttl"), match.group("class"),
+                                match.group("type"), match.group("data"), currentOrigin)
+
+
+async def _aiter_lines(stream, encoding='utf-8'):
+    """ 非同期ストリームを行単位のstrの非同期iteratorに変換します。
+    チャンクの境界が行やマルチバイト文字の途中にあっても正しく分割します。
+    """
+    if hasattr(stream, '__aiter__'):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        buffer = ''
+        async for chunk in stream:
+            if isinstance(chunk, (bytes, bytearray)):
+                chunk = decoder.decode(chunk)
+            buffer += chunk
+            if '\n' not in chunk:
+                continue
+            lines = buffer.split('\n')
+            buffer = lines.pop()
+            for line in lines:
+                yield line
+        buffer += decoder.decode(b'', final=True)
+        if buffer:
+            yield buffer
+    else:
+        line = await stream.readline()
+        while line:
+            if isinstance(line, (bytes, bytearray)):
+                line = line.decode(encoding)
+            yield line
+            line = await stream.readline()
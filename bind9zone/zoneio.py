@@ -0,0 +1,118 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+from contextlib import contextmanager
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ["open_zone_reader", "find_zone_file", "ZONEFILE_SUFFIXES"]
+
+# zoneファイルとして検索する拡張子(優先順)です。
+ZONEFILE_SUFFIXES = ('.zone', '.zone.gz', '.zone.bz2', '.zone.xz', '.zone.zst')
+
+_MAGIC_LENGTH = 6
+_MAGIC_GZIP = b'\x1f\x8b'
+_MAGIC_BZ2 = b'BZh'
+_MAGIC_XZ = b'\xfd7zXZ\x00'
+_MAGIC_ZSTD = b'\x28\xb5\x2f\xfd'
+
+
+def find_zone_file(target, origin, namespace):
+    """ {target}/{namespace}/{origin}.zone (圧縮ファイルを含む) のうち、存在するファイルのパスを返します。
+    いずれも存在しない場合は非圧縮の .zone のパスを返します。
+    """
+    basepath = os.path.join(target, namespace, origin)
+    for suffix in ZONEFILE_SUFFIXES:
+        if os.path.isfile(basepath + suffix):
+            return basepath + suffix
+    return basepath + ZONEFILE_SUFFIXES[0]
+
+
+@contextmanager
+def open_zone_reader(source, encoding='utf-8'):
+    """ zoneファイルをテキストのストリームとして開きます。
+    sourceにはファイルパスまたはバイナリストリーム(sys.stdin.buffer等)を指定します。
+
+    gzip/bzip2/xz/zstd で圧縮されている場合は、拡張子ではなく先頭のマジックバイトで判定して
+    逐次展開します(zstdは compression.zstd または zstandard モジュールが必要です)。
+    ファイル全体をメモリに読み込むことはありません。
+    バイナリストリームを指定した場合、そのストリーム自体は閉じません。
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, mode='rb') as raw:
+            reader = _open_text(raw, encoding)
+            try:
+                yield reader
+            finally:
+                reader.close()
+    else:
+        reader = _open_text(source, encoding)
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+
+def _open_text(raw, encoding):
+    magic = _read_magic(raw)
+    binary = io.BufferedReader(_PrefixedReader(magic, raw))
+    if magic.startswith(_MAGIC_GZIP):
+        return gzip.open(binary, mode='rt', encoding=encoding)
+    if magic.startswith(_MAGIC_BZ2):
+        return bz2.open(binary, mode='rt', encoding=encoding)
+    if magic.startswith(_MAGIC_XZ):
+        return lzma.open(binary, mode='rt', encoding=encoding)
+    if magic.startswith(_MAGIC_ZSTD):
+        if zstd is not None:
+            return zstd.open(binary, mode='rt', encoding=encoding)
+        if zstandard is not None:
+            decompressed = zstandard.ZstdDecompressor().stream_reader(binary, closefd=False)
+            return io.TextIOWrapper(io.BufferedReader(decompressed), encoding=encoding)
+        raise ValueError('zstd compressed zone file requires "zstandard" module.')
+    return io.TextIOWrapper(binary, encoding=encoding)
+
+
+def _read_magic(raw):
+    # パイプからの入力では1回のreadで必要なバイト数が揃わないことがあるため、EOFまで繰り返します。
+    magic = b''
+    while len(magic) < _MAGIC_LENGTH:
+        chunk = raw.read(_MAGIC_LENGTH - len(magic))
+        if not chunk:
+            break
+        magic += chunk
+    return magic
+
+
+class _PrefixedReader(io.RawIOBase):
+    """ 判定のために先読みしたバイト列を、元のストリームの先頭に戻して読み出すためのラッパーです。
+    close() しても元のストリームは閉じません。
+    """
+
+    def __init__(self, prefix, raw):
+        self._prefix = prefix
+        self._raw = raw
+        # read1 が使える場合は、バッファが埋まるのを待たずに到着済みのデータを返します。
+        self._read = getattr(raw, 'read1', raw.read)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._prefix:
+            size = min(len(buffer), len(self._prefix))
+            buffer[:size] = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            return size
+        data = self._read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        return size
@@ -1,11 +1,10 @@
 import re
-import validators
 import itertools
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import Column
+from sqlalchemy import Column, Index
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import validates
-from sqlalchemy.types import DateTime, String, Integer, BigInteger
+from sqlalchemy.types import DateTime, String, Integer, BigInteger, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from . import utils as zutils
 JST = timezone(timedelta(hours=+9), 'JST')
@@ -15,7 +14,9 @@ Base = declarative_base()
 class ZoneRecord(Base):
 
     __tablename__ = "bind9zone_zone_records"
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        Index('ix_bind9zone_zone_records_zone_sort_key', 'namespace', 'origin', 'sort_key'),
+        {'sqlite_autoincrement': True})
 
     id = Column('id', BigInteger().with_variant(Integer, "sqlite"),
                 primary_key=True, autoincrement=True)
@@ -26,6 +27,25 @@ class ZoneRecord(Base):
     origin = Column('origin', String(), nullable=False)
     namespace = Column('namespace', String())
     fqdn = Column('fqdn', String(), index=True)
+    # DNSの正規順序で並べるためのキーです。zutils.canonical_sort_key を参照してください。
+    sort_key = Column('sort_key', String())
+    # レコードの値を解析した検索用のカラムです。zutils.rdata_columns を参照してください。
+    rdata_address = Column('rdata_address', LargeBinary(), index=True)
+    rdata_target = Column('rdata_target', String(), index=True)
+    rdata_priority = Column('rdata_priority', Integer())
+    rdata_weight = Column('rdata_weight', Integer())
+    rdata_port = Column('rdata_port', Integer())
+    # SOAレコードの値を分解したカラムです。dataと同じ内容を保持します。zutils.soa_columns を参照してください。
+    soa_mname = Column('soa_mname', String())
+    soa_rname = Column('soa_rname', String())
+    soa_serial = Column('soa_serial', BigInteger())
+    soa_refresh = Column('soa_refresh', Integer())
+    soa_retry = Column('soa_retry', Integer())
+    soa_expire = Column('soa_expire', Integer())
+    soa_minimum = Column('soa_minimum', Integer())
+    # 行のバージョンです。ORMのUPDATE/DELETEは読み込んだ時点のバージョンを条件に実行され(compare-and-swap)、
+    # 他の書き込みで変更されていた場合は StaleDataError になります。
+    version = Column('version', Integer(), nullable=False, default=1)
     created_by = Column('created_by', String())
     modified_by = Column('modified_by', String())
     created_at = Column('created_at', DateTime(timezone=False),
@@ -33,12 +53,43 @@ class ZoneRecord(Base):
     modified_at = Column('modified_at', DateTime(timezone=False),
                          default=datetime.now, onupdate=datetime.now)
 
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self, record):
         keys = record.keys()
         for c in self.__table__.columns:
             if c.name in keys:
                 setattr(self, c.name, record[c.name])
         self.fqdn = self.get_fqdn()
+        self.sort_key = self.get_sort_key()
+        self.update_rdata_columns()
+
+    @classmethod
+    def to_insert_row(cls, record, namespace=None):
+        """ パース済みレコード(ParsedRecord/dict)から、テーブルへのINSERT用のdictを作成します。
+        ORMのインスタンスを経由しませんが、各カラムの検証内容は ZoneRecord(record) と同じです。
+        namespace を指定した場合は record の namespace より優先されます。
+        """
+        if namespace is None:
+            namespace = record.get('namespace')
+        name = _validate_name(record['name'])
+        origin = _validate_origin(record['origin'])
+        row = {
+            'name': name,
+            'type': record['type'],
+            'data': _validate_data(record['data']),
+            'ttl': zutils.normalize_ttl(record['ttl']),
+            'origin': origin,
+            'namespace': _validate_namespace(namespace),
+            'fqdn': _fqdn(name, origin),
+        }
+        row['sort_key'] = zutils.canonical_sort_key(row['fqdn'], row['type'], origin)
+        row.update(zutils.rdata_columns(row['type'], row['data'], origin))
+        row.update(zutils.soa_columns(row['type'], row['data']))
+        rid = record.get('id')
+        if rid is not None:
+            row['id'] = rid
+        return row
 
     @hybrid_property
     def ttl(self):
@@ -50,31 +101,19 @@ class ZoneRecord(Base):
 
     @validates('name')
     def name_validate(self, key, name):
-        if name is None:
-            raise ValueError('name must not be NULL')
-        return name
+        return _validate_name(name)
 
     @validates('data')
     def data_validate(self, key, data):
-        if data is None:
-            raise ValueError('data must not be NULL')
-        return data
+        return _validate_data(data)
 
     @validates('origin')
     def origin_validate(self, key, origin):
-        if origin is None:
-            raise ValueError('origin must not be NULL')
-        elif origin.endswith('.') and validators.domain(origin[:-1]):
-            return origin
-        else:
-            raise ValueError(
-                'origin must be a domain string with trailing dot="."')
+        return _validate_origin(origin)
 
     @validates('namespace')
     def namespace_validate(self, key, namespace):
-        if namespace is None or validators.slug(namespace):
-            return namespace
-        raise ValueError('namespace must be a slug string')
+        return _validate_namespace(namespace)
 
     def compare(self, other):
         keys = ['name', 'type', 'data', 'ttl', 'origin', 'namespace']
@@ -83,7 +122,25 @@ class ZoneRecord(Base):
                 'ZoneRecord is not comparable with {}'.format(type(other)))
         return all([getattr(self, k) == getattr(other, k) for k in keys])
 
-    def to_record(self, origin=None, withId=True):
+    def to_record(self, origin=None, withId=True, omitName=False, omitTtl=False):
+        """ zonefileの1行に変換します。
+        omitName/omitTtl を指定すると、名前/TTLを省略した行を返します(ZoneFileのコンパクト出力用)。
+        """
+        name = '' if omitName else self.get_relative_name(origin)
+        comment = ''
+        if withId:
+            comment += ' ; meta=(id={})'.format(self.id)
+        fields = [name]
+        if not omitTtl:
+            fields.append(str(self.ttl) if self.ttl is not None else '')
+        if self.type == 'SOA':
+            fields += ['IN', self.type, self.get_soa_text()]
+        else:
+            fields += ['IN', self.type, self.data]
+        return ' '.join(fields) + comment
+
+    def get_relative_name(self, origin=None):
+        """ originからの相対名(apexの場合は"@"、origin外の場合は末尾に"."を付けたFQDN)を返します。 """
         if origin is None:
             origin = self.origin
         origin = re.sub(r'\.$', '', re.sub(r'^@\.', '', origin))
@@ -93,28 +150,29 @@ class ZoneRecord(Base):
             name = self.fqdn + '.'
         if len(name) == 0:
             name = '@'
-        comment = ''
-        if withId:
-            comment += ' ; meta=(id={})'.format(self.id)
-        ttl = self.ttl if self.ttl is not None else ''
-        if self.type == 'SOA':
-            return '{} {} IN {} {}{}'.format(name, ttl, self.type, self.get_soa_text(), comment)
-        else:
-            return '{} {} IN {} {}{}'.format(name, ttl, self.type, self.data, comment)
+        return name
 
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns if getattr(self, c.name) is not None}
 
     def get_fqdn(self):
-        if not self.name.startswith('$'):
-            if self.name.endswith('.'):
-                fqdn = self.name
-            else:
-                fqdn = self.name + '.' + self.origin
-            return re.sub(r'\.$', '', re.sub(r'^@\.', '', fqdn))
+        return _fqdn(self.name, self.origin)
+
+    def get_sort_key(self):
+        return zutils.canonical_sort_key(self.fqdn, self.type, self.origin)
+
+    def update_rdata_columns(self):
+        """ type/data から検索用のカラム(rdata_*)とSOAのカラム(soa_*)を設定し直します。 """
+        for k, v in zutils.rdata_columns(self.type, self.data, self.origin).items():
+            setattr(self, k, v)
+        for k, v in zutils.soa_columns(self.type, self.data).items():
+            setattr(self, k, v)
 
     def get_soa_params(self):
         if self.type == 'SOA':
+            if self.soa_serial is not None:
+                # 分解済みのカラムがある場合は、dataを解析しません。
+                return {k[4:]: getattr(self, k) for k in zutils.SOA_COLUMNS}
             return zutils.soa_parameters_from_data(self.data)
         else:
             raise ValueError("SOA type record only support this function.")
@@ -129,9 +187,9 @@ class ZoneRecord(Base):
     @classmethod
     def delete_origin_from_database(cls, scopedSession, origin, namespace=None):
         origin = origin.rstrip('.')
-        if not validators.domain(re.sub(r'\.$', '', origin)):
+        if not zutils.is_domain(re.sub(r'\.$', '', origin)):
             raise Exception('Invalid Origin Name, {}'.format(origin))
-        if namespace and not validators.slug(namespace):
+        if namespace and not zutils.is_slug(namespace):
             raise Exception('Invalid Namespace, {}'.format(namespace))
         originWithDot = origin + '.'
         session = scopedSession()
@@ -149,9 +207,9 @@ class ZoneRecord(Base):
     @classmethod
     def from_database(cls, scopedSession, origin, namespace=None):
         origin = origin.rstrip('.')
-        if not validators.domain(re.sub(r'\.$', '', origin)):
+        if not zutils.is_domain(re.sub(r'\.$', '', origin)):
             raise Exception('Invalid Origin Name, {}'.format(origin))
-        if namespace and not validators.slug(namespace):
+        if namespace and not zutils.is_slug(namespace):
             raise Exception('Invalid Namespace, {}'.format(namespace))
         originWithDot = origin + '.'
         session = scopedSession()
@@ -168,9 +226,9 @@ class ZoneRecord(Base):
     @classmethod
     def get_record(cls, Session, origin, namespace, name, type=None):
         origin = origin.rstrip('.')
-        if not validators.domain(re.sub(r'\.$', '', origin)):
+        if not zutils.is_domain(re.sub(r'\.$', '', origin)):
             raise Exception('Invalid Origin Name, {}'.format(origin))
-        if namespace and not validators.slug(namespace):
+        if namespace and not zutils.is_slug(namespace):
             raise Exception('Invalid Namespace, {}'.format(namespace))
         originWithDot = origin + '.'
         session = Session()
@@ -189,9 +247,9 @@ class ZoneRecord(Base):
     @classmethod
     def set_record(cls, Session, origin, namespace, name, type, values, ttl=None):
         origin = origin.rstrip('.')
-        if not validators.domain(re.sub(r'\.$', '', origin)):
+        if not zutils.is_domain(re.sub(r'\.$', '', origin)):
             raise Exception('Invalid Origin Name, {}'.format(origin))
-        if namespace and not validators.slug(namespace):
+        if namespace and not zutils.is_slug(namespace):
             raise Exception('Invalid Namespace, {}'.format(namespace))
         originWithDot = origin + '.'
         session = Session()
@@ -224,6 +282,7 @@ class ZoneRecord(Base):
                         r.data = v
                         if type == 'CNAME':
                             r.type = 'CNAME'
+                        r.update_rdata_columns()
                         if ttl is not None:
                             r.ttl = ttl
                         addList.append(r)
@@ -239,9 +298,9 @@ class ZoneRecord(Base):
     @classmethod
     def delete_record(cls, Session, origin, namespace, name, type=None):
         origin = origin.rstrip('.')
-        if not validators.domain(re.sub(r'\.$', '', origin)):
+        if not zutils.is_domain(re.sub(r'\.$', '', origin)):
             raise Exception('Invalid Origin Name, {}'.format(origin))
-        if namespace and not validators.slug(namespace):
+        if namespace and not zutils.is_slug(namespace):
             raise Exception('Invalid Namespace, {}'.format(namespace))
         originWithDot = origin + '.'
         session = Session()
@@ -263,3 +322,40 @@ class ZoneRecord(Base):
             return [r.to_dict() for r in records]
         finally:
             session.close()
+
+
+def _fqdn(name, origin):
+    if not name.startswith('$'):
+        if name.endswith('.'):
+            fqdn = name
+        else:
+            fqdn = name + '.' + origin
+        return re.sub(r'\.$', '', re.sub(r'^@\.', '', fqdn))
+
+
+def _validate_name(name):
+    if name is None:
+        raise ValueError('name must not be NULL')
+    return name
+
+
+def _validate_data(data):
+    if data is None:
+        raise ValueError('data must not be NULL')
+    return data
+
+
+def _validate_origin(origin):
+    if origin is None:
+        raise ValueError('origin must not be NULL')
+    elif origin.endswith('.') and zutils.is_domain(origin[:-1]):
+        return origin
+    else:
+        raise ValueError(
+            'origin must be a domain string with trailing dot="."')
+
+
+def _validate_namespace(namespace):
+    if namespace is None or zutils.is_slug(namespace):
+        return namespace
+    raise ValueError('namespace must be a slug string')
@@ -2,11 +2,18 @@ import sys
 import re
 import pytest
 import os
+import json
 from itertools import zip_longest
 from contextlib import contextmanager
-from io import StringIO
+from io import StringIO, BytesIO
+import gzip
+import time
+from datetime import datetime
 
+from bind9zone import ZoneRecord, ZoneFile, query
 from bind9zone.cli import Bind9ZoneCLI
+from bind9zone.rendercache import compress_zone
+from sqlalchemy import create_engine, text
 
 ZONEDIR_SRC = 'tests/input'
 ZONEDIR = 'tests/output'
@@ -68,10 +75,10 @@ def zonefile_is_same(a, b):
     return all([o == e for o, e in zip_longest(sorted(a_lines), sorted(b_lines))])
 
 
-def test_bulkpull(connection):
+def test_bulkpull(connection, zonedir):
     con = ['--connection', connection]
     zone = ['--zones', 'public/example.com,private/example.com']
-    dirs = ['--dir', ZONEDIR]
+    dirs = ['--dir', zonedir]
 
     with captured_output() as (out, err):
         code = Bind9ZoneCLI(['bulkpull', *con, *zone, *dirs, '--mkdir']).run()
@@ -79,14 +86,192 @@ def test_bulkpull(connection):
 
     assert zonefile_is_same(
         os.path.join(ZONEDIR_SRC, 'public/example.com.zone'),
-        os.path.join(ZONEDIR, 'public/example.com.zone'),
+        os.path.join(zonedir, 'public/example.com.zone'),
     )
     assert zonefile_is_same(
         os.path.join(ZONEDIR_SRC, 'private/example.com.zone'),
-        os.path.join(ZONEDIR, 'private/example.com.zone'),
+        os.path.join(zonedir, 'private/example.com.zone'),
     )
 
 
+def test_bulkpull_multiple_dirs(connection, tmp_path):
+    con = ['--connection', connection]
+    zone = ['--zones', 'public/example.com,private/example.com']
+    dirs = [str(tmp_path / d) for d in ('a', 'b', 'c', 'd')]
+    for d in dirs:
+        os.mkdir(d)
+    dir_map = tmp_path / 'dirmap'
+    dir_map.write_text('# namespace directory\npublic {}\n* {}\n'.format(dirs[2], dirs[3]))
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['bulkpull', *con, *zone, '--mkdir',
+                             '--dir', dirs[0], '--dir', dirs[1], '--dir-map', str(dir_map)]).run()
+    assert code == 0
+    for d in (dirs[0], dirs[1], dirs[3]):
+        assert zonefile_is_same(
+            os.path.join(ZONEDIR_SRC, 'private/example.com.zone'),
+            os.path.join(d, 'private/example.com.zone'))
+    assert not os.path.exists(os.path.join(dirs[2], 'private/example.com.zone'))
+    # publicは --dir と、マップファイルの"public"と"*"の行のすべてに出力されます。
+    for d in dirs:
+        assert zonefile_is_same(
+            os.path.join(ZONEDIR_SRC, 'public/example.com.zone'),
+            os.path.join(d, 'public/example.com.zone'))
+    assert not [f for f in os.listdir(os.path.join(dirs[0], 'public')) if f.startswith('.')]
+
+    # マップファイルに該当する行がないnamespaceは、標準出力には出力せずにエラーになります。
+    dir_map.write_text('public {}\n'.format(dirs[2]))
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, '--zone', 'private/example.com', '--dir-map', str(dir_map)]).run()
+    assert code == 1
+    assert out.getvalue() == ''
+
+
+def test_pullreverse(connection, tmp_path):
+    con = ['--connection', connection]
+    args = ['pullreverse', *con, '--namespaces', 'public', '--prefix', '192.0.2.0/24',
+            '--prefix', '2001:db8::/32', '--dir', str(tmp_path), '--mkdir',
+            '--nameserver', 'ns.example.com', '--email', 'admin@example.com']
+    zonefile = tmp_path / 'public' / '2.0.192.in-addr.arpa.zone'
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(args).run()
+    assert code == 0
+    records = list(ZoneFile.from_stream(StringIO(zonefile.read_text())))
+    ptr = sorted([(r.name, r.data) for r in records if r.type == 'PTR'])
+    assert ('20', 'multi.example.com.') in ptr
+    assert ('11', 'server.example.com.') in ptr
+    assert ('11', 'dns.example.com.') in ptr
+    assert (tmp_path / 'public' / '8.b.d.0.1.0.0.2.ip6.arpa.zone').exists()
+    serial = [r for r in records if r.type == 'SOA'][0].data
+
+    # 変更がない場合はファイルを書き換えません。
+    mtime = zonefile.stat().st_mtime_ns
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(args).run() == 0
+    assert zonefile.stat().st_mtime_ns == mtime
+
+    # 対象のプレフィックスのレコードが変更された場合は、シリアルを進めて書き換えます。
+    with captured_output() as (out, err):
+        Bind9ZoneCLI(['set', *con, '--zone', 'public/example.com', 'reverse', 'A', '192.0.2.150']).run()
+        assert Bind9ZoneCLI(args).run() == 0
+    records = list(ZoneFile.from_stream(StringIO(zonefile.read_text())))
+    assert ('150', 'reverse.example.com.') in [(r.name, r.data) for r in records if r.type == 'PTR']
+    assert [r for r in records if r.type == 'SOA'][0].data != serial
+    with captured_output() as (out, err):
+        Bind9ZoneCLI(['delete', *con, '--zone', 'public/example.com', 'reverse', 'A']).run()
+
+    # 逆引きzoneにできないプレフィックスは引数のエラー、重複するプレフィックスはエラー終了になります。
+    options = ['pullreverse', *con, '--namespaces', 'public', '--dir', str(tmp_path),
+               '--nameserver', 'ns.example.com', '--email', 'admin@example.com']
+    for prefix in ('192.0.2.0/23', 'bogus', '2001:db8::/30'):
+        with captured_output() as (out, err):
+            with pytest.raises(SystemExit) as e:
+                Bind9ZoneCLI([*options, '--prefix', prefix])
+        assert e.value.code == 2
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI([*options, '--prefix', '192.0.0.0/16', '--prefix', '192.0.2.0/24']).run() == 1
+
+    # A/AAAAレコードがないnamespaceや、書き出せなかったzoneがある場合は、namespaceごとの結果の最大値を返します。
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI([*options, '--prefix', '192.0.2.0/24', '--namespaces', 'public,empty',
+                             '--mkdir']).run() == 2
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI([*options, '--prefix', '192.0.2.0/24', '--namespaces', 'private']).run() == 1
+
+
+def test_bulkserial(connection):
+    con = ['--connection', connection]
+    engine = create_engine(connection)
+
+    def serials():
+        with engine.connect() as c:
+            rows = c.execute(text(
+                "SELECT namespace, soa_serial FROM bind9zone_zone_records "
+                "WHERE origin = 'example.com.' AND type = 'SOA' ORDER BY namespace"))
+            return [tuple(row) for row in rows]
+
+    before = serials()
+    assert len(before) == 2
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['bulkserial', *con, '--zones', 'public/example.com,private/example.com',
+                             '--force']).run()
+    assert code == 0
+    assert serials() == [(namespace, serial + 1) for namespace, serial in before]
+
+
+def test_journal(connection):
+    con = ['--connection', connection]
+    zone = ['--zone', 'public/example.com']
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['set', *con, *zone, 'journal', 'A', '192.0.2.1']).run() == 0
+        assert Bind9ZoneCLI(['set', *con, *zone, 'journal', 'A', '192.0.2.2']).run() == 0
+        assert Bind9ZoneCLI(['delete', *con, *zone, 'journal', 'A']).run() == 0
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['journal', *con, *zone]).run()
+    assert code == 0
+    lines = out.getvalue().strip().split('\n')
+    assert lines[0].startswith('; serial ')
+    # 最後のシリアルでは、追加して削除した値は相殺されています。
+    assert [line for line in lines if ' journal ' in line] == []
+
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['compactjournal', *con, '--zones', 'public/example.com']).run() == 1
+        assert Bind9ZoneCLI(['compactjournal', *con, '--zones', 'public/example.com', '--max-age', '0']).run() == 0
+        assert Bind9ZoneCLI(['journal', *con, *zone]).run() == 2
+
+
+def test_pullzone_as_of(connection):
+    con = ['--connection', connection]
+    zone = ['--zone', 'public/example.com']
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['snapshot', *con, '--interval', '1']).run() == 0
+        assert Bind9ZoneCLI(['pullzone', *con, *zone, '--no-meta']).run() == 0
+    current = out.getvalue()
+
+    # 変更後も、変更前の時点のzoneを出力できます。
+    time.sleep(0.01)
+    as_of = datetime.now().isoformat()
+    time.sleep(0.01)
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['set', *con, *zone, 'asof', 'A', '192.0.2.1']).run() == 0
+        assert Bind9ZoneCLI(['pullzone', *con, *zone, '--as-of', as_of]).run() == 0
+    assert out.getvalue() == current
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['delete', *con, *zone, 'asof', 'A']).run() == 0
+
+
+def test_pushzone_journal_serial(connection, session_factory, tmp_path):
+    con = ['--connection', connection]
+    origin = 'pushjournal.example.com.'
+    zone = ['--zone', 'public/' + origin]
+    zonefile = tmp_path / 'pushjournal.example.com.zone'
+    with open(os.path.join(ZONEDIR_SRC, 'public/example.com.zone'), mode='r') as reader:
+        zonefile.write_text(reader.read().replace('$ORIGIN example.com.', '$ORIGIN ' + origin))
+    serial = 2101202346
+
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['pushzone', *con, *zone, str(zonefile)]).run() == 0
+        assert Bind9ZoneCLI(['pullzone', *con, *zone, '--no-meta']).run() == 0
+    current = out.getvalue()
+
+    # pushしたレコードは、pushする前のシリアル(SOAがなかったので0)で記録されます。
+    session = session_factory()
+    changes = query.get_journal_changes(session, 'public', origin)
+    assert [c['serial'] for c in changes] == [0]
+    assert len(changes[0]['add']) == 20
+    assert query.get_journal_changes(session, 'public', origin, serial) == []
+    assert len(query.get_records_as_of(session, 'public', origin, serial)) == 20
+    session.close()
+
+    # ファイルのシリアルを指定すると、pushした内容を出力できます。
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['pullzone', *con, *zone, '--as-of', str(serial)]).run() == 0
+    assert out.getvalue() == current
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['deletezone', *con, *zone]).run() == 0
+
+
 def test_pullzone(connection):
     con = ['--connection', connection]
     zone = ['--zone', 'public/example.com']
@@ -102,6 +287,88 @@ def test_pullzone(connection):
     return all([o == e for o, e in zip_longest(sorted(src_lines), sorted(output))])
 
 
+def test_pullzone_compact(connection):
+    con = ['--connection', connection]
+    zone = ['--zone', 'public/example.com']
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, *zone]).run()
+    assert code == 0
+    full = out.getvalue()
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, *zone, '--compact', '--no-meta']).run()
+    assert code == 0
+    compact = out.getvalue()
+
+    assert len(compact) < len(full)
+    assert 'meta=' not in compact
+    expect = [ZoneRecord({**r, 'namespace': 'public'}).to_record(withId=False)
+              for r in ZoneFile.from_stream(StringIO(full))]
+    output = [ZoneRecord({**r, 'namespace': 'public'}).to_record(withId=False)
+              for r in ZoneFile.from_stream(StringIO(compact))]
+    assert sorted(output) == sorted(expect)
+
+
+def test_pullzone_render_cache(connection):
+    con = ['--connection', connection]
+    zone = ['--zone', 'public/example.com']
+    engine = create_engine(connection)
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, *zone]).run()
+    assert code == 0
+    expect = out.getvalue()
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, *zone, '--render-cache']).run()
+    assert code == 0
+    assert out.getvalue() == expect
+    rows = engine.execute('SELECT generation, content FROM bind9zone_rendered_zones').fetchall()
+    assert len(rows) == 1
+
+    # キャッシュのみを書き換えて、キャッシュから出力されることを確認します。
+    compressed, digest = compress_zone(b'cached\n')
+    engine.execute(text('UPDATE bind9zone_rendered_zones SET content = :content'), content=compressed)
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pullzone', *con, *zone, '--render-cache']).run()
+    assert out.getvalue() == 'cached\n'
+
+    # レコードを変更すると世代番号が進み、キャッシュは使用されなくなります。
+    with captured_output() as (out, err):
+        Bind9ZoneCLI(['set', *con, *zone, 'cached', 'A', '192.0.2.99']).run()
+        code = Bind9ZoneCLI(['pullzone', *con, *zone, '--render-cache']).run()
+    assert code == 0
+    assert 'cached 60 IN A 192.0.2.99' in out.getvalue()
+    with captured_output() as (out, err):
+        Bind9ZoneCLI(['delete', *con, *zone, 'cached', 'A']).run()
+
+
+def test_render_cache_env(monkeypatch):
+    args = ['pullzone', '--zone', 'public/example.com']
+    for value, expected in [('1', True), ('true', True), ('YES', True), ('0', False), ('false', False), ('', False)]:
+        monkeypatch.setenv('RENDER_CACHE', value)
+        assert Bind9ZoneCLI(args).args['render_cache'] is expected
+
+
+def test_bulkpush_bulk_load(connection):
+    con = ['--connection', connection]
+    zones = ['--zones', 'public/example.com,private/example.com']
+    engine = create_engine(connection)
+
+    def counts():
+        rows = engine.execute(text(
+            "SELECT namespace, COUNT(*) FROM bind9zone_zone_records "
+            "WHERE origin = 'example.com.' GROUP BY namespace ORDER BY namespace"))
+        return [tuple(row) for row in rows]
+
+    before = counts()
+    with captured_output() as (out, err):
+        assert Bind9ZoneCLI(['deletezone', *con, *zones]).run() == 0
+        code = Bind9ZoneCLI(['bulkpush', *con, *zones, '--dir', ZONEDIR_SRC, '--bulk-load']).run()
+    assert code == 0
+    assert counts() == before
+
+
 def test_delete_and_pushzone(connection):
     con = ['--connection', connection]
     zone = ['--zone', 'public/example.com']
@@ -129,3 +396,103 @@ def test_delete_and_pushzone(connection):
     with open(os.path.join(ZONEDIR_SRC, 'public/example.com.zone'), mode='r') as reader:
         expect = normalize_zonefile(reader)
     return all([o == e for o, e in zip_longest(sorted(expect), sorted(output))])
+
+
+def test_bulkpush_with_cache(connection, tmp_path):
+    con = ['--connection', connection]
+    zone = ['--zones', 'private/example.com']
+    cache = ['--cache-dir', str(tmp_path / 'cache')]
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['deletezone', *con, *zone]).run()
+    assert code == 0
+
+    # 1回目はパースしてキャッシュを作成し、DBへ登録します。
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['bulkpush', *con, *zone, '--dir', ZONEDIR_SRC, *cache]).run()
+    assert code == 0
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 2
+
+    # 2回目はキャッシュヒットし、DBの内容も同一のためpushされません(レコードは重複しません)。
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['bulkpush', *con, *zone, '--dir', ZONEDIR_SRC, *cache]).run()
+    assert code == 0
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['get', *con, '--zone', 'private/example.com', 'multi', 'A']).run()
+    assert code == 0
+    assert len(normalize_zonefile(out.getvalue().strip().split('\n'))) == 3
+
+
+def test_pushzone_compressed_and_stdin(connection, tmp_path, monkeypatch):
+    con = ['--connection', connection]
+    zone = ['--zone', 'private/example.com']
+    with open(os.path.join(ZONEDIR_SRC, 'private/example.com.zone'), mode='rb') as reader:
+        zonebytes = reader.read()
+    zonefile = str(tmp_path / 'example.com.zone.gz')
+    with open(zonefile, mode='wb') as output:
+        output.write(gzip.compress(zonebytes))
+
+    class Stdin(object):
+        buffer = BytesIO(zonebytes)
+
+        def isatty(self):
+            return False
+
+    for args in ([zonefile], ['-']):
+        with captured_output() as (out, err):
+            code = Bind9ZoneCLI(['deletezone', *con, '--zones', 'private/example.com']).run()
+        assert code == 0
+        monkeypatch.setattr(sys, 'stdin', Stdin())
+        with captured_output() as (out, err):
+            code = Bind9ZoneCLI(['pushzone', *con, *zone, *args]).run()
+        assert code == 0
+
+        with captured_output() as (out, err):
+            code = Bind9ZoneCLI(['get', *con, *zone, 'multi', 'A']).run()
+        assert code == 0
+        assert len(normalize_zonefile(out.getvalue().strip().split('\n'))) == 3
+
+
+def test_pushzone_tolerant(connection, tmp_path):
+    con = ['--connection', connection]
+    zone = ['--zone', 'private/example.jp']
+    zonefile = str(tmp_path / 'example.jp.zone')
+    report = str(tmp_path / 'report.json')
+    with open(zonefile, mode='w') as output:
+        output.write('\n'.join([
+            '$ORIGIN example.jp.',
+            '$TTL 600',
+            'www 60 IN A 192.0.2.1',
+            'broken line',
+            'mail 60 IN A 192.0.2.2',
+        ]) + '\n')
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pushzone', *con, *zone, zonefile,
+                             '--max-errors', '0', '--error-report', report]).run()
+    assert code == 4
+    with open(report) as reader:
+        result = json.load(reader)
+    assert result['total'] == 1
+    assert result['errors'][0] == {
+        'file': zonefile, 'namespace': 'private', 'origin': 'example.jp',
+        'line': 4, 'text': 'broken line', 'reason': 'Unrecognized line'}
+
+    # 閾値内のエラーであれば成功扱いになり、有効な行は登録されています。
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['deletezone', *con, '--zones', 'private/example.jp']).run()
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pushzone', *con, *zone, zonefile, '--max-errors', '1']).run()
+    assert code == 0
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['get', *con, *zone, 'mail', 'A']).run()
+    assert code == 0
+
+    # --max-errors を指定しない場合は、上限なしの寛容モードでレポートを出力します。
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['pushzone', *con, *zone, zonefile, '--error-report', report]).run()
+    assert code == 0
+    with open(report) as reader:
+        result = json.load(reader)
+    assert result['total'] == 1 and result['max_errors'] is None
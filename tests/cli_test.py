@@ -1,5 +1,6 @@
 import sys
 import re
+import pytest
 import itertools
 from contextlib import contextmanager
 from io import StringIO
@@ -278,3 +279,39 @@ def test_delete_mixedrecord(connection):
     assert code == 2
     assert all([o == e for o, e in itertools.zip_longest(
         sorted(output), sorted(expect))])
+
+
+def test_search(connection):
+    con = ['--connection', connection]
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['search', *con, '--address', '192.0.2.20/31']).run()
+    assert code == 0
+    assert [re.sub(r' *; .*$', '', line) for line in out.getvalue().strip().split('\n')] == [
+        'public/example.com. multi 60 IN A 192.0.2.20',
+        'public/example.com. multi 60 IN A 192.0.2.21']
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['search', *con, '--namespace', 'private',
+                             '--target', 'SERVER.example.com.']).run()
+    assert code == 0
+    assert sorted([re.sub(r' *; .*$', '', line) for line in out.getvalue().strip().split('\n')]) == [
+        'private/example.com. @ 60 IN MX 10 server',
+        'private/example.com. alias 60 IN CNAME server',
+        'private/example.com. fqdn1 60 IN CNAME server.example.com.']
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['search', *con, '--address', '2001:db8::/32']).run()
+    assert code == 0
+    assert 'public/example.com. mixed 60 IN AAAA 2001:0DB8::2:1' in [
+        re.sub(r' *; .*$', '', line) for line in out.getvalue().strip().split('\n')]
+
+    with captured_output() as (out, err):
+        code = Bind9ZoneCLI(['search', *con, '--address', '198.51.100.1']).run()
+    assert code == 2
+
+    # アドレスとして解釈できない値は、引数のエラーになります。
+    with captured_output() as (out, err):
+        with pytest.raises(SystemExit) as e:
+            Bind9ZoneCLI(['search', *con, '--address', 'not-an-ip'])
+    assert e.value.code == 2
@@ -4,15 +4,24 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 from bind9zone.cli import Bind9ZoneCLI
 
 ZONEDIR_SRC = 'tests/input'
-ZONEDIR = 'tests/output'
+
+
+POSTGRES_CONNECTION = 'postgresql://postgres:postgres@db/database'
 
 
 def get_connection_fixture_params():
     if os.getenv('TEST_POSTGRES'):
-        return ['sqlite:///tests/db.sqlite3',
-                'postgresql://postgres:postgres@db/database']
+        return ['sqlite', 'postgresql']
     else:
-        return ['sqlite:///tests/db.sqlite3']
+        return ['sqlite']
+
+
+def get_connection_string(param, tmp_path_factory):
+    if param == 'postgresql':
+        return POSTGRES_CONNECTION
+    # SQLiteのDBファイルと、zoneのロックファイルのディレクトリ({DBファイル}.locks/)は、
+    # リポジトリ内に残らないようpytestの一時ディレクトリに作成します。
+    return 'sqlite:///{}'.format(tmp_path_factory.getbasetemp() / 'db.sqlite3')
 
 
 @pytest.fixture()
@@ -21,18 +30,19 @@ def zonedir_src():
 
 
 @pytest.fixture()
-def zonedir():
-    return ZONEDIR
+def zonedir(tmp_path):
+    """ zoneファイルの出力先です。出力したファイルがリポジトリ内に残らないよう、テストごとの一時ディレクトリを返します。 """
+    return str(tmp_path)
 
 
 @pytest.fixture(scope='module', params=get_connection_fixture_params())
-def connection(request):
+def connection(request, tmp_path_factory):
     """ pytest対象モジュールの引数に"connection"を指定すると、
     このfixtureが実行され、データベースの初期化を行った上でconnection文字列を返します。
     1つのモジュール内(pyファイル)から複数回使用された場合でも、データベースの初期化処理が
     行われるのは各モジュールあたり最初の一回だけです。
     """
-    connection = request.param
+    connection = get_connection_string(request.param, tmp_path_factory)
     con = ['--connection', connection]
     Bind9ZoneCLI(['init', *con, '--drop']).run()
     Bind9ZoneCLI(['bulkpush', *con,
@@ -52,5 +62,8 @@ def session_factory(connection):
     engine = create_engine(connection)
     session_factory = sessionmaker(bind=engine)
     Session = scoped_session(session_factory)
-    return Session
+    yield Session
+    # PostgreSQLでは、トランザクションが残っていると次のモジュールの init --drop が待たされます。
+    Session.remove()
+    engine.dispose()
 
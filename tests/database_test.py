@@ -0,0 +1,199 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import text, MetaData, Table, Column
+from sqlalchemy.types import DateTime, String, Integer
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from bind9zone import database, query, ParsedRecord, ZoneRecord
+from bind9zone.zonerecord import Base
+from bind9zone.cli import Bind9ZoneCLI
+
+
+def test_engine_registry(connection):
+    engine = database.get_engine(connection)
+    assert database.get_engine(connection) is engine
+    if connection.startswith('sqlite:///'):
+        assert isinstance(engine.pool, QueuePool)
+
+    # CLIのハンドラも同じEngineを使用し、終了後はSessionを閉じて接続をプールに返します。
+    code = Bind9ZoneCLI(['get', '--connection', connection, '--zone', 'public/example.com', 'www', 'A']).run()
+    assert code in (0, 2)
+    assert database.get_engine(connection) is engine
+    assert engine.pool.checkedout() == 0
+
+    with database.session_scope(connection) as session:
+        session.execute('SELECT 1')
+        assert engine.pool.checkedout() == 1
+    assert engine.pool.checkedout() == 0
+
+
+def test_engine_options(monkeypatch):
+    monkeypatch.setenv('DB_POOL_SIZE', '2')
+    monkeypatch.setenv('DB_POOL_RECYCLE', '300')
+    monkeypatch.setenv('DB_POOL_PRE_PING', '1')
+    options = database.engine_options('postgresql://user@localhost/db')
+    assert options['pool_size'] == 2
+    assert options['pool_recycle'] == 300
+    assert options['pool_pre_ping'] is True
+    assert 'pool_size' not in database.engine_options('sqlite://')
+    # 0/false 等は無効です。
+    for value in ('0', 'false', 'no', ''):
+        monkeypatch.setenv('DB_POOL_PRE_PING', value)
+        assert database.engine_options('postgresql://user@localhost/db')['pool_pre_ping'] is False
+
+
+def test_readonly_session(connection):
+    with database.session_scope(connection, readonly=True) as session:
+        records = query.get_records(session, namespace='public', origin='example.com.')
+        assert records
+        with pytest.raises(DBAPIError):
+            session.execute(text("UPDATE bind9zone_zone_records SET ttl = 1 WHERE id = :id"),
+                            {'id': records[0].id})
+
+    # 読み込み専用の設定は、プールに戻した接続には残りません。
+    with database.session_scope(connection) as session:
+        assert query.get_generation(session, 'public', 'readonly.example.com.') == 0
+        query.set_records(session, origin='readonly.example.com.', namespace='public',
+                          name='www', type='A', data='192.0.2.1')
+        query.delete_records(session, origin='readonly.example.com.', namespace='public')
+
+
+def test_bulk_load_scope(connection):
+    origin = 'bulkload.example.com.'
+    with pytest.raises(RuntimeError):
+        with database.bulk_load_scope(connection) as session:
+            query.insert_records(session, 'public', [ParsedRecord('www', '60', 'IN', 'A', '192.0.2.1', origin)],
+                                 commit=False)
+            raise RuntimeError('abort')
+    # 例外が発生した場合は、すべての変更がロールバックされます。
+    with database.session_scope(connection) as session:
+        assert query.get_records(session, namespace='public', origin=origin) == []
+
+    with database.bulk_load_scope(connection) as session:
+        query.insert_records(session, 'public', [ParsedRecord('www', '60', 'IN', 'A', '192.0.2.1', origin)],
+                             commit=False)
+    with database.session_scope(connection) as session:
+        assert [r.data for r in query.get_records(session, namespace='public', origin=origin)] == ['192.0.2.1']
+        if connection.startswith('sqlite'):
+            # 緩めた設定はプールに戻した接続には残りません(デフォルトは FULL=2)。
+            assert session.execute('PRAGMA synchronous').scalar() == 2
+        query.delete_records(session, origin=origin, namespace='public')
+
+
+def test_sqlite_profile(monkeypatch, tmp_path):
+    monkeypatch.setenv('SQLITE_PROFILE', 'performance')
+    connection = 'sqlite:///{}'.format(tmp_path / 'profile.sqlite3')
+    try:
+        with database.session_scope(connection) as session:
+            assert session.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert session.execute('PRAGMA synchronous').scalar() == 1
+            assert session.execute('PRAGMA busy_timeout').scalar() == 5000
+    finally:
+        database.dispose_engines()
+
+
+def test_read_session_failover(connection, tmp_path):
+    broken = 'sqlite:///{}'.format(tmp_path / 'missing' / 'replica.sqlite3')
+    replica = 'sqlite:///{}'.format(tmp_path / 'replica.sqlite3')
+    try:
+        assert Bind9ZoneCLI(['init', '--connection', replica]).run() == 0
+        assert Bind9ZoneCLI(['set', '--connection', replica, '--zone', 'public/replica.example.com',
+                             'www', 'A', '192.0.2.1']).run() == 0
+
+        # 接続できないレプリカは読み飛ばされ、すべて失敗した場合はプライマリが使用されます。
+        for _ in range(3):
+            session = database.get_read_session(connection, ','.join([broken, replica]))
+            assert session.get_bind() is database.get_engine(replica)
+        assert database.get_read_session(connection, [broken]).get_bind() is database.get_engine(connection)
+        assert database.get_read_session(connection, None).get_bind() is database.get_engine(connection)
+        database.remove_sessions()
+
+        # 読み込みのみのコマンドはレプリカから取得します。
+        args = ['get', '--connection', connection, '--zone', 'public/replica.example.com', 'www', 'A']
+        assert Bind9ZoneCLI(args).run() == 2
+        assert Bind9ZoneCLI([*args, '--read-connection', ','.join([broken, replica])]).run() == 0
+    finally:
+        database.dispose_engines()
+
+
+def test_zone_locks(connection):
+    holder = database.get_engine(connection)
+    with database.session_scope(connection) as session:
+        other = sessionmaker(bind=holder)()
+        try:
+            before = database.lock_stats()
+            with database.zone_locks(session, [('public', 'lock.example.com.')]):
+                # 同じzoneは待たされ、異なるzoneは待たずにロックできます。
+                with pytest.raises(database.LockTimeoutError):
+                    with database.zone_locks(other, [('public', 'lock.example.com.')], timeout=0.1):
+                        pass
+                with database.zone_locks(other, [('private', 'lock.example.com.')], timeout=0.1):
+                    pass
+                other.rollback()
+
+                if connection.startswith('postgresql'):
+                    # ロックのタイムアウト以外のエラー(ここではstatement_timeout)は LockTimeoutError になりません。
+                    other.execute("SET LOCAL statement_timeout = '100ms'")
+                    with pytest.raises(OperationalError) as e:
+                        with database.zone_locks(other, [('public', 'lock.example.com.')]):
+                            pass
+                    assert e.value.orig.pgcode == '57014'
+                    other.rollback()
+
+                if connection.startswith('sqlite'):
+                    args = ['deletezone', '--connection', connection, '--zones', 'public/lock.example.com',
+                            '--lock-timeout', '0.1']
+                    assert Bind9ZoneCLI(args).run() == 1
+            session.commit()
+            stats = database.lock_stats()
+            assert stats['acquired'] - before['acquired'] >= 2
+            assert stats['timeouts'] - before['timeouts'] >= 1
+            assert stats['wait_max'] >= 0.1
+        finally:
+            other.close()
+
+
+def test_upgrade(connection, zonedir_src):
+    con = ['--connection', connection]
+    engine = database.get_engine(connection)
+    # 以前のバージョンのテーブル(sort_key/rdata_*/soa_*/versionカラムと、関連するテーブルがない)を作成します。
+    legacy = Table(ZoneRecord.__tablename__, MetaData(),
+                   Column('id', Integer(), primary_key=True, autoincrement=True),
+                   Column('name', String(), nullable=False), Column('type', String()),
+                   Column('data', String(), nullable=False), Column('ttl', Integer()),
+                   Column('origin', String(), nullable=False), Column('namespace', String()),
+                   Column('fqdn', String(), index=True),
+                   Column('created_by', String()), Column('modified_by', String()),
+                   Column('created_at', DateTime()), Column('modified_at', DateTime()))
+    origin = 'upgrade.example.com.'
+    now = datetime.now()
+    try:
+        for table in reversed(Base.metadata.sorted_tables):
+            table.drop(engine, checkfirst=True)
+        legacy.create(engine)
+        engine.execute(legacy.insert(), [
+            {'name': '@', 'type': 'SOA', 'data': 'ns.example.com. admin.example.com. ( 100 600 600 604800 60 )',
+             'ttl': None, 'origin': origin, 'namespace': 'public', 'fqdn': 'upgrade.example.com',
+             'created_at': now, 'modified_at': now},
+            {'name': 'www', 'type': 'A', 'data': '192.0.2.1', 'ttl': 60, 'origin': origin, 'namespace': 'public',
+             'fqdn': 'www.upgrade.example.com', 'created_at': now, 'modified_at': now},
+        ])
+        assert Bind9ZoneCLI(['init', *con]).run() == 3
+        assert Bind9ZoneCLI(['upgrade', *con]).run() == 0
+        # 2回目は変更するものがありません。
+        assert database.upgrade_tables(engine, Base.metadata.sorted_tables) == []
+
+        with database.session_scope(connection) as session:
+            records = {r.type: r for r in query.get_records(session, namespace='public', origin=origin)}
+            assert records['SOA'].soa_serial == 100 and records['SOA'].sort_key.startswith('0')
+            assert records['A'].rdata_address == bytes([192, 0, 2, 1])
+            assert [r.version for r in records.values()] == [1, 1]
+            # 以前のSOAも分解済みのカラムでシリアルを更新できます。
+            assert query.update_serial(session, origin, 'public', force=True)[0]['soa_serial'] == 101
+            query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+            assert [r.version for r in query.get_records(session, 'public', origin, name='www')] == [2]
+    finally:
+        Bind9ZoneCLI(['init', *con, '--drop']).run()
+        Bind9ZoneCLI(['bulkpush', *con, '--dir', zonedir_src,
+                      '--zones', 'public/example.com,private/example.com']).run()
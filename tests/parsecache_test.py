@@ -0,0 +1,74 @@
+import os
+import shutil
+from io import StringIO
+from bind9zone import ZoneFile
+from bind9zone.parsecache import ParseCache, DigestReader, file_identity
+from bind9zone.zoneio import open_zone_reader
+
+
+def parse(zonefile, origin='example.com.'):
+    with open(zonefile, mode='r') as reader:
+        return list(ZoneFile.from_stream(StringIO(reader.read()), origin=origin))
+
+
+def test_parsecache_hit_and_invalidate(zonedir_src, tmp_path):
+    zonefile = str(tmp_path / 'example.com.zone')
+    shutil.copy(os.path.join(zonedir_src, 'public/example.com.zone'), zonefile)
+    cache = ParseCache(str(tmp_path / 'cache'))
+    assert cache.get(zonefile, 'example.com.') is None
+
+    identity = file_identity(zonefile)
+    records = parse(zonefile)
+    cache.put(zonefile, 'example.com.', records, identity)
+    assert cache.get(zonefile, 'example.com.') == records
+    # originが異なる場合は別エントリです。
+    assert cache.get(zonefile, 'example.jp.') is None
+    # 別インスタンスからもインデックスを読み込めます。
+    assert ParseCache(str(tmp_path / 'cache')).get(zonefile, 'example.com.') == records
+
+    # mtimeのみの変更(内容は同一)はキャッシュヒットになります。
+    st = os.stat(zonefile)
+    os.utime(zonefile, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    assert cache.get(zonefile, 'example.com.') == records
+
+    # 内容が変更された場合はミスになります。
+    with open(zonefile, mode='a') as output:
+        output.write('added 60 IN A 192.0.2.99\n')
+    assert cache.get(zonefile, 'example.com.') is None
+
+
+def test_parsecache_lru_eviction(zonedir_src, tmp_path):
+    cache = ParseCache(str(tmp_path / 'cache'))
+    zonefiles = []
+    for i in range(3):
+        zonefile = str(tmp_path / 'example{}.com.zone'.format(i))
+        shutil.copy(os.path.join(zonedir_src, 'public/example.com.zone'), zonefile)
+        cache.put(zonefile, 'example.com.', parse(zonefile), file_identity(zonefile))
+        zonefiles.append(zonefile)
+    entry_size = cache.total_bytes // 3
+
+    # 0番目にアクセスして最近使用したことにした上で、2エントリ分に制限します。
+    assert cache.get(zonefiles[0], 'example.com.') is not None
+    cache.max_bytes = entry_size * 2
+    cache.put(zonefiles[2], 'example.com.', parse(zonefiles[2]), file_identity(zonefiles[2]))
+    assert cache.total_bytes <= entry_size * 2
+    assert cache.get(zonefiles[0], 'example.com.') is not None
+    assert cache.get(zonefiles[1], 'example.com.') is None
+    assert cache.get(zonefiles[2], 'example.com.') is not None
+
+
+def test_parsecache_changed_while_parsing(zonedir_src, tmp_path):
+    zonefile = str(tmp_path / 'example.com.zone')
+    shutil.copy(os.path.join(zonedir_src, 'public/example.com.zone'), zonefile)
+    with DigestReader(zonefile) as source, open_zone_reader(source) as reader:
+        records = list(ZoneFile.from_stream(reader, origin='example.com.'))
+        identity = source.identity()
+    assert identity == file_identity(zonefile)
+    assert records == parse(zonefile)
+
+    # パース中にファイルが変更された場合は、キャッシュできる値を返しません。
+    with DigestReader(zonefile) as source, open_zone_reader(source) as reader:
+        records = list(ZoneFile.from_stream(reader, origin='example.com.'))
+        with open(zonefile, mode='a') as output:
+            output.write('added 60 IN A 192.0.2.99\n')
+        assert source.identity() is None
@@ -0,0 +1,32 @@
+from datetime import datetime
+from bind9zone import pgcopy
+from bind9zone.pgcopy import _LineReader
+
+
+def test_format_copy_value():
+    assert pgcopy.format_copy_value(None) == '\\N'
+    assert pgcopy.format_copy_value(60) == '60'
+    assert pgcopy.format_copy_value('"a\\"b" c\td\r\ne') == '"a\\\\"b" c\\td\\r\\ne'
+    assert pgcopy.format_copy_value('\\N') == '\\\\N'
+    assert pgcopy.format_copy_value(bytes([192, 0, 2, 1])) == '\\\\xc0000201'
+    assert pgcopy.format_copy_value(datetime(2020, 1, 2, 3, 4, 5)) == '2020-01-02 03:04:05'
+    assert pgcopy.format_copy_row(['www', None, 1]) == 'www\t\\N\t1\n'
+
+
+def test_line_reader():
+    lines = ['line{}\n'.format(i) for i in range(100)]
+    reader = _LineReader(iter(lines))
+    chunks = []
+    while True:
+        chunk = reader.read(7)
+        if not chunk:
+            break
+        assert len(chunk) <= 7
+        chunks.append(chunk)
+    assert ''.join(chunks) == ''.join(lines)
+    assert _LineReader(iter(lines)).read() == ''.join(lines)
+
+
+def test_is_copy_supported(session_factory):
+    session = session_factory()
+    assert pgcopy.is_copy_supported(session) == (session.get_bind().dialect.name == 'postgresql')
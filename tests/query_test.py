@@ -3,7 +3,12 @@ query.pyに対する編集を伴うテスト項目です。
 """
 
 import time
-from bind9zone import query
+import threading
+import pytest
+from datetime import datetime
+from sqlalchemy.orm.exc import StaleDataError
+from bind9zone import query, ParsedRecord, ZoneRecord
+from bind9zone import utils as zutils
 
 
 def test_set_records(session_factory):
@@ -150,3 +155,280 @@ def test_update_serial(session_factory):
                                 namespace='public', origin='third.example.com.', name='@', type='SOA')
     assert [r.data for r in records] == [
         'ns.example.com. admin.example.com. ( 100 3600 1200 604800 600 )']
+
+
+def test_insert_records(session_factory):
+    session = session_factory()
+    records = [
+        ParsedRecord('bulk{}'.format(i), '60', 'IN', 'A', '192.0.2.{}'.format(i), 'bulk.example.com.')
+        for i in range(1, 6)]
+    count = query.insert_records(session, 'public', iter(records), batch_size=2)
+    assert count == 5
+    records = query.get_records(session, namespace='public', origin='bulk.example.com.')
+    assert sorted([(r.name, r.ttl, r.fqdn) for r in records]) == [
+        ('bulk{}'.format(i), 60, 'bulk{}.bulk.example.com'.format(i)) for i in range(1, 6)]
+    assert all([r.created_at is not None for r in records])
+
+
+def test_zone_generation(session_factory):
+    session = session_factory()
+    origin = 'generation.example.com.'
+    assert query.get_generation(session, 'public', origin) == 0
+    query.insert_records(session, 'public', [ParsedRecord('www', '60', 'IN', 'A', '192.0.2.1', origin)])
+    assert query.get_generation(session, 'public', origin) == 1
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+    assert query.get_generation(session, 'public', origin) == 2
+
+    # 世代番号が一致する場合のみキャッシュが返ります。
+    assert query.put_rendered_zone(session, 'public', origin, 'text', 2, b'zone', 'digest')
+    assert query.get_rendered_zone(session, 'public', origin, 'text') == b'zone'
+    assert not query.put_rendered_zone(session, 'public', origin, 'text', 1, b'stale', 'digest')
+    query.delete_records(session, origin=origin, namespace='public')
+    assert query.get_generation(session, 'public', origin) == 3
+    assert query.get_rendered_zone(session, 'public', origin, 'text') is None
+
+
+def test_zone_generation_concurrent(session_factory):
+    # 同じzoneの最初の変更が同時に行われても、主キーの重複エラーにならず、両方の変更が加算されます。
+    origin = 'generation-race.example.com.'
+    first, second = session_factory.session_factory(), session_factory.session_factory()
+    errors = []
+
+    def bump():
+        try:
+            query.bump_generation(second, 'public', origin)
+            second.commit()
+        except Exception as e:
+            errors.append(e)
+            second.rollback()
+
+    try:
+        query.bump_generation(first, 'public', origin)
+        thread = threading.Thread(target=bump)
+        thread.start()
+        time.sleep(0.2)
+        first.commit()
+        thread.join()
+        assert errors == []
+        assert query.get_generation(first, 'public', origin) == 2
+    finally:
+        first.close()
+        second.close()
+
+
+def test_find_by_address_and_target(session_factory):
+    session = session_factory()
+    origin = 'search.example.com.'
+    query.insert_records(session, 'public', [
+        ParsedRecord('host1', '60', 'IN', 'A', '198.51.100.1', origin),
+        ParsedRecord('host2', '60', 'IN', 'A', '198.51.100.130', origin),
+        ParsedRecord('host3', '60', 'IN', 'AAAA', '2001:db8:1::1', origin),
+        ParsedRecord('@', '60', 'IN', 'MX', '10 Host1', origin),
+        ParsedRecord('_sip._tcp', '60', 'IN', 'SRV', '10 20 5060 host1.search.example.com.', origin),
+    ])
+    assert [r.name for r in query.find_by_address(session, '198.51.100.1')] == ['host1']
+    assert [r.name for r in query.find_by_address(session, '198.51.100.0/24', namespace='public')] == [
+        'host1', 'host2']
+    assert [r.name for r in query.find_by_address(session, '198.51.100.128/25')] == ['host2']
+    assert [r.name for r in query.find_by_address(session, '2001:db8:1::/48')] == ['host3']
+
+    records = query.find_by_target(session, 'host1.search.example.com')
+    assert sorted([(r.type, r.rdata_priority, r.rdata_port) for r in records]) == [
+        ('MX', 10, None), ('SRV', 10, 5060)]
+    assert [r.type for r in query.find_by_target(session, 'HOST1.search.example.com.', type='SRV')] == ['SRV']
+
+    # 値を変更すると検索用のカラムも更新されます。
+    query.set_records(session, origin=origin, namespace='public', name='host1', type='A', data='203.0.113.1')
+    assert query.find_by_address(session, '198.51.100.1') == []
+    assert [r.name for r in query.find_by_address(session, '203.0.113.1')] == ['host1']
+
+
+def test_soa_columns(session_factory):
+    session = session_factory()
+    origin = 'soacolumns.example.com.'
+    query.set_soa_records(session, namespace='public', origin=origin,
+                          nameserver='ns.example.com', email='admin@example.com', serial=2020010100)
+    records = query.get_records(session, namespace='public', origin=origin, type='SOA')
+    assert [(r.soa_mname, r.soa_rname, r.soa_serial, r.soa_minimum) for r in records] == [
+        ('ns.example.com.', 'admin.example.com.', 2020010100, 600)]
+
+    # 既存のSOAを変更した場合も、dataと分解済みのカラムが一致します。
+    query.set_soa_records(session, namespace='public', origin=origin,
+                          nameserver='ns2.example.com', email='admin@example.com', refresh=7200)
+    records = query.get_records(session, namespace='public', origin=origin, type='SOA')
+    assert [r.data for r in records] == ['ns2.example.com. admin.example.com. ( 2020010100 7200 1200 604800 600 )']
+    assert [(r.soa_mname, r.soa_refresh) for r in records] == [('ns2.example.com.', 7200)]
+
+    # シリアルの更新はSQL上で行われ、dataも組み立て直されます。
+    query.update_serial(session, namespace='public', origin=origin, force=True)
+    records = query.get_records(session, namespace='public', origin=origin, type='SOA')
+    assert [r.data for r in records] == ['ns2.example.com. admin.example.com. ( 2020010101 7200 1200 604800 600 )']
+    assert [r.soa_serial for r in records] == [2020010101]
+    assert records[0].get_soa_text() == records[0].data
+
+
+def test_update_serials(session_factory):
+    session = session_factory()
+    zones = [('public', 'bulk1.example.com.'), ('public', 'bulk2.example.com.')]
+    for namespace, origin in zones:
+        query.set_soa_records(session, namespace=namespace, origin=origin,
+                              nameserver='ns.example.com', email='admin@example.com', serial=10)
+    time.sleep(0.1)
+    query.set_record(session, 'bulk1.example.com.', 'public', 'www', 'A', '192.0.2.1')
+    generation = query.get_generation(session, 'public', 'bulk1.example.com.')
+
+    # SOAより後に変更されたzoneのみ更新されます。
+    assert query.update_serials(session, zones) == [('public', 'bulk1.example.com.', 11)]
+    assert query.update_serials(session, zones) == []
+    assert query.get_generation(session, 'public', 'bulk1.example.com.') == generation + 1
+    records = query.get_records(session, namespace='public', origin='bulk1.example.com.', type='SOA')
+    assert [r.data for r in records] == ['ns.example.com. admin.example.com. ( 11 3600 1200 604800 600 )']
+
+    base = zutils.date_serial_base()
+    assert query.update_serials(session, zones, force=True, date_serial=True) == [
+        ('public', 'bulk1.example.com.', base), ('public', 'bulk2.example.com.', base)]
+    assert query.update_serials(session, zones[1:], force=True, date_serial=True) == [
+        ('public', 'bulk2.example.com.', base + 1)]
+
+
+def test_insert_records_escaping(session_factory):
+    # PostgreSQLではCOPYで登録されるため、エスケープが必要な値と、idを指定したレコードを含めます。
+    session = session_factory()
+    origin = 'escape.example.com.'
+    records = [
+        ParsedRecord('txt', '60', 'IN', 'TXT', '"a\\"b\\\\c" "tab\there"', origin),
+        ParsedRecord('www', '60', 'IN', 'A', '192.0.2.1', origin, 900001),
+        ParsedRecord('www', '60', 'IN', 'A', '192.0.2.2', origin),
+    ]
+    assert query.insert_records(session, 'public', records) == 3
+    records = query.get_records(session, namespace='public', origin=origin)
+    assert sorted([(r.name, r.data) for r in records]) == [
+        ('txt', '"a\\"b\\\\c" "tab\there"'), ('www', '192.0.2.1'), ('www', '192.0.2.2')]
+    assert [r.id for r in records if r.data == '192.0.2.1'] == [900001]
+    assert [r.rdata_address for r in records if r.data == '192.0.2.2'] == [bytes([192, 0, 2, 2])]
+    assert all([r.created_at is not None for r in records])
+    query.delete_records(session, origin=origin, namespace='public')
+
+
+def test_journal(session_factory):
+    session = session_factory()
+    origin = 'journal.example.com.'
+    query.set_soa_records(session, namespace='public', origin=origin,
+                          nameserver='ns.example.com', email='admin@example.com', serial=100)
+    query.insert_records(session, 'public', [ParsedRecord('www', '60', 'IN', 'A', '192.0.2.1', origin)])
+    query.update_serial(session, origin, 'public', force=True)
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A',
+                      data=['192.0.2.2', '192.0.2.3'])
+    query.delete_records(session, origin=origin, namespace='public', name='www', type='A')
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+
+    def ops(change):
+        return ([e.to_record() for e in change['del']], [e.to_record() for e in change['add']])
+
+    changes = query.get_journal_changes(session, 'public', origin, 101)
+    assert [c['serial'] for c in changes] == [101]
+    # 同じシリアルの間に追加して削除した 192.0.2.3 は相殺されます。
+    assert ops(changes[0]) == (['www 60 IN A 192.0.2.1'], ['www 60 IN A 192.0.2.2'])
+
+    changes = query.get_journal_changes(session, 'public', origin)
+    assert [c['serial'] for c in changes] == [0, 100, 101]
+    # 新しいzoneのSOAは、作成する前のシリアル(0)で記録されます。
+    soa100 = '@ IN SOA ns.example.com. admin.example.com. ( 100 3600 1200 604800 600 )'
+    assert ops(changes[0]) == ([], [soa100])
+    # シリアルの更新は、変更前のシリアルで古いSOAの削除と新しいSOAの追加として記録されます。
+    soa101 = '@ IN SOA ns.example.com. admin.example.com. ( 101 3600 1200 604800 600 )'
+    assert ops(changes[1]) == ([soa100], ['www 60 IN A 192.0.2.1', soa101])
+
+    assert query.compact_journal(session, [('public', origin)], serial=101) == 4
+    assert [c['serial'] for c in query.get_journal_changes(session, 'public', origin)] == [101]
+    query.delete_records(session, origin=origin, namespace='public')
+    query.compact_journal(session, [('public', origin)], serial=102)
+
+
+def test_records_as_of(session_factory):
+    session = session_factory()
+    origin = 'asof.example.com.'
+
+    def as_of(point):
+        return [(r.name, r.ttl, r.data) for r in query.get_records_as_of(session, 'public', origin, point)]
+
+    query.set_soa_records(session, namespace='public', origin=origin,
+                          nameserver='ns.example.com', email='admin@example.com', serial=1)
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.1')
+    query.update_serial(session, origin, 'public', force=True)
+    time.sleep(0.01)
+    point = datetime.now()
+    time.sleep(0.01)
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+    query.set_records(session, origin=origin, namespace='public', name='mail', type='A', data='192.0.2.3')
+    query.update_serial(session, origin, 'public', force=True)
+
+    soa1 = ('@', None, 'ns.example.com. admin.example.com. ( 1 3600 1200 604800 600 )')
+    soa2 = ('@', None, 'ns.example.com. admin.example.com. ( 2 3600 1200 604800 600 )')
+    assert as_of(0) == []
+    assert as_of(1) == [soa1]
+    assert as_of(2) == [soa2, ('www', 60, '192.0.2.1')]
+    assert as_of(point) == [soa2, ('www', 60, '192.0.2.1')]
+    current = as_of(3)
+    assert [r[0] for r in current] == ['@', 'mail', 'www']
+    assert query.get_records_as_of(session, 'public', origin, 3)[1].fqdn == 'mail.asof.example.com'
+
+    # スナップショットと、スナップショット以降の変更履歴から再構成します。
+    assert query.take_snapshots(session, [('public', origin)], interval=100) == []
+    assert len(query.take_snapshots(session, [('public', origin)], interval=1)) == 1
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.4')
+    assert ('www', 60, '192.0.2.4') in as_of(datetime.now())
+    assert as_of(3) == current
+
+    # 削除した範囲の最後の時点はスナップショットとして残り、それより前は再構成できません。
+    assert query.compact_journal(session, [('public', origin)], serial=3) > 0
+    assert as_of(3) == current
+    with pytest.raises(ValueError):
+        as_of(2)
+    query.delete_records(session, origin=origin, namespace='public')
+
+
+def test_set_records_conflict(session_factory, monkeypatch):
+    # scoped_session は同じSessionを返すため、独立した2つのSessionを作成します。
+    session, other = session_factory.session_factory(), session_factory.session_factory()
+    origin = 'conflict.example.com.'
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.1')
+    records = query.get_records(session, namespace='public', origin=origin, name='www')
+    assert [r.version for r in records] == [1]
+    session.commit()
+
+    # 読み込んでから変更するまでの間に、他のSessionが同じ行を変更します。
+    table = ZoneRecord.__table__
+    merge = query._merge_set_records
+    calls = []
+
+    def concurrent_merge(records, *args, **kwargs):
+        if not calls:
+            other.execute(table.update().where(table.c.id == records[0].id).values(
+                data='192.0.2.2', version=table.c.version + 1))
+            other.commit()
+        calls.append([(r.data, r.version) for r in records])
+        return merge(records, *args, **kwargs)
+    monkeypatch.setattr(query, '_merge_set_records', concurrent_merge)
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A',
+                      data=['192.0.2.3', '192.0.2.4'])
+    monkeypatch.undo()
+    # versionが一致しないため1回目の変更は失敗し(StaleDataError)、読み込みからやり直しています。
+    assert calls == [[('192.0.2.1', 1)], [('192.0.2.2', 2)]]
+    records = query.get_records(other, namespace='public', origin=origin, name='www')
+    assert sorted([(r.data, r.version) for r in records]) == [('192.0.2.3', 3), ('192.0.2.4', 1)]
+    other.commit()
+
+    # やり直しても競合する場合は ConcurrentUpdateError になります。
+    def conflict(*args, **kwargs):
+        raise StaleDataError('conflict')
+    monkeypatch.setattr(query, 'WRITE_RETRY_INTERVAL', 0)
+    monkeypatch.setattr(query, '_merge_set_records', conflict)
+    with pytest.raises(query.ConcurrentUpdateError):
+        query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.5')
+    monkeypatch.undo()
+    assert sorted([r.data for r in query.get_records(session, namespace='public', origin=origin)]) == [
+        '192.0.2.3', '192.0.2.4']
+    query.delete_records(session, origin=origin, namespace='public')
+    session.close()
+    other.close()
@@ -0,0 +1,94 @@
+import pytest
+from bind9zone import query, querycache
+from bind9zone.querycache import QueryCache
+from bind9zone.cli import Bind9ZoneCLI
+
+
+def test_query_cache_records(session_factory):
+    session = session_factory()
+    origin = 'cache.example.com.'
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.1')
+    cache = QueryCache()
+
+    assert [r.data for r in cache.get_records(session, 'public', origin, name='www')] == ['192.0.2.1']
+    assert [r.data for r in cache.get_records(session, 'public', origin, name='www')] == ['192.0.2.1']
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'validations': 1, 'evictions': 0, 'size': 1}
+    # キャッシュしたレコードはZoneRecordではなく、変更できないnamedtupleです。
+    record = cache.get_records(session, 'public', origin, name='www')[0]
+    assert record.text == 'www 60 IN A 192.0.2.1 ; meta=(id={})'.format(record.id)
+    with pytest.raises(AttributeError):
+        record.data = '192.0.2.9'
+    assert cache.stats()['hits'] == 2
+
+    # 書き込みで世代番号が進むと、キャッシュは使用されません。
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+    assert [r.data for r in cache.get_records(session, 'public', origin, name='www')] == ['192.0.2.2']
+    assert cache.stats()['misses'] == 2
+
+    # 他のzoneの変更は影響しません。
+    query.set_records(session, origin='other.' + origin, namespace='public', name='www', type='A', data='192.0.2.9')
+    cache.get_records(session, 'public', origin, name='www')
+    assert cache.stats()['hits'] == 3
+    query.delete_records(session, origin=origin, namespace='public')
+    query.delete_records(session, origin='other.' + origin, namespace='public')
+    assert cache.get_records(session, 'public', origin, name='www') == []
+
+
+def test_query_cache_stale_and_eviction(session_factory):
+    session = session_factory()
+    origin = 'stale.example.com.'
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.1')
+
+    # stale の間は世代番号を確認せずに返します。
+    cache = QueryCache(stale=60)
+    cache.get_records(session, 'public', origin)
+    query.set_records(session, origin=origin, namespace='public', name='www', type='A', data='192.0.2.2')
+    assert [r.data for r in cache.get_records(session, 'public', origin)] == ['192.0.2.1']
+    assert cache.stats()['validations'] == 0
+    cache.invalidate(namespace='public', origin=origin)
+    assert [r.data for r in cache.get_records(session, 'public', origin)] == ['192.0.2.2']
+
+    cache = QueryCache(max_entries=1, ttl=0)
+    cache.get_records(session, 'public', origin, name='www')
+    cache.get_records(session, 'public', origin)
+    cache.get_records(session, 'public', origin)
+    assert cache.stats() == {'hits': 0, 'misses': 3, 'validations': 0, 'evictions': 1, 'size': 1}
+    query.delete_records(session, origin=origin, namespace='public')
+
+
+def test_query_cache_namespace_zones(session_factory):
+    session = session_factory()
+    cache = QueryCache()
+    zones = cache.get_namespace_zones(session, namespace='public')
+    assert ('public', 'example.com.') in zones
+    assert cache.get_namespace_zones(session, namespace='public') == zones
+    assert cache.stats()['hits'] == 1
+
+    query.set_records(session, origin='newzone.example.com.', namespace='public', name='www', type='A',
+                      data='192.0.2.1')
+    assert ('public', 'newzone.example.com.') in cache.get_namespace_zones(session, namespace='public')
+    query.delete_records(session, origin='newzone.example.com.', namespace='public')
+    assert ('public', 'newzone.example.com.') not in cache.get_namespace_zones(session, namespace='public')
+
+
+def test_query_cache_cli(connection, monkeypatch, capsys):
+    monkeypatch.setattr(querycache, '_shared_cache', None)
+    con = ['--connection', connection]
+    zone = ['--zone', 'public/example.com']
+    assert Bind9ZoneCLI(['get', *con, *zone, 'server', 'A']).run() == 0
+    expect = capsys.readouterr().out
+    assert 'server 60 IN A 192.0.2.11' in expect
+
+    # 同じプロセス内の呼び出しでは、2回目以降はキャッシュから返します。
+    for _ in range(2):
+        assert Bind9ZoneCLI(['get', *con, *zone, 'server', 'A', '--query-cache']).run() == 0
+        assert capsys.readouterr().out == expect
+    stats = querycache.get_shared_cache().stats()
+    assert (stats['misses'], stats['hits']) == (1, 1)
+
+    # 変更されたzoneは取得し直します。
+    assert Bind9ZoneCLI(['set', *con, *zone, 'querycache', 'A', '192.0.2.1']).run() == 0
+    assert Bind9ZoneCLI(['get', *con, *zone, 'querycache', 'A', '--query-cache']).run() == 0
+    assert Bind9ZoneCLI(['delete', *con, *zone, 'querycache', 'A']).run() == 0
+    assert Bind9ZoneCLI(['get', *con, *zone, 'querycache', 'A', '--query-cache']).run() == 2
+    capsys.readouterr()
@@ -0,0 +1,161 @@
+import os
+import struct
+import ipaddress
+from io import BytesIO, StringIO
+import pytest
+from bind9zone import ZoneFile, ZoneRecord, query, database
+from bind9zone.cli import Bind9ZoneCLI
+from bind9zone.rawzone import write_raw_zone, rdata_to_wire, RawFormatError, RRTYPE_CODES
+
+TYPE_NAMES = {v: k for k, v in RRTYPE_CODES.items()}
+
+
+def decode_name(wire, pos):
+    labels = []
+    while wire[pos] != 0:
+        length = wire[pos]
+        labels.append(wire[pos + 1:pos + 1 + length].decode('utf-8'))
+        pos += 1 + length
+    return '.'.join(labels) + '.', pos + 1
+
+
+def decode_rdata(type, wire):
+    """ テスト用のリファレンスデコーダです。ワイヤ形式のrdataをテキスト表記に戻します。 """
+    if type == 'A':
+        return str(ipaddress.IPv4Address(wire))
+    if type == 'AAAA':
+        return str(ipaddress.IPv6Address(wire))
+    if type in ('NS', 'CNAME', 'PTR'):
+        return decode_name(wire, 0)[0]
+    if type == 'MX':
+        return '{} {}'.format(struct.unpack('!H', wire[:2])[0], decode_name(wire, 2)[0])
+    if type == 'TXT':
+        strings, pos = [], 0
+        while pos < len(wire):
+            strings.append('"{}"'.format(wire[pos + 1:pos + 1 + wire[pos]].decode('utf-8')))
+            pos += 1 + wire[pos]
+        return ' '.join(strings)
+    if type == 'SOA':
+        mname, pos = decode_name(wire, 0)
+        rname, pos = decode_name(wire, pos)
+        return '{} {} ( {} {} {} {} {} )'.format(mname, rname, *struct.unpack('!IIIII', wire[pos:]))
+    raise AssertionError(type)
+
+
+def decode_raw_zone(data):
+    format, version, dumptime, flags, sourceserial, lastxfrin = struct.unpack('!IIIIII', data[:24])
+    assert (format, version, flags) == (2, 1, 0)
+    pos, records = 24, []
+    while pos < len(data):
+        totallen, rdclass, rdtype, covers, ttl, count = struct.unpack('!IHHHII', data[pos:pos + 18])
+        assert rdclass == 1 and covers == 0
+        end, pos = pos + totallen, pos + 18
+        namelen = struct.unpack('!H', data[pos:pos + 2])[0]
+        name = decode_name(data[pos + 2:pos + 2 + namelen], 0)[0]
+        pos += 2 + namelen
+        for _ in range(count):
+            rdlen = struct.unpack('!H', data[pos:pos + 2])[0]
+            type = TYPE_NAMES[rdtype]
+            records.append((name, ttl, type, decode_rdata(type, data[pos + 2:pos + 2 + rdlen])))
+            pos += 2 + rdlen
+        assert pos == end
+    return records
+
+
+def expect_records(records):
+    """ テキスト形式のレコードを、リファレンスデコーダと同じ表記(名前は絶対名)に揃えます。 """
+    def absolute(name, origin):
+        if name == '@':
+            return origin
+        return name if name.endswith('.') else name + '.' + origin
+
+    result = []
+    for r in records:
+        data = r.get_soa_text() if r.type == 'SOA' else r.data
+        if r.type in ('NS', 'CNAME', 'PTR'):
+            data = absolute(data, r.origin)
+        elif r.type == 'MX':
+            pref, exchange = data.split()
+            data = '{} {}'.format(pref, absolute(exchange, r.origin))
+        elif r.type == 'AAAA':
+            data = str(ipaddress.IPv6Address(data))
+        ttl = r.ttl if r.ttl is not None else 600
+        result.append((r.fqdn + '.', ttl, r.type, data))
+    return sorted(result)
+
+
+def test_rawzone_roundtrip(zonedir_src):
+    zonefile = os.path.join(zonedir_src, 'public/example.com.zone')
+    with open(zonefile, mode='r') as reader:
+        records = [ZoneRecord({**r, 'namespace': 'public'})
+                   for r in ZoneFile.from_stream(StringIO(reader.read()))]
+    records = ZoneFile.sort_records(records)
+    output = BytesIO()
+    count = write_raw_zone(records, output, dumptime=0)
+    # multi/A の3レコードは1つのRRsetにまとめられます。
+    assert count == len(records) - 2
+    assert sorted(decode_raw_zone(output.getvalue())) == expect_records(records)
+
+
+def test_pullzone_raw(connection, tmp_path):
+    con = ['--connection', connection]
+    os.mkdir(str(tmp_path / 'private'))
+    code = Bind9ZoneCLI(['pullzone', *con, '--zone', 'private/example.com',
+                         '--dir', str(tmp_path), '--format', 'raw']).run()
+    assert code == 0
+    with open(str(tmp_path / 'private' / 'example.com.zone.raw'), mode='rb') as reader:
+        decoded = decode_raw_zone(reader.read())
+    with open('tests/input/private/example.com.zone', mode='r') as reader:
+        records = [ZoneRecord({**r, 'namespace': 'private'}) for r in ZoneFile.from_stream(reader)]
+    assert sorted(decoded) == expect_records(records)
+
+
+def test_rawzone_key_sig_cert():
+    assert rdata_to_wire('KEY', '256 3 RSASHA1 AQID BAU=', 'example.com.') == bytes.fromhex('010003050102030405')
+    assert rdata_to_wire('CERT', 'PGP 0 0 AQID', 'example.com.') == bytes.fromhex('0003000000010203')
+    # 日時は YYYYMMDDHHmmSS(UTC) または秒数で指定でき、括弧で複数行に分けた値も変換できます。
+    sig = 'A 5 2 86400 20300101000000 1577836800 2642 example.com. ( AQID\n BAU= )'
+    assert rdata_to_wire('SIG', sig, 'example.com.') == (
+        bytes.fromhex('0001 05 02 00015180 70dbd880 5e0be100 0a52'.replace(' ', ''))
+        + b'\x07example\x03com\x00' + bytes.fromhex('0102030405'))
+    with pytest.raises(RawFormatError):
+        rdata_to_wire('CAA', '0 issue "ca.example.net"', 'example.com.')
+
+
+def test_rawzone_sig_covers():
+    zonetext = '\n'.join([
+        "$ORIGIN example.com.",
+        "www 60 IN SIG A 5 3 60 20300101000000 20200101000000 2642 example.com. AQID",
+        "www 60 IN SIG MX 5 3 60 20300101000000 20200101000000 2642 example.com. BAU=",
+        "www 60 IN SIG A 5 3 60 20300101000000 20200101000000 2643 example.com. BgcI",
+        "www 60 IN RRSIG A 8 3 60 20300101000000 20200101000000 2644 example.com. CQoL",
+    ])
+    records = [ZoneRecord({**r, 'namespace': 'public'}) for r in ZoneFile.from_stream(StringIO(zonetext))]
+    output = BytesIO()
+    # SIGは署名するtypeごとに別のRRsetになり、連続していない同じtypeのSIGもまとめられます。
+    assert write_raw_zone(ZoneFile.sort_records(records), output, dumptime=0) == 3
+    data, pos, rdatasets = output.getvalue(), 24, []
+    while pos < len(data):
+        totallen, rdclass, rdtype, covers, ttl, count = struct.unpack('!IHHHII', data[pos:pos + 18])
+        rdatasets.append((rdtype, covers, count))
+        pos += totallen
+    assert sorted(rdatasets) == [(24, 1, 2), (24, 15, 1), (46, 1, 1)]
+
+
+def test_pullzone_raw_unsupported(connection, tmp_path):
+    con = ['--connection', connection]
+    origin = 'rawerror.example.com.'
+    with database.session_scope(connection) as session:
+        query.set_soa_records(session, origin, 'public', 'ns.example.com.', 'admin@example.com')
+        query.set_records(session, origin=origin, namespace='public', name='@', type='CAA',
+                          data='0 issue "ca.example.net"')
+    try:
+        os.mkdir(str(tmp_path / 'public'))
+        # 変換できないレコードを含むzoneは、トレースバックではなく終了コード1になり、ファイルは作成されません。
+        code = Bind9ZoneCLI(['pullzone', *con, '--zone', 'public/rawerror.example.com',
+                             '--dir', str(tmp_path), '--format', 'raw']).run()
+        assert code == 1
+        assert os.listdir(str(tmp_path / 'public')) == []
+    finally:
+        with database.session_scope(connection) as session:
+            query.delete_records(session, origin=origin, namespace='public')
@@ -0,0 +1,40 @@
+import ipaddress
+import pytest
+from bind9zone import ZoneRecord
+from bind9zone.reversezone import ReverseZoneIndex, reverse_zone_origin, build_reverse_zones
+
+
+def test_reverse_zone_origin():
+    assert reverse_zone_origin(ipaddress.ip_network('192.0.2.0/24')) == '2.0.192.in-addr.arpa.'
+    assert reverse_zone_origin(ipaddress.ip_network('10.0.0.0/8')) == '10.in-addr.arpa.'
+    assert reverse_zone_origin(ipaddress.ip_network('2001:db8::/32')) == '8.b.d.0.1.0.0.2.ip6.arpa.'
+    with pytest.raises(ValueError):
+        reverse_zone_origin(ipaddress.ip_network('192.0.2.0/25'))
+    with pytest.raises(ValueError):
+        reverse_zone_origin(ipaddress.ip_network('2001:db8::/33'))
+
+
+def test_reverse_zone_index():
+    index = ReverseZoneIndex(['192.0.2.0/24', '198.51.100.0/24', '10.0.0.0/8', '2001:db8:1::/48'])
+    assert index.lookup(ipaddress.ip_address('192.0.2.255')) == '2.0.192.in-addr.arpa.'
+    assert index.lookup(ipaddress.ip_address('10.20.30.40').packed) == '10.in-addr.arpa.'
+    assert index.lookup(ipaddress.ip_address('192.0.3.1')) is None
+    assert index.lookup(ipaddress.ip_address('9.255.255.255')) is None
+    assert index.lookup(ipaddress.ip_address('2001:db8:1:2::1')) == '1.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa.'
+    assert index.lookup(ipaddress.ip_address('2001:db8:2::1')) is None
+    with pytest.raises(ValueError):
+        ReverseZoneIndex(['10.0.0.0/8', '10.1.0.0/16'])
+
+
+def test_build_reverse_zones():
+    def record(name, type, data):
+        return ZoneRecord({'name': name, 'type': type, 'data': data, 'ttl': 60,
+                           'origin': 'example.com.', 'namespace': 'public'})
+    records = [record('www', 'A', '192.0.2.10'), record('mail', 'A', '192.0.2.2'),
+               record('other', 'A', '203.0.113.1'), record('v6', 'AAAA', '2001:db8::1')]
+    zones = build_reverse_zones(records, ReverseZoneIndex(['192.0.2.0/24', '2001:db8::/32', '198.51.100.0/24']))
+    assert zones['2.0.192.in-addr.arpa.'] == [
+        ('2', 60, 'mail.example.com.'), ('10', 60, 'www.example.com.')]
+    assert zones['8.b.d.0.1.0.0.2.ip6.arpa.'] == [
+        ('1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0', 60, 'v6.example.com.')]
+    assert zones['100.51.198.in-addr.arpa.'] == []
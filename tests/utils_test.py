@@ -33,3 +33,18 @@ def test_origin_with_dot():
     for o in origins:
         with pytest.raises(ValueError):
             zutils.origin_with_dot(o)
+
+
+def test_is_domain_and_slug():
+    import validators
+    domains = ['example.com', 'EXAMPLE.co.jp', 'a.b', 'www.example.jp', '_dmarc.example.com',
+               'xn--p1ai.xn--p1ai', 'テスト.jp', 'example', '-bad.example.com', 'bad-.example.com',
+               'example.c0m', 'example.com/', '', 'a' * 64 + '.com', 'a..com', 'under_score.example.com']
+    assert [zutils.is_domain(d) for d in domains] == [bool(validators.domain(d)) for d in domains]
+    slugs = ['public', 'private-1', 'my_slug', 'my.slug', '', 'スラッグ']
+    assert [zutils.is_slug(s) for s in slugs] == [bool(validators.slug(s)) for s in slugs]
+    assert zutils.is_domain(None) is False
+
+    hits = zutils.is_domain.cache_info().hits
+    zutils.is_domain('example.com')
+    assert zutils.is_domain.cache_info().hits == hits + 1
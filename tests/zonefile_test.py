@@ -1,8 +1,12 @@
 import re
 import os
 import textwrap
+import asyncio
+import pytest
 from io import StringIO
-from bind9zone import ZoneFile, ZoneRecord
+from bind9zone import ZoneFile, ZoneRecord, ParsedRecord
+from bind9zone.zonefile import ZoneParseError
+from bind9zone import utils as zutils
 
 
 def normalize_zonefile(stream):
@@ -21,9 +25,9 @@ def test_zonefile_io(zonedir_src):
     $ORIGIN example.com.
     $TTL 600
     @  IN SOA ns.example.com. admin.example.com. ( 2101202346 600 600 604800 60 ) ; meta=(id=None)
+    @ 60 IN NS dns ; meta=(id=None)
     @ 60 IN A 192.168.1.11 ; meta=(id=None)
     @ 60 IN MX 10 server ; meta=(id=None)
-    @ 60 IN NS dns ; meta=(id=None)
     @ 60 IN TXT "v=spf1 ip4:192.168.1.5/32 ~all" ; meta=(id=None)
     alias 60 IN CNAME server ; meta=(id=None)
     dns 60 IN A 192.168.1.11 ; meta=(id=None)
@@ -77,3 +81,142 @@ def test_zonefile_multiline_soa():
     records = [ZoneRecord(r) for r in ZoneFile.from_stream(StringIO(zonetext))]
     assert records[0].name == '@'
     assert records[0].type == 'SOA'
+
+
+def test_zonefile_parsed_record():
+    zonetext = '\n'.join([
+        "$ORIGIN example.jp.",
+        "$TTL 600",
+        "www 60 IN A 192.0.2.1 ; meta=(id=10)",
+        "    IN A 192.0.2.2",
+    ])
+    records = list(ZoneFile.from_stream(StringIO(zonetext)))
+    assert all([isinstance(r, ParsedRecord) for r in records])
+    assert records[0]['id'] == 10
+    assert records[0]['class'] == 'IN'
+    assert 'id' not in records[1]
+    assert {**records[1]} == {
+        'name': 'www', 'ttl': '60', 'class': 'IN', 'type': 'A',
+        'data': '192.0.2.2', 'origin': 'example.jp.'}
+
+    record = ZoneRecord({**records[0], 'namespace': 'public'})
+    assert record.id == 10
+    assert record.fqdn == 'www.example.jp'
+    assert ZoneRecord.to_insert_row(records[1], 'public') == {
+        'name': 'www', 'type': 'A', 'data': '192.0.2.2', 'ttl': 60,
+        'origin': 'example.jp.', 'namespace': 'public', 'fqdn': 'www.example.jp',
+        'sort_key': record.sort_key, 'rdata_address': bytes([192, 0, 2, 2]),
+        'rdata_target': None, 'rdata_priority': None, 'rdata_weight': None, 'rdata_port': None,
+        'soa_mname': None, 'soa_rname': None, 'soa_serial': None, 'soa_refresh': None,
+        'soa_retry': None, 'soa_expire': None, 'soa_minimum': None}
+
+
+def test_zonefile_canonical_order():
+    zonetext = '\n'.join([
+        "$ORIGIN example.jp.",
+        "$TTL 600",
+        "z 60 IN A 192.0.2.1",
+        "a.b 60 IN A 192.0.2.2",
+        "B 60 IN A 192.0.2.3",
+        "b 60 IN TXT \"b\"",
+        "@ 60 IN MX 10 mail",
+        "@ 60 IN NS ns1",
+        "@ 600 IN SOA ns.example.jp. admin.example.jp. ( 1 600 600 604800 60 )",
+        "c.example.jp. 60 IN A 192.0.2.4",
+    ])
+    records = [ZoneRecord({**r, 'namespace': 'public'})
+               for r in ZoneFile.from_stream(StringIO(zonetext))]
+    lines = list(ZoneFile.iter_zonefile(records))
+    # apexのSOA -> apexのNS -> 所有者名(ラベルを逆順に比較) -> type の順に並びます。
+    assert [l.split(' ')[0] + ' ' + l.split(' ')[3] for l in lines[2:]] == [
+        '@ SOA', '@ NS', '@ MX', 'B A', 'b TXT', 'a.b A', 'c A', 'z A']
+    assert ZoneFile.to_zonefile(records) == '\n'.join(lines)
+
+    # 以前の types/names 引数も指定でき、正規順序より優先されます。
+    def owners(sorted_records):
+        return [r.to_record().split(' ')[0] + ' ' + r.type for r in sorted_records]
+    assert owners(ZoneFile.sort_records(records, types=['SOA'], names=['@'])) == [
+        '@ SOA', '@ NS', '@ MX', 'B A', 'b TXT', 'a.b A', 'c A', 'z A']
+    assert owners(ZoneFile.sort_records(records, types=['A'], names=['z'])) == [
+        'z A', 'B A', 'a.b A', 'c A', '@ SOA', '@ NS', '@ MX', 'b TXT']
+
+
+def test_zonefile_compact_roundtrip(zonedir_src):
+    def record_set(records):
+        return sorted([(r.fqdn, r.type, r.data, r.ttl) for r in records])
+
+    zonefile = os.path.join(zonedir_src, 'private/example.jp.zone')
+    with open(zonefile, mode='r') as reader:
+        records = [ZoneRecord({**r, 'namespace': 'public'})
+                   for r in ZoneFile.from_stream(StringIO(reader.read()))]
+    records.append(ZoneRecord({'name': 'www', 'type': 'A', 'data': '192.0.2.1', 'ttl': 3600,
+                               'origin': 'example.jp.', 'namespace': 'public'}))
+    records.append(ZoneRecord({'name': 'www', 'type': 'A', 'data': '192.0.2.2', 'ttl': 3600,
+                               'origin': 'example.jp.', 'namespace': 'public'}))
+
+    full = ZoneFile.to_zonefile(records)
+    lines = list(ZoneFile.iter_zonefile(records, compact=True, with_meta=False))
+    assert lines[1] == '$TTL 60'
+    assert len('\n'.join(lines)) < len(full)
+    assert all(['meta=' not in line for line in lines])
+    # 名前の省略された行と、TTLの省略された行が含まれます。
+    assert any([line.startswith(' ') for line in lines])
+    assert any([re.match(r'^\S* IN ', line) for line in lines])
+
+    parsed = [ZoneRecord({**r, 'namespace': 'public'})
+              for r in ZoneFile.from_stream(StringIO('\n'.join(lines)))]
+    assert record_set(parsed) == record_set(records)
+
+
+def test_zonefile_async_stream(zonedir_src):
+    zonefile = os.path.join(zonedir_src, 'private/example.jp.zone')
+    with open(zonefile, mode='rb') as reader:
+        zonebytes = reader.read()
+    expect = list(ZoneFile.from_stream(StringIO(zonebytes.decode('utf-8'))))
+
+    async def chunks(size):
+        # 行やSOAの途中で分割されたチャンクを模擬します。
+        for i in range(0, len(zonebytes), size):
+            await asyncio.sleep(0)
+            yield zonebytes[i:i + size]
+
+    class LineReader(object):
+        def __init__(self):
+            self.lines = zonebytes.splitlines(keepends=True)
+
+        async def readline(self):
+            return self.lines.pop(0) if self.lines else b''
+
+    async def collect(stream):
+        batches = []
+        async for batch in zutils.aiter_batches(ZoneFile.from_async_stream(stream), 4):
+            batches.append(batch)
+        return batches
+
+    for stream in (chunks(7), chunks(4096), LineReader()):
+        batches = asyncio.run(collect(stream))
+        assert all([len(b) <= 4 for b in batches])
+        assert [r for b in batches for r in b] == expect
+    assert [r.name for r in expect][-1] == 'empty'
+
+
+def test_zonefile_missed_lines():
+    zonetext = '\n'.join([
+        "$ORIGIN example.jp.",
+        "    IN A 192.0.2.1",
+        "$TTL 600",
+        "www 60 IN A 192.0.2.2",
+        "$UNKNOWN foo",
+        "this is not a record",
+        "mail 60 IN MX 10 www",
+        "@  IN SOA ns.example.com. admin.example.com. (",
+    ])
+    with pytest.raises(ZoneParseError) as e:
+        list(ZoneFile.from_stream(StringIO(zonetext)))
+    assert e.value.lineno == 2
+
+    missed = []
+    records = list(ZoneFile.from_stream(StringIO(zonetext), missed_lines=missed))
+    assert [(r.name, r.type) for r in records] == [('www', 'A'), ('mail', 'MX')]
+    assert [m['line'] for m in missed] == [2, 5, 6, 8]
+    assert missed[2] == {'line': 6, 'text': 'this is not a record', 'reason': 'Unrecognized line'}
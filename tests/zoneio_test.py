@@ -0,0 +1,54 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import pytest
+from bind9zone import ZoneFile
+from bind9zone.zoneio import open_zone_reader, find_zone_file
+
+
+@pytest.fixture
+def zonebytes(zonedir_src):
+    with open(os.path.join(zonedir_src, 'public/example.com.zone'), mode='rb') as reader:
+        return reader.read()
+
+
+class TrickleReader(io.RawIOBase):
+    """ パイプのように数バイトずつしか返さないストリームです。 """
+
+    def __init__(self, data):
+        self.data = data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.data), 3)
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+@pytest.mark.parametrize('compress', [lambda b: b, gzip.compress, bz2.compress, lzma.compress])
+def test_open_zone_reader(zonebytes, compress, tmp_path):
+    expect = zonebytes.decode('utf-8')
+    path = str(tmp_path / 'example.com.zone')
+    with open(path, mode='wb') as output:
+        output.write(compress(zonebytes))
+    with open_zone_reader(path) as reader:
+        assert reader.read() == expect
+
+    stream = TrickleReader(compress(zonebytes))
+    with open_zone_reader(stream) as reader:
+        records = list(ZoneFile.from_stream(reader))
+    assert len(records) == 20
+    assert not stream.closed
+
+
+def test_find_zone_file(zonebytes, tmp_path):
+    os.mkdir(str(tmp_path / 'public'))
+    assert find_zone_file(str(tmp_path), 'example.com', 'public') == str(tmp_path / 'public/example.com.zone')
+    with open(str(tmp_path / 'public/example.com.zone.xz'), mode='wb') as output:
+        output.write(lzma.compress(zonebytes))
+    assert find_zone_file(str(tmp_path), 'example.com', 'public') == str(tmp_path / 'public/example.com.zone.xz')